@@ -4,6 +4,7 @@ import { getTokens, warnUnauthenticated } from '@common/auth'
 import { Config } from '@common/types'
 import { API_BASE_URL } from '@config'
 import axios from 'axios'
+import crypto from 'crypto'
 import FormData from 'form-data'
 import fs from 'fs'
 import yaml from 'js-yaml'
@@ -28,6 +29,188 @@ const defaultIgnore = [
     '.DS_Store',
 ]
 
+const BUILD_POLL_INTERVAL = 1000
+
+// builds run in the background, so poll until this one is done, printing
+// its log as it comes in
+const waitForBuild = async (
+    buildId: string,
+    accessToken: string
+): Promise<string> => {
+    const headers = { Authorization: `Bearer ${accessToken}` }
+    let printed = 0
+
+    while (true) {
+        // the log is complete once the build is, so read the status first
+        const build = await axios.get(`${API_BASE_URL}/build/get`, {
+            params: { build_id: buildId },
+            headers,
+        })
+
+        const { status } = build.data
+
+        while (true) {
+            const res = await axios.get(`${API_BASE_URL}/build/logs`, {
+                params: { build_id: buildId, start: printed },
+                headers,
+            })
+
+            const { lines, total } = res.data
+            lines.forEach((line: string) => process.stdout.write(line))
+            printed += lines.length
+
+            if (lines.length === 0 || printed >= total) {
+                break
+            }
+        }
+
+        if (status !== 'CREATED' && status !== 'BUILDING') {
+            return status
+        }
+
+        await new Promise((resolve) =>
+            setTimeout(resolve, BUILD_POLL_INTERVAL)
+        )
+    }
+}
+
+type ManifestFile = {
+    path: string
+    hash: string
+    size: number
+    executable: boolean
+}
+
+// list the files in a folder the way tar would, skipping filtered paths
+const listFiles = (
+    baseFolder: string,
+    filter: (name: string) => boolean,
+    folder = '.'
+): string[] => {
+    const files: string[] = []
+
+    const entries = fs.readdirSync(path.join(baseFolder, folder), {
+        withFileTypes: true,
+    })
+
+    for (const entry of entries) {
+        const name = `${folder}/${entry.name}`
+
+        if (!filter(name)) {
+            continue
+        }
+
+        if (entry.isDirectory()) {
+            files.push(...listFiles(baseFolder, filter, name))
+        } else if (entry.isFile()) {
+            files.push(name)
+        }
+    }
+
+    return files
+}
+
+const hashFile = (file: string): Promise<string> =>
+    new Promise((resolve, reject) => {
+        const hash = crypto.createHash('sha256')
+
+        fs.createReadStream(file)
+            .on('data', (chunk) => hash.update(chunk))
+            .on('end', () => resolve(hash.digest('hex')))
+            .on('error', reject)
+    })
+
+const uploadDelta = async (
+    baseFolder: string,
+    scriptId: string,
+    filter: (name: string) => boolean,
+    accessToken: string,
+    debug: boolean
+) => {
+    const headers = { Authorization: `Bearer ${accessToken}` }
+    const manifest: ManifestFile[] = []
+
+    for (const name of listFiles(baseFolder, filter)) {
+        const file = path.join(baseFolder, name)
+        const stat = fs.statSync(file)
+
+        manifest.push({
+            path: name,
+            hash: await hashFile(file),
+            size: stat.size,
+            executable: (stat.mode & 0o111) !== 0,
+        })
+    }
+
+    const res = await axios.post(
+        `${API_BASE_URL}/script/build-manifest`,
+        { script_id: scriptId, files: manifest },
+        { headers }
+    )
+
+    const missing = new Set<string>(res.data.missing)
+    debug &&
+        console.log(`Uploading ${missing.size} of ${manifest.length} files`)
+
+    const form = new FormData()
+    form.append('script_id', scriptId)
+    form.append('manifest', JSON.stringify(manifest))
+
+    for (const file of manifest) {
+        if (missing.delete(file.hash)) {
+            form.append(
+                'files',
+                fs.createReadStream(path.join(baseFolder, file.path)),
+                { filename: file.hash }
+            )
+        }
+    }
+
+    return axios.post(`${API_BASE_URL}/script/build-delta`, form, {
+        headers: { ...form.getHeaders(), ...headers },
+        maxBodyLength: Infinity,
+    })
+}
+
+const uploadContext = async (
+    baseFolder: string,
+    scriptId: string,
+    filter: (name: string) => boolean,
+    accessToken: string,
+    debug: boolean
+) => {
+    const tmpFile = tmp.fileSync()
+    debug && console.log(`Created temporary file ${tmpFile.name} for tarball`)
+
+    try {
+        await tar.c(
+            {
+                gzip: true,
+                file: tmpFile.name,
+                cwd: baseFolder,
+                filter,
+            },
+            ['./']
+        )
+
+        const form = new FormData()
+        form.append('script_id', scriptId)
+        form.append('context', fs.createReadStream(tmpFile.name))
+
+        // use a raw axios request because openapi-generator doesn't like streams
+        return await axios.post(`${API_BASE_URL}/script/build`, form, {
+            headers: {
+                ...form.getHeaders(),
+                Authorization: `Bearer ${accessToken}`,
+            },
+            maxBodyLength: Infinity,
+        })
+    } finally {
+        // delete the temporary file
+        tmpFile.removeCallback()
+    }
+}
+
 export const deploy = (program: Command) => {
     program
         .command('deploy')
@@ -111,45 +294,46 @@ export const deploy = (program: Command) => {
 
             const config: Config = yaml.load(configContents) as Config
 
-            const tmpFile = tmp.fileSync()
-            debug &&
-                console.log(
-                    `Created temporary file ${tmpFile.name} for tarball`
-                )
+            const filter = (name: string) => {
+                const keep = !nonnegatedMatcher(name) || negatedMatcher(name)
+                debug && console.log(`${name} ${keep ? 'keep' : 'ignore'}`)
+                return keep
+            }
 
-            await tar.c(
-                {
-                    gzip: true,
-                    file: tmpFile.name,
-                    filter: (name: string) => {
-                        const keep =
-                            !nonnegatedMatcher(name) || negatedMatcher(name)
-                        debug &&
-                            console.log(`${name} ${keep ? 'keep' : 'ignore'}`)
-                        return keep
-                    },
-                },
-                ['./']
-            )
+            // only upload the files the server does not have yet, falling
+            // back to the whole context if that fails
+            uploadDelta(baseFolder, config.id, filter, access_token, debug)
+                .catch((err) => {
+                    if ([401, 403, 404].includes(err.response?.status)) {
+                        throw err
+                    }
+
+                    debug && console.log(err)
+                    debug && console.log('Uploading the whole context')
 
-            const form = new FormData()
-            form.append('script_id', config.id)
-            form.append('context', fs.createReadStream(tmpFile.name))
-
-            // use a raw axios request because openapi-generator doesn't like streams
-            axios
-                .post(`${API_BASE_URL}/script/build`, form, {
-                    headers: {
-                        ...form.getHeaders(),
-                        Authorization: `Bearer ${access_token}`,
-                    },
+                    return uploadContext(
+                        baseFolder,
+                        config.id,
+                        filter,
+                        access_token,
+                        debug
+                    )
                 })
-                .then((res) => {
-                    console.log('Script deployed successfully')
-                    console.log(tmpFile.name)
+                .then(async (res) => {
+                    const buildId: string = res.data.id
+                    console.log(`Queued build ${buildId}`)
+
+                    const status = await waitForBuild(buildId, access_token)
 
-                    // delete the temporary file
-                    tmpFile.removeCallback()
+                    if (status === 'SUCCESS') {
+                        console.log('Script deployed successfully')
+                    } else if (status === 'SUPERSEDED') {
+                        console.log(
+                            `Build ${buildId} was superseded by a newer build`
+                        )
+                    } else {
+                        console.error(`Build ${buildId} failed`)
+                    }
                 })
                 .catch(warnUnauthenticated)
                 .catch((err) => {
@@ -173,9 +357,6 @@ export const deploy = (program: Command) => {
                     }
 
                     debug && console.log(err)
-
-                    // delete the temporary file
-                    tmpFile.removeCallback()
                 })
         })
 }
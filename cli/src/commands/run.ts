@@ -1,7 +1,46 @@
-import { warnUnauthenticated } from '@common/auth'
+import { getTokens, warnUnauthenticated } from '@common/auth'
 import { villageClient } from '@common/villageClient'
+import { API_BASE_URL } from '@config'
+import axios from 'axios'
 import { Command } from 'commander'
 
+// follow the output of a run as server-sent events until it finishes
+const tailRun = async (runId: string, debug: boolean) => {
+    const { access_token } = await getTokens({ debug })
+
+    const res = await axios.get(`${API_BASE_URL}/run/stream`, {
+        params: { run_id: runId },
+        headers: { Authorization: `Bearer ${access_token}` },
+        responseType: 'stream',
+    })
+
+    res.data.setEncoding('utf8')
+
+    let buffer = ''
+
+    for await (const chunk of res.data) {
+        buffer += chunk
+
+        let boundary = buffer.indexOf('\n\n')
+        while (boundary !== -1) {
+            const lines = buffer.slice(0, boundary).split('\n')
+            buffer = buffer.slice(boundary + 2)
+            boundary = buffer.indexOf('\n\n')
+
+            const data = lines.find((line) => line.startsWith('data: '))
+            if (data === undefined) continue
+
+            const payload = JSON.parse(data.slice('data: '.length))
+
+            if (lines.includes('event: end')) {
+                return payload.status
+            }
+
+            process.stdout.write(payload)
+        }
+    }
+}
+
 export const run = (program: Command) => {
     program
         .command('run')
@@ -27,11 +66,14 @@ export const run = (program: Command) => {
             }
             villageClient.scripts
                 .runScript({ script_id: program.args[1], params })
-                .then(({ build_id: buildId, output }) => {
+                .then(({ id, build_id: buildId }) => {
                     console.log(
                         `Running script ${program.args[1]} with build ${buildId}`
                     )
-                    console.log(output)
+                    return tailRun(id, debug)
+                })
+                .then((status) => {
+                    debug && console.log(`Run finished with status ${status}`)
                 })
                 .catch(warnUnauthenticated)
                 .catch((err) => {
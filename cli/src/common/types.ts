@@ -13,4 +13,13 @@ export interface Config {
     engine_version: string
 
     params: { [key: string]: ConfigParam }
+
+    // cores, megabytes (or a size such as '512m') and seconds
+    cpu?: number
+    memory?: number | string
+    timeout?: number
+
+    // runs with the same params share one output for cache_ttl seconds
+    cacheable?: boolean
+    cache_ttl?: number
 }
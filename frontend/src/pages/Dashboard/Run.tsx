@@ -1,9 +1,47 @@
 import { getDuration, getFormattedDateTime, getTimeSince } from '@common/dates'
 import { VillageClient } from '@common/VillageClient'
+import { API_BASE_URL } from '@config'
 import { PageLoading } from '@pages/PageLoading'
 import { useEffect, useState } from 'react'
 import { Link, useParams } from 'react-router-dom'
-import { RunWithScriptDetailed } from '../../../api'
+import { RunStatus, RunWithScriptDetailed } from '../../../api'
+
+// follow the output of a run as server-sent events until it finishes
+const tailRun = async (
+    runId: string,
+    onOutput: (output: string) => void,
+    signal: AbortSignal
+) => {
+    const res = await fetch(`${API_BASE_URL}/run/stream?run_id=${runId}`, {
+        headers: VillageClient.request.config.HEADERS as Record<string, string>,
+        signal,
+    })
+
+    if (res.body === null) return
+
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader()
+
+    let buffer = ''
+
+    for (;;) {
+        const { done, value } = await reader.read()
+        if (done) return
+
+        buffer += value
+
+        let boundary = buffer.indexOf('\n\n')
+        while (boundary !== -1) {
+            const lines = buffer.slice(0, boundary).split('\n')
+            buffer = buffer.slice(boundary + 2)
+            boundary = buffer.indexOf('\n\n')
+
+            const data = lines.find((line) => line.startsWith('data: '))
+            if (data === undefined || lines.includes('event: end')) continue
+
+            onOutput(JSON.parse(data.slice('data: '.length)))
+        }
+    }
+}
 
 export const Run = () => {
     const { id } = useParams()
@@ -18,6 +56,35 @@ export const Run = () => {
         })
     }, [id])
 
+    useEffect(() => {
+        if (run === null) return
+        if (
+            run.status !== RunStatus.CREATED &&
+            run.status !== RunStatus.RUNNING
+        )
+            return
+
+        const controller = new AbortController()
+
+        const appendOutput = (chunk: string) => {
+            setRun((prev) => prev && { ...prev, output: prev.output + chunk })
+        }
+
+        // the stream replays the output from the start
+        setRun((prev) => prev && { ...prev, output: '' })
+
+        tailRun(run.id, appendOutput, controller.signal)
+            .then(() => VillageClient.runs.getRun(run.id))
+            .then((s) => {
+                setRun(s)
+            })
+            .catch((err) => {
+                if (!controller.signal.aborted) console.error(err)
+            })
+
+        return () => controller.abort()
+    }, [run?.id, run?.status])
+
     if (run === null) {
         return <PageLoading />
     }
@@ -6,3 +6,102 @@ ALLOWED_ORIGINS = [os.getenv("FRONTEND_URL")] + [
 ]
 
 TEMPORAL_SERVER = os.getenv("TEMPORAL_SERVER", "localhost:7233")
+
+# maximum number of containers the executor pool runs at once
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "8"))
+
+# warm containers kept per build, and how long an idle one may wait for a run
+WARM_POOL_MIN_SIZE = int(os.getenv("WARM_POOL_MIN_SIZE", "1"))
+WARM_POOL_MAX_SIZE = int(os.getenv("WARM_POOL_MAX_SIZE", "4"))
+WARM_POOL_IDLE_TTL = float(os.getenv("WARM_POOL_IDLE_TTL", "300"))
+# number of builds with warm containers, least recently used builds are evicted
+WARM_POOL_MAX_BUILDS = int(os.getenv("WARM_POOL_MAX_BUILDS", "16"))
+
+# run output is appended to storage once this many bytes are buffered, or after
+# this many seconds, whichever comes first
+RUN_OUTPUT_FLUSH_BYTES = int(os.getenv("RUN_OUTPUT_FLUSH_BYTES", "65536"))
+RUN_OUTPUT_FLUSH_INTERVAL = float(os.getenv("RUN_OUTPUT_FLUSH_INTERVAL", "0.5"))
+
+# concurrent runs per workspace, unless the workspace sets its own max_runs
+WORKSPACE_MAX_RUNS = int(os.getenv("WORKSPACE_MAX_RUNS", "4"))
+
+# resources reserved for a run whose build does not declare its own
+RUN_DEFAULT_CPU = float(os.getenv("RUN_DEFAULT_CPU", "1"))
+RUN_DEFAULT_MEMORY = int(os.getenv("RUN_DEFAULT_MEMORY", "512"))  # megabytes
+# capacity of the docker host, read from the daemon when unset
+EXECUTOR_CPU = os.getenv("EXECUTOR_CPU")
+EXECUTOR_MEMORY = os.getenv("EXECUTOR_MEMORY")  # megabytes
+
+# docker endpoints of the executor hosts, such as tcp://10.0.0.2:2376, separated
+# by commas. runs use the local daemon when unset
+EXECUTOR_HOSTS = [x for x in os.getenv("EXECUTOR_HOSTS", "").split(",") if x]
+EXECUTOR_HEARTBEAT_INTERVAL = float(os.getenv("EXECUTOR_HEARTBEAT_INTERVAL", "10"))
+
+# seconds a server process holds on to its runs and containers without renewing
+# its lease, after which the next process to start reclaims them
+INSTANCE_LEASE_TTL = float(os.getenv("INSTANCE_LEASE_TTL", "60"))
+# seconds between checks for runs of this process cancelled through another one
+RUN_CANCEL_POLL_INTERVAL = float(os.getenv("RUN_CANCEL_POLL_INTERVAL", "2"))
+
+# runs of a batch that may execute at once, unless the batch sets its own. the
+# workspace limit still applies on top
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "16"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "10000"))
+
+# outputs of cacheable builds kept in memory, and how long they stay fresh when
+# the build does not set its own cache_ttl
+RUN_CACHE_MAX_ENTRIES = int(os.getenv("RUN_CACHE_MAX_ENTRIES", "1024"))
+RUN_CACHE_TTL = float(os.getenv("RUN_CACHE_TTL", "3600"))  # seconds
+
+# seconds a run may take when neither it nor its build sets a timeout
+RUN_DEFAULT_TIMEOUT = float(os.getenv("RUN_DEFAULT_TIMEOUT", "3600"))
+
+# outputs of at least this many bytes are moved to the compressed blob store
+# once their run finishes, and the chunks a run's output was streamed in are
+# kept for this many seconds after it finishes
+RUN_OUTPUT_BLOB_THRESHOLD = int(os.getenv("RUN_OUTPUT_BLOB_THRESHOLD", "1048576"))
+RUN_OUTPUT_BLOB_DIR = os.getenv("RUN_OUTPUT_BLOB_DIR", "/var/lib/village/outputs")
+RUN_OUTPUT_RETENTION = float(os.getenv("RUN_OUTPUT_RETENTION", "600"))
+
+# bigstring params of at least this many bytes, and uploaded files of at most
+# RUN_INPUT_MAX_BYTES, are sent to the container as raw bytes on stdin
+RUN_INPUT_INLINE_BYTES = int(os.getenv("RUN_INPUT_INLINE_BYTES", "65536"))
+RUN_INPUT_MAX_BYTES = int(os.getenv("RUN_INPUT_MAX_BYTES", "268435456"))
+
+# image builds run at once, and where uploaded contexts wait for their build
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS", "2"))
+BUILD_CONTEXT_DIR = os.getenv("BUILD_CONTEXT_DIR", "/var/lib/village/contexts")
+
+# largest build context accepted, in bytes
+BUILD_CONTEXT_MAX_BYTES = int(os.getenv("BUILD_CONTEXT_MAX_BYTES", "536870912"))
+
+# where files of uploaded contexts are cached, and for how long after last use
+BUILD_FILE_CACHE_DIR = os.getenv("BUILD_FILE_CACHE_DIR", "/var/lib/village/files")
+BUILD_FILE_CACHE_TTL = int(os.getenv("BUILD_FILE_CACHE_TTL", "604800"))
+
+# build log lines stored per segment at most, how long a line is buffered
+# before its segment is stored, and lines kept on the build itself
+BUILD_LOG_FLUSH_LINES = int(os.getenv("BUILD_LOG_FLUSH_LINES", "200"))
+BUILD_LOG_FLUSH_INTERVAL = float(os.getenv("BUILD_LOG_FLUSH_INTERVAL", "1"))
+BUILD_LOG_TAIL_LINES = int(os.getenv("BUILD_LOG_TAIL_LINES", "50"))
+
+# bytes of build images kept on each docker daemon, and how often base images
+# are pulled and build images evicted
+IMAGE_CACHE_BUDGET = int(os.getenv("IMAGE_CACHE_BUDGET", "21474836480"))
+IMAGE_MAINTAIN_INTERVAL = float(os.getenv("IMAGE_MAINTAIN_INTERVAL", "300"))
+
+# region, cluster and network of runs on Fargate, the role their images are
+# pulled with, and where their logs go
+AWS_REGION = os.getenv("AWS_REGION", "us-west-1")
+FARGATE_CLUSTER = os.getenv("FARGATE_CLUSTER", "village-cluster")
+FARGATE_SUBNETS = [x for x in os.getenv("FARGATE_SUBNETS", "").split(",") if x]
+FARGATE_SECURITY_GROUPS = [
+    x for x in os.getenv("FARGATE_SECURITY_GROUPS", "").split(",") if x
+]
+FARGATE_EXECUTION_ROLE = os.getenv("FARGATE_EXECUTION_ROLE")
+FARGATE_LOG_GROUP = os.getenv("FARGATE_LOG_GROUP", "/village/runs")
+
+# seconds between checks on a run on Fargate, starting at the minimum and
+# doubling up to the maximum while it keeps running
+FARGATE_POLL_MIN_INTERVAL = float(os.getenv("FARGATE_POLL_MIN_INTERVAL", "1"))
+FARGATE_POLL_MAX_INTERVAL = float(os.getenv("FARGATE_POLL_MAX_INTERVAL", "30"))
@@ -12,7 +12,19 @@ from fastapi.responses import JSONResponse
 from prisma import Prisma
 
 from config import ALLOWED_ORIGINS
-from routers import builds, invites, runs, schedules, scripts, users, workspaces
+from routers import (
+    batches,
+    builds,
+    invites,
+    runs,
+    schedules,
+    scripts,
+    users,
+    workspaces,
+)
+from server.builds import shutdown_builder, start_builder
+from server.docker import shutdown_executor, start_executor
+from worker import shutdown_worker, start_worker
 
 tags_meta = [
     {
@@ -27,6 +39,10 @@ tags_meta = [
         "name": "runs",
         "description": "Runs",
     },
+    {
+        "name": "batches",
+        "description": "Batches of runs",
+    },
     {
         "name": "schedules",
         "description": "Schedules",
@@ -53,10 +69,16 @@ prisma = Prisma(auto_register=True)
 @app.on_event("startup")  # type: ignore
 async def startup() -> None:
     await prisma.connect()
+    await start_executor()
+    await start_builder()
+    start_worker()
 
 
 @app.on_event("shutdown")  # type: ignore
 async def shutdown() -> None:
+    shutdown_worker()
+    shutdown_builder()
+    await shutdown_executor()
     if prisma.is_connected():
         await prisma.disconnect()
 
@@ -87,6 +109,7 @@ def add_router(router: APIRouter):
 add_router(scripts.router)
 add_router(builds.router)
 add_router(runs.router)
+add_router(batches.router)
 add_router(schedules.router)
 add_router(users.router)
 add_router(workspaces.router)
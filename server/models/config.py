@@ -1,9 +1,12 @@
+import re
 from typing import Dict, List, Optional, Union
 
 from prisma.enums import ParamType
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from pydantic_yaml import YamlModel
 
+MEMORY_UNITS = {"k": 1 / 1024, "m": 1, "g": 1024}
+
 
 class DetailedOptions(BaseModel):
     label: str
@@ -30,3 +33,33 @@ class Config(YamlModel):
 
     build_command: Optional[str]
     image: Optional[str]
+
+    # cores, megabytes (or a string such as "512m" or "2g") and seconds
+    cpu: Optional[float]
+    memory: Optional[int]
+    timeout: Optional[int]
+
+    # runs with the same params share one output for cache_ttl seconds
+    cacheable: bool = False
+    cache_ttl: Optional[int]
+
+    @validator("memory", pre=True)
+    def parse_memory(cls, value: Union[int, str, None]) -> Optional[int]:
+        if value is None or (isinstance(value, int) and not isinstance(value, bool)):
+            return value
+
+        if not isinstance(value, str):
+            raise ValueError(f"Invalid memory size: {value}")
+
+        match = re.fullmatch(r"(\d+)\s*([kmg])?b?", value.strip().lower())
+        if match is None:
+            raise ValueError(f"Invalid memory size: {value}")
+
+        return int(int(match.group(1)) * MEMORY_UNITS[match.group(2) or "m"])
+
+    @validator("cpu", "memory", "timeout")
+    def check_positive(cls, value: Optional[float]) -> Optional[float]:
+        if value is not None and value <= 0:
+            raise ValueError("must be greater than zero")
+
+        return value
@@ -0,0 +1,114 @@
+from datetime import datetime
+from typing import Dict, List
+
+import prisma.models as PrismaModels
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel
+
+from routers.scripts import check_script_access
+from routers.users import get_user
+from server.output import ACTIVE_RUN_STATUSES
+
+router = APIRouter(prefix="/batch", tags=["batches"])
+
+# most runs returned in a single page of batch results
+BATCH_PAGE_MAX_SIZE = 1000
+
+
+class BatchProgress(BaseModel):
+    """
+    Progress of a batch of runs
+    """
+
+    id: str
+    created_at: datetime
+    script_id: str
+    build_id: str
+    size: int
+    parallelism: int
+    statuses: Dict[str, int]
+    completed: int
+    finished: bool
+
+
+async def get_batch_with_access(user_id: str, batch_id: str) -> PrismaModels.Batch:
+
+    batch = await PrismaModels.Batch.prisma().find_unique(where={"id": batch_id})
+
+    if batch is None:
+        raise HTTPException(
+            status_code=403, detail="You do not have access to this batch"
+        )
+
+    try:
+        await check_script_access(user_id, batch.script_id)
+    except HTTPException:
+        # Intercept the exception and throw a new one
+        raise HTTPException(
+            status_code=403, detail="You do not have access to this batch"
+        )
+
+    return batch
+
+
+@router.get("/get", operation_id="get_batch", response_model=BatchProgress)
+async def get_batch(batch_id: str, user: PrismaModels.User = Depends(get_user)):
+    """
+    Get the progress of a batch, as the number of its runs in each status.
+    """
+
+    batch = await get_batch_with_access(user.id, batch_id)
+
+    groups = await PrismaModels.Run.prisma().group_by(
+        ["status"], where={"batch_id": batch.id}, count=True
+    )
+    statuses: Dict[str, int] = {
+        group["status"]: group["_count"]["_all"] for group in groups  # type: ignore
+    }
+    active = sum(
+        count for status, count in statuses.items() if status in ACTIVE_RUN_STATUSES
+    )
+
+    return BatchProgress(
+        id=batch.id,
+        created_at=batch.created_at,
+        script_id=batch.script_id,
+        build_id=batch.build_id,
+        size=batch.size,
+        parallelism=batch.parallelism,
+        statuses=statuses,
+        completed=batch.size - active,
+        finished=active == 0,
+    )
+
+
+@router.get(
+    "/runs", operation_id="get_batch_runs", response_model=List[PrismaModels.Run]
+)
+async def get_batch_runs(
+    batch_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=BATCH_PAGE_MAX_SIZE),
+    user: PrismaModels.User = Depends(get_user),
+):
+    """
+    Get a page of the runs of a batch, in the order their params were given.
+    """
+
+    batch = await get_batch_with_access(user.id, batch_id)
+
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={"batch_id": batch.id},
+        order={"batch_index": "asc"},
+        include={"params": True, "outputs": {"order_by": {"seq": "asc"}}},
+        skip=offset,
+        take=limit,
+    )
+
+    # output is stored in chunks as the run progresses
+    for run in runs:
+        if not run.output and run.output_blob is None:
+            run.output = "".join(chunk.data for chunk in run.outputs or [])
+        run.outputs = None
+
+    return runs
@@ -1,12 +1,22 @@
+import json
+from typing import AsyncIterator, Optional
+
 import prisma.models as PrismaModels
 import prisma.partials as PrismaPartials
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
 
 from routers.scripts import check_script_access
 from routers.users import get_user
+from server.build_logs import BuildLogPage, decode_segment, read_log, tail_log
+from server.docker import image_manager
+from server.images import ImageStats
 
 router = APIRouter(prefix="/build", tags=["builds"])
 
+# most lines of a build log returned by /build/logs
+BUILD_LOG_PAGE_LINES = 1000
+
 
 async def check_build_access(user_id: str, build_id: str):
 
@@ -51,6 +61,74 @@ async def get_build(build_id: str, user: PrismaModels.User = Depends(get_user)):
     return build
 
 
+@router.get("/logs", operation_id="get_build_logs", response_model=BuildLogPage)
+async def get_build_logs(
+    build_id: str,
+    start: Optional[int] = Query(None, ge=0),
+    limit: int = Query(BUILD_LOG_PAGE_LINES, ge=1, le=BUILD_LOG_PAGE_LINES),
+    tail: Optional[int] = Query(None, ge=1, le=BUILD_LOG_PAGE_LINES),
+    user: PrismaModels.User = Depends(get_user),
+):
+    """
+    Get a page of a build's log: `limit` lines from line `start`, or the last
+    `tail` lines.
+    """
+
+    await check_build_access(user.id, build_id)
+
+    if tail is not None:
+        _, total = await read_log(build_id, 0, 0)
+        start = max(total - tail, 0)
+    elif start is None:
+        start = 0
+
+    lines, total = await read_log(build_id, start, start + (tail or limit))
+
+    return BuildLogPage(lines=lines, start=start, total=total)
+
+
+async def log_events(build_id: str, after: int) -> AsyncIterator[str]:
+
+    async for segment in tail_log(build_id, after):
+        event = {"start": segment.first_line, "lines": decode_segment(segment)}
+        yield f"id: {segment.seq}\ndata: {json.dumps(event)}\n\n"
+
+    build = await PrismaModels.Build.prisma().find_unique(where={"id": build_id})
+    status = None if build is None else build.status
+
+    yield f"event: end\ndata: {json.dumps({'status': status})}\n\n"
+
+
+@router.get("/stream", operation_id="stream_build")
+async def stream_build(
+    build_id: str,
+    last_event_id: Optional[int] = Header(None),
+    user: PrismaModels.User = Depends(get_user),
+):
+    """
+    Tail the log of a build as server-sent events. Each event holds a segment
+    of log lines, and a final `end` event holds the status of the finished
+    build.
+    """
+
+    await check_build_access(user.id, build_id)
+
+    return StreamingResponse(
+        log_events(build_id, -1 if last_event_id is None else last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.get("/images", operation_id="get_image_stats", response_model=ImageStats)
+async def get_image_stats(user: PrismaModels.User = Depends(get_user)):
+    """
+    Get metrics of the build images kept on the executors.
+    """
+
+    return image_manager.stats()
+
+
 @router.get("/list", operation_id="list_builds")
 async def list_builds(user: PrismaModels.User = Depends(get_user)):
     """
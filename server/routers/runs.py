@@ -1,14 +1,28 @@
-from typing import List
+import json
+from typing import AsyncIterator, List, Optional
 
 import prisma.models as PrismaModels
 import prisma.partials as PrismaPartials
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
 
 from routers.scripts import check_script_access
 from routers.users import get_user
+from server.cache import CacheStats
+from server.docker import RunNotCancellableError, cancel_run, result_cache
+from server.fargate import fargate_watcher
+from server.output import (
+    ACTIVE_RUN_STATUSES,
+    read_output,
+    read_output_range,
+    tail_output,
+)
 
 router = APIRouter(prefix="/run", tags=["runs"])
 
+# bytes of a large output returned by /run/get
+RUN_OUTPUT_PREVIEW_BYTES = 65536
+
 
 @router.get(
     "/list",
@@ -87,9 +101,140 @@ async def get_run(run_id: str, user: PrismaModels.User = Depends(get_user)):
     if run is None:
         raise HTTPException(status_code=404, detail="Run not found")
 
+    # large outputs are only previewed, read the rest from /run/output
+    if run.output_blob is not None:
+        preview = await read_output_range(run, 0, RUN_OUTPUT_PREVIEW_BYTES)
+        run.output = preview.decode("utf-8", errors="ignore")
+
+    # output is stored in chunks as the run progresses
+    elif not run.output:
+        run.output = await read_output(run.id)
+
     return run
 
 
+@router.get("/output", operation_id="get_run_output")
+async def get_run_output(
+    run_id: str,
+    start: Optional[int] = Query(None, ge=0),
+    end: Optional[int] = Query(None, ge=0),
+    head: Optional[int] = Query(None, ge=0),
+    tail: Optional[int] = Query(None, ge=0),
+    user: PrismaModels.User = Depends(get_user),
+):
+    """
+    Get the output of a run as bytes, either bytes `start` to `end`, the first
+    `head` bytes or the last `tail` bytes. The total size of the output is in
+    the X-Output-Size header.
+    """
+
+    await check_run_access(user.id, run_id)
+
+    run = await PrismaModels.Run.prisma().find_unique(where={"id": run_id})
+
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+
+    if run.output_size is not None:
+        size = run.output_size
+    else:
+        size = len((await read_output(run.id)).encode("utf-8"))
+
+    if tail is not None:
+        start, end = max(size - tail, 0), size
+    elif head is not None:
+        start, end = 0, min(head, size)
+    else:
+        start = 0 if start is None else start
+        end = size if end is None else min(end, size)
+
+    data = await read_output_range(run, start, end)
+
+    headers = {"X-Output-Size": str(size)}
+    if data:
+        headers["Content-Range"] = f"bytes {start}-{start + len(data) - 1}/{size}"
+
+    return Response(
+        content=data, media_type="text/plain; charset=utf-8", headers=headers
+    )
+
+
+async def output_events(run_id: str, after: int) -> AsyncIterator[str]:
+
+    streamed = False
+    async for chunk in tail_output(run_id, after):
+        streamed = True
+        yield f"id: {chunk.seq}\ndata: {json.dumps(chunk.data)}\n\n"
+
+    run = await PrismaModels.Run.prisma().find_unique(where={"id": run_id})
+    status = None if run is None else run.status
+
+    # the chunks of runs that finished a while ago have expired; large outputs
+    # are left for /run/output
+    if run is not None and not streamed and after < 0 and run.output:
+        yield f"id: 0\ndata: {json.dumps(run.output)}\n\n"
+
+    yield f"event: end\ndata: {json.dumps({'status': status})}\n\n"
+
+
+@router.get("/stream", operation_id="stream_run")
+async def stream_run(
+    run_id: str,
+    last_event_id: Optional[int] = Header(None),
+    user: PrismaModels.User = Depends(get_user),
+):
+    """
+    Tail the output of a run as server-sent events. Each event holds a chunk of
+    output, and a final `end` event holds the status of the finished run.
+    """
+
+    await check_run_access(user.id, run_id)
+
+    return StreamingResponse(
+        output_events(run_id, -1 if last_event_id is None else last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.post("/cancel", operation_id="cancel_run", response_model=PrismaModels.Run)
+async def cancel(run_id: str, user: PrismaModels.User = Depends(get_user)):
+    """
+    Cancel a queued or running run. A running run has its container killed, or
+    its task stopped on Fargate, and is marked cancelled shortly after. A run
+    started by another server is stopped by that server.
+    """
+
+    await check_run_access(user.id, run_id)
+
+    run = await PrismaModels.Run.prisma().find_unique(where={"id": run_id})
+
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+
+    if run.status not in ACTIVE_RUN_STATUSES:
+        raise HTTPException(status_code=400, detail="Run has already finished")
+
+    if run.task_arn is not None:
+        await fargate_watcher.cancel(run_id, run.task_arn)
+    else:
+        try:
+            await cancel_run(run_id)
+        except RunNotCancellableError as err:
+            raise HTTPException(status_code=409, detail=str(err))
+
+    return await PrismaModels.Run.prisma().find_unique(where={"id": run_id})
+
+
+@router.get("/cache", operation_id="get_run_cache", response_model=CacheStats)
+async def get_run_cache(user: PrismaModels.User = Depends(get_user)):
+    """
+    Get the hit and miss counts of the cache of run results.
+    """
+
+    return result_cache.stats()
+
+
 @router.delete("/delete", operation_id="delete_run", response_model=PrismaModels.Run)
 async def delete_run(run_id: str, user: PrismaModels.User = Depends(get_user)):
     """
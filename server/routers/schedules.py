@@ -1,6 +1,6 @@
 import json
 import secrets
-from typing import Dict, List, Optional, Union, cast
+from typing import List, Optional
 
 import prisma.models as PrismaModels
 import prisma.partials as PrismaPartials
@@ -12,9 +12,9 @@ from temporalio.client import Client
 
 from config import TEMPORAL_SERVER
 from models.params import ParamInputType
-from routers.scripts import RunScriptInput, check_script_access, run_script_wrapper
+from routers.scripts import check_script_access
 from routers.users import get_user
-from worker import RunScheduledInput, RunScript
+from worker import RunScheduledInput, RunScript, dispatch_schedule
 
 router = APIRouter(prefix="/schedule", tags=["schedules"])
 
@@ -209,7 +209,6 @@ async def run_schedule(schedule_request: RunScheduleInput):
 
     schedule = await PrismaModels.Schedule.prisma().find_unique(
         where={"id": schedule_request.schedule_id},
-        include={"params": True},
     )
 
     if schedule is None:
@@ -218,16 +217,10 @@ async def run_schedule(schedule_request: RunScheduleInput):
     if not verify_token(schedule.token_hash, schedule_request.token):
         raise HTTPException(status_code=403, detail="Invalid token")
 
-    if schedule.params is None:
-        schedule.params = []
-
-    params_dict = {param.key: param.value for param in schedule.params}
+    run = await dispatch_schedule(schedule.id)
 
-    params = cast(Optional[Dict[str, Union[str, int, float, bool]]], params_dict)
-
-    run_inputs = RunScriptInput(script_id=schedule.script_id, params=params)
-
-    run = await run_script_wrapper(run_inputs, schedule_id=schedule.id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Script not found")
 
     return run
 
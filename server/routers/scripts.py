@@ -1,23 +1,16 @@
+import asyncio
 import json
-import logging
 import os
 import re
 import tarfile
 import time
-import uuid
+import zlib
 from datetime import datetime
-from pathlib import Path
-from shutil import rmtree
-from tempfile import NamedTemporaryFile, TemporaryDirectory, mkdtemp
-from typing import Dict, List, Optional, Union
-
-import aiofiles
-import boto3
-import docker
+from tempfile import NamedTemporaryFile
+from typing import Any, Dict, List, Optional, Tuple, Union
+
 import prisma.partials as PrismaPartials
-import pulumi
-import pulumi_aws as aws
-import pulumi_awsx as awsx
+from botocore.exceptions import ClientError
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
 from fastapi.security import HTTPBearer
 from prisma import models as PrismaModels
@@ -25,13 +18,37 @@ from prisma import types as PrismaTypes
 from prisma.enums import BuildStatus, Engine, ParamType, RunStatus
 from prisma.errors import UniqueViolationError
 from prisma.partials import UserWithWorkspaces
-from pulumi import automation as auto
-from pydantic import BaseModel
-
+from pydantic import BaseModel, ValidationError, parse_raw_as
+
+from config import (
+    BATCH_MAX_SIZE,
+    BATCH_PARALLELISM,
+    BUILD_CONTEXT_DIR,
+    BUILD_CONTEXT_MAX_BYTES,
+    RUN_INPUT_MAX_BYTES,
+)
 from models.config import Config
 from models.params import ParamInputType  # type: ignore
 from routers.users import get_user, verify_token, verify_token_with_create_user
-from server.docker import docker_client, execute  # type: ignore
+from server.admission import PRIORITY_INTERACTIVE
+from server.builds import build_queue, context_hash, context_path
+from server.contexts import (
+    BuildContext,
+    ContextFileError,
+    ContextTooLargeError,
+    ManifestFile,
+    assemble_context,
+    check_manifest,
+    ingest_context,
+    missing_files,
+    store_files,
+)
+from server.docker import execute, execute_batch, run_timeout  # type: ignore
+from server.fargate import FargateError, fargate_runner, fargate_watcher
+from server.images import LATEST_BUILD_ORDER
+from server.inputs import store_input_file
+from server.instance import INSTANCE_ID
+from server.resources import build_resources
 from utils.auth import ParsedToken
 from utils.ids import propose_script_id_internal  # type: ignore
 
@@ -192,53 +209,41 @@ async def update_script(
     return updated_script
 
 
-def construct_dockerfile(
-    script: PrismaModels.Script,
-    build_command: Optional[str],
-    image: Optional[str],
-    user: PrismaModels.User = Depends(get_user),
-) -> str:
+def parse_config(data: bytes) -> Config:
     """
-    Construct a Dockerfile from a script.
+    Parse the village.yaml of a build context, answering 400 if it is invalid.
     """
 
-    if script.engine == Engine.Python:
-
-        image = f"python:{script.engine_version}-alpine" if image is None else image
-
-        return f"""
-        FROM {image}
-        
-        WORKDIR /app
-        
-        COPY context.tar.gz /app
-        COPY shim.py /app
+    try:
+        return Config.parse_raw(data)
+    except ValidationError as err:
+        raise HTTPException(status_code=400, detail=str(err))
 
-        RUN tar -xzf context.tar.gz
-        {f'RUN {build_command}' if build_command is not None else ""}
-        RUN if test -f "./requirements.txt"; then python3 -m pip install -r requirements.txt; fi
-        CMD ["python3", "shim.py"]
-        """
 
-    elif script.engine == Engine.Node:
+async def save_context(context: UploadFile, path: str) -> Tuple[BuildContext, Config]:
+    """
+    Copy an uploaded build context to `path`, parsing it as it is copied, and
+    return what was found in it and its parsed village.yaml. The upload itself
+    has already been spooled whole by the time this runs.
+    """
 
-        image = f"node:{script.engine_version}-alpine" if image is None else image
+    loop = asyncio.get_running_loop()
 
-        return f"""
-        FROM {image}
-        
-        WORKDIR /app
-        
-        COPY context.tar.gz /app
-        COPY shim.js /app
+    try:
+        ingested = await loop.run_in_executor(
+            None, ingest_context, context.file, path, BUILD_CONTEXT_MAX_BYTES
+        )
+    except ContextTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
+    except (tarfile.TarError, EOFError, zlib.error):
+        raise HTTPException(status_code=400, detail="Invalid build context")
 
-        RUN tar -xzf context.tar.gz
-        {f'RUN {build_command}' if build_command is not None else ""}
-        RUN yarn install
-        CMD ["node", "shim.js"]
-        """
+    if ingested.config is None:
+        raise HTTPException(
+            status_code=400, detail="village.yaml not found in build context"
+        )
 
-    raise ValueError(f"Unsupported engine: {script.engine}")
+    return ingested, parse_config(ingested.config)
 
 
 @router.post(
@@ -252,7 +257,8 @@ async def build_script(
     user: UserWithWorkspaces = Depends(verify_token_with_create_user),
 ):
     """
-    Build a script so that it can be run.
+    Queue a build of a script so that it can be run. The build is returned as
+    soon as it is queued; poll /build/get for its status.
     """
 
     await check_script_access(user.id, script_id)
@@ -263,35 +269,145 @@ async def build_script(
     if script is None:
         raise HTTPException(status_code=404, detail="Script not found")
 
-    # async with aiofiles.open(
-    #     "/Users/kevinhu/Desktop/received.tar.gz", "wb"
-    # ) as out_file:
-    #     while content := await context.read(1024):  # async read chunk
-    #         await out_file.write(content)  # async write chunk
+    # the context waits on disk until a build worker picks it up
+    with NamedTemporaryFile(dir=BUILD_CONTEXT_DIR, delete=False) as f:
+        package_path = f.name
 
-    # return
+    try:
+        ingested, config = await save_context(context, package_path)
+
+        return await queue_build(script, user.id, package_path, ingested, config)
+    finally:
+        if os.path.exists(package_path):
+            os.remove(package_path)
+
+
+class BuildManifestInput(BaseModel):
+    """
+    Build context manifest input
+    """
+
+    script_id: str
+    files: List[ManifestFile]
 
-    temp_dir = TemporaryDirectory()
-    package_path = temp_dir.name + "/context.tar.gz"
-    # see https://stackoverflow.com/questions/63580229/how-to-save-uploadfile-in-fastapi
-    async with aiofiles.open(package_path, "wb") as out_file:
-        while content := await context.read(1024):  # async read chunk
-            await out_file.write(content)  # async write chunk
 
-    with tarfile.open(package_path, "r:gz") as tar:
-        config_file = tar.extractfile("village.yaml")
+class BuildManifestOutput(BaseModel):
+    """
+    Hashes of the files of a build context that need to be uploaded
+    """
+
+    missing: List[str]
+
+
+@router.post(
+    "/build-manifest",
+    response_model=BuildManifestOutput,
+    operation_id="negotiate_build_manifest",
+)
+async def negotiate_build_manifest(
+    manifest: BuildManifestInput,
+    user: UserWithWorkspaces = Depends(verify_token_with_create_user),
+):
+    """
+    Find which files of a build context have to be uploaded to /build-delta.
+    The rest are already on the server.
+    """
+
+    await check_script_access(user.id, manifest.script_id)
+
+    try:
+        check_manifest(manifest.files, BUILD_CONTEXT_MAX_BYTES)
+    except ContextFileError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    except ContextTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
+
+    loop = asyncio.get_running_loop()
+    missing = await loop.run_in_executor(None, missing_files, manifest.files)
+
+    return BuildManifestOutput(missing=missing)
+
+
+@router.post(
+    "/build-delta",
+    response_model=PrismaModels.Build,
+    operation_id="build_script_delta",
+)
+async def build_script_delta(
+    script_id: str = Form(...),
+    manifest: str = Form(...),
+    files: List[UploadFile] = File([]),
+    user: UserWithWorkspaces = Depends(verify_token_with_create_user),
+):
+    """
+    Queue a build of a script from a manifest of its context, a JSON list of
+    files. Only the files /build-manifest reported missing are uploaded, each
+    with its hash as its filename.
+    """
+
+    await check_script_access(user.id, script_id)
+
+    script = await PrismaModels.Script.prisma().find_unique(where={"id": script_id})
+
+    if script is None:
+        raise HTTPException(status_code=404, detail="Script not found")
+
+    try:
+        entries = parse_raw_as(List[ManifestFile], manifest)
+    except ValidationError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+
+    loop = asyncio.get_running_loop()
 
-        if config_file is None:
+    with NamedTemporaryFile(dir=BUILD_CONTEXT_DIR, delete=False) as f:
+        package_path = f.name
+
+    try:
+        check_manifest(entries, BUILD_CONTEXT_MAX_BYTES)
+
+        await loop.run_in_executor(
+            None,
+            store_files,
+            [(x.file, x.filename) for x in files],
+            BUILD_CONTEXT_MAX_BYTES,
+        )
+
+        ingested = await loop.run_in_executor(
+            None, assemble_context, entries, package_path, BUILD_CONTEXT_MAX_BYTES
+        )
+
+        if ingested.config is None:
             raise HTTPException(
                 status_code=400, detail="village.yaml not found in build context"
             )
 
-        config = Config.parse_raw(config_file.read())
+        config = parse_config(ingested.config)
+
+        return await queue_build(script, user.id, package_path, ingested, config)
+    except ContextFileError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    except ContextTooLargeError as err:
+        raise HTTPException(status_code=413, detail=str(err))
+    finally:
+        if os.path.exists(package_path):
+            os.remove(package_path)
 
-    build = await PrismaModels.Build.prisma().create(
+
+async def create_build(
+    script: PrismaModels.Script,
+    user_id: str,
+    ingested: BuildContext,
+    config: Config,
+    image_uri: Optional[str] = None,
+) -> PrismaModels.Build:
+    """
+    Create a build of an uploaded context.
+    """
+
+    return await PrismaModels.Build.prisma().create(
         {
-            "script_id": script_id,
-            "status": BuildStatus.BUILDING,
+            "script_id": script.id,
+            "status": BuildStatus.CREATED,
             "output": "",
             "params": {
                 "create": [
@@ -317,50 +433,37 @@ async def build_script(
                 ]
             },
             "build_command": config.build_command,
-            "creator_id": user.id,
+            "image": config.image,
+            "cpu": config.cpu,
+            "memory": config.memory,
+            "timeout": config.timeout,
+            "cacheable": config.cacheable,
+            "cache_ttl": config.cache_ttl,
+            "context_hash": context_hash(
+                ingested.files, script, config.build_command, config.image
+            ),
+            "image_uri": image_uri,
+            "creator_id": user_id,
         }
     )
 
-    dockerfile_contents = construct_dockerfile(
-        script, config.build_command, config.image
-    )
 
-    with open(temp_dir.name + "/Dockerfile", "w", encoding="utf-8") as file:
-        file.write(dockerfile_contents)
-
-    if script.engine == Engine.Python:
-        with open(temp_dir.name + "/shim.py", "w", encoding="utf-8") as file:
-            with open(
-                Path(__file__).parent.parent / "sdk/shim.py", "r", encoding="utf-8"
-            ) as f:
-                file.write(f.read())
-
-    elif script.engine == Engine.Node:
-        with open(temp_dir.name + "/shim.js", "w", encoding="utf-8") as file:
-            with open(
-                Path(__file__).parent.parent / "sdk/shim.js", "r", encoding="utf-8"
-            ) as f:
-                file.write(f.read())
-
-    try:
-        _, logs = docker_client.images.build(path=temp_dir.name, tag=build.id)  # type: ignore
-    except docker.errors.BuildError as err:  # type: ignore
-        logging.error(err)  # type: ignore
-
-        raise HTTPException(status_code=500, detail="Build failed") from err
-
-    temp_dir.cleanup()
+async def queue_build(
+    script: PrismaModels.Script,
+    user_id: str,
+    package_path: str,
+    ingested: BuildContext,
+    config: Config,
+    image_uri: Optional[str] = None,
+) -> PrismaModels.Build:
+    """
+    Create a build from a saved context and queue it.
+    """
 
-    log_stream: List[str] = [x["stream"] for x in logs if x.get("stream")]  # type: ignore
+    build = await create_build(script, user_id, ingested, config, image_uri)
 
-    build = await PrismaModels.Build.prisma().update(
-        where={"id": build.id},
-        data={
-            "status": BuildStatus.SUCCESS,
-            "output": json.dumps(log_stream),
-            "completed_at": datetime.now(),
-        },
-    )
+    os.replace(package_path, context_path(build.id))
+    await build_queue.submit(script.id, build.id)
 
     return build
 
@@ -435,6 +538,8 @@ class RunScriptInput(BaseModel):
 
     script_id: str
     params: ParamInputType
+    # seconds, at most the build's own timeout
+    timeout: Optional[int]
 
 
 @router.post(
@@ -448,143 +553,60 @@ async def build_container(
     user: PrismaModels.User = Depends(get_user),
 ):
     """
-    Build a script, put tarball in S3, create cluster, and build/put image in ECR.
+    Queue a build of a script whose image is pushed to ECR, to be run on
+    Fargate. The build is returned as soon as it is queued; poll /build/get for
+    its status and image_uri.
     """
 
+    await check_script_access(user.id, script_id)
+
     # get script details
     script = await PrismaModels.Script.prisma().find_unique(where={"id": script_id})
 
     if script is None:
         raise HTTPException(status_code=404, detail="Script not found")
 
-    temp_dir = TemporaryDirectory()
-    package_path = temp_dir.name + "/context.tar.gz"
-    # see https://stackoverflow.com/questions/63580229/how-to-save-uploadfile-in-fastapi
-    async with aiofiles.open(package_path, "wb") as out_file:
-        while content := await context.read(1024):  # async read chunk
-            await out_file.write(content)  # async write chunk
-
-    with tarfile.open(package_path, "r:gz") as tar:
-        config_file = tar.extractfile("village.yaml")
+    with NamedTemporaryFile(dir=BUILD_CONTEXT_DIR, delete=False) as f:
+        package_path = f.name
 
-        if config_file is None:
-            raise HTTPException(
-                status_code=400, detail="village.yaml not found in build context"
-            )
+    try:
+        ingested, config = await save_context(context, package_path)
 
-        config = Config.parse_raw(config_file.read())
+        digest = context_hash(
+            ingested.files, script, config.build_command, config.image
+        )
 
-    build = await PrismaModels.Build.prisma().create(
-        {
-            "script_id": script_id,
-            "status": BuildStatus.BUILDING,
-            "output": "",
-            "image_uri": "",
-            "params": {
-                "create": [
-                    {
-                        "key": key,
-                        "type": p.type,
-                        "default": p.default,
-                        "description": p.description,
-                        "required": p.required,
-                        "options": [
-                            json.dumps({"label": x, "value": x})
-                            if isinstance(x, str)
-                            else json.dumps(
-                                {
-                                    "label": x.label,
-                                    "value": x.value,
-                                }
-                            )
-                            for x in p.options
-                        ],
-                    }
-                    for key, p in config.params.items()
-                ]
+        # an image pushed from the same context and inputs is used as is
+        existing = await PrismaModels.Build.prisma().find_first(
+            where={
+                "context_hash": digest,
+                "status": BuildStatus.SUCCESS,
+                "image_uri": {"not": None},
             },
-            "build_command": config.build_command,
-            "creator_id": user.id,
-        }
-    )
-
-    dockerfile_contents = construct_dockerfile(
-        script, config.build_command, config.image
-    )
+            order={"completed_at": "desc"},
+        )
 
-    with open(temp_dir.name + "/Dockerfile", "w", encoding="utf-8") as file:
-        file.write(dockerfile_contents)
-
-    if script.engine == Engine.Python:
-        with open(temp_dir.name + "/shim.py", "w", encoding="utf-8") as file:
-            with open(
-                Path(__file__).parent.parent / "sdk/shim.py", "r", encoding="utf-8"
-            ) as f:
-                file.write(f.read())
-    elif script.engine == Engine.Node:
-        with open(temp_dir.name + "/shim.js", "w", encoding="utf-8") as file:
-            with open(
-                Path(__file__).parent.parent / "sdk/shim.js", "r", encoding="utf-8"
-            ) as f:
-                file.write(f.read())
-
-    with NamedTemporaryFile(suffix=".tar.gz") as f:
-        with tarfile.open(f.name, "w:gz") as tar:
-            tar.add(temp_dir.name, arcname="app")
-        with open(f.name, "rb") as tar_file:
-            s3_client = boto3.client("s3")
-            s3_client.upload_fileobj(
-                tar_file, "village-internal", f"containers/{script_id}.tar.gz"
+        if existing is None:
+            # an empty image uri has the build's image published once built
+            return await queue_build(
+                script, user.id, package_path, ingested, config, image_uri=""
             )
 
-    temp_dir.cleanup()
-
-    filename = f"{script_id}.tar.gz"
-
-    def pulumi_build():
-        s3 = boto3.client("s3")
+        build = await create_build(script, user.id, ingested, config)
 
-        temp_dir = mkdtemp()
-        file_path = temp_dir + "/" + filename
-        with open(file_path, "xb") as f:
-            s3.download_fileobj("village-internal", "containers/" + filename, f)
-
-        file = tarfile.open(file_path)
-        file.extractall(temp_dir)
-        file.close()
-
-        os.remove(file_path)
-
-        repo = awsx.ecr.Repository("village-repo")
-
-        image = awsx.ecr.Image(
-            f"image-{script_id}", repository_url=repo.url, path=temp_dir + "/app"
+        return await PrismaModels.Build.prisma().update(
+            where={"id": build.id},
+            data={
+                "status": BuildStatus.SUCCESS,
+                "output": json.dumps([f"Reused the image of build {existing.id}\n"]),
+                "image_uri": existing.image_uri,
+                "image_size": existing.image_size,
+                "completed_at": datetime.now(),
+            },
         )
-
-        pulumi.export("image_uri", image.image_uri)
-        pulumi.export("temp_dir", temp_dir)
-
-    project_name = "village_containers"
-    stack_name = "dev-build"
-    stack = auto.create_or_select_stack(
-        stack_name=stack_name, project_name=project_name, program=pulumi_build
-    )
-    stack.workspace.install_plugin("aws", "v4.0.0")
-    stack.set_config("aws:region", auto.ConfigValue(value="us-west-1"))
-    stack.refresh()
-    up_res = stack.up(on_output=print)
-    rmtree(up_res.outputs["temp_dir"].value)
-
-    build = await PrismaModels.Build.prisma().update(
-        where={"id": build.id},
-        data={
-            "status": BuildStatus.SUCCESS,
-            "image_uri": up_res.outputs["image_uri"].value,
-            "completed_at": datetime.now(),
-        },
-    )
-
-    return build
+    finally:
+        if os.path.exists(package_path):
+            os.remove(package_path)
 
 
 @router.post(
@@ -596,18 +618,12 @@ async def run_script_container(
     script: RunScriptInput, user: PrismaModels.User = Depends(get_user)
 ):
     """
-    Run script on Fargate.
+    Run script on Fargate. The run is returned as soon as its task is started;
+    poll /run/get for its status and output.
     """
     await check_script_access(user.id, script.script_id)
 
-    build = await PrismaModels.Build.prisma().find_first(
-        where={"script_id": script.script_id, "status": BuildStatus.SUCCESS},
-        order={"updated_at": "desc"},
-        include={"params": True, "script": True},
-    )
-
-    if build is None or build.status != BuildStatus.SUCCESS:
-        raise HTTPException(status_code=404, detail="No builds found")
+    build = await latest_build(script.script_id)
 
     params = [] if build.params is None else build.params
     script_params = {} if script.params is None else script.params
@@ -615,41 +631,8 @@ async def run_script_container(
 
     validate_params(script_params, params)
 
-    # currently we get the container output from Cloudwatch logs
-    # this uuid is so that we can identify each specific run properly
-    run_uuid = str(uuid.uuid4())
-
-    def pulumi_run():
-        cluster = aws.ecs.Cluster("village-cluster")
-
-        script_params = {} if script.params is None else script.params
-
-        task_defn = awsx.ecs.FargateTaskDefinition(
-            "village-task",
-            containers={
-                "village": awsx.ecs.TaskDefinitionContainerDefinitionArgs(
-                    image=image_uri,
-                    memory=128,
-                    command=[
-                        "python3",
-                        "shim.py",
-                        f"{json.dumps(script_params)}",
-                        f"{run_uuid}",
-                    ],
-                )
-            },
-            runtime_platform=aws.ecs.TaskDefinitionRuntimePlatformArgs(
-                cpu_architecture="ARM64", operating_system_family="LINUX"
-            ),
-        )
-
-        awsx.ecs.FargateService(
-            "village-service",
-            cluster=cluster.arn,
-            task_definition=task_defn.task_definition.arn,
-        )
-
-        pulumi.export("log_group_name", task_defn.log_group.name)
+    if build.script is None:
+        raise Exception
 
     run = await PrismaModels.Run.prisma().create(
         {
@@ -659,86 +642,99 @@ async def run_script_container(
             "output": "",
             "schedule_id": None,
             "creator_id": None,
+            "instance_id": INSTANCE_ID,
+            "timeout": script.timeout,
         }
     )
 
-    if build.script is None:
-        raise Exception
-
-    output: str = ""
+    loop = asyncio.get_running_loop()
+    resources = build_resources(build)
 
-    project_name = "village_containers"
-    stack_name = "dev-run"
-    stack = auto.create_or_select_stack(
-        stack_name=stack_name, project_name=project_name, program=pulumi_run
-    )
-    stack.workspace.install_plugin("aws", "v4.0.0")
-    stack.set_config("aws:region", auto.ConfigValue(value="us-west-1"))
-    stack.refresh()
-    up_res = stack.up(on_output=print)
-
-    log_group_name = up_res.outputs["log_group_name"].value
-    logs_client = boto3.client("logs")
-
-    log_uuid = ""
-    timeout = 120
-    period = 1
-    mustend = time.time() + timeout
-    while time.time() < mustend:
-        log_stream = logs_client.describe_log_streams(
-            logGroupName=log_group_name,
-            orderBy="LastEventTime",
-            descending=True,
-            limit=1,
+    try:
+        # the shim prints its result with the run id, which is how the
+        # watcher tells it apart in the task's log
+        task_arn = await loop.run_in_executor(
+            None,
+            fargate_runner.run,
+            image_uri,
+            resources.cpu,
+            resources.memory,
+            container_command(build.script.engine, script_params, run.id),
+            run.id,
         )
-        log_events = logs_client.get_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream["logStreams"][0]["logStreamName"],
+    except (FargateError, ClientError) as err:
+        return await PrismaModels.Run.prisma().update(
+            {
+                "output": str(err),
+                "status": RunStatus.FAILURE,
+                "completed_at": datetime.utcnow(),
+            },
+            where={"id": run.id},
         )
-        if len(log_events["events"]) > 0:
-            log_uuid = json.loads(log_events["events"][0]["message"])["uuid"]
-            if log_uuid == run_uuid:
-                run = await PrismaModels.Run.prisma().update(
-                    {
-                        "output": log_events["events"][0]["message"],
-                        "status": RunStatus.SUCCESS,
-                        "completed_at": datetime.now(),
-                    },
-                    where={"id": run.id},
-                )
-                return run
-            time.sleep(period)
 
+    started = datetime.utcnow()
     run = await PrismaModels.Run.prisma().update(
-        {
-            "status": RunStatus.FAILURE,
-        },
+        {"task_arn": task_arn, "started_at": started},
         where={"id": run.id},
     )
+    assert run is not None
+
+    fargate_watcher.watch(run.id, task_arn, run_timeout(run, build), time.time())
+
     return run
 
 
-async def run_script_wrapper(
-    script: RunScriptInput,
-    schedule_id: Optional[str] = None,
-    user_id: Optional[str] = None,
-):
+def container_command(
+    engine: Engine, params: Dict[str, Union[str, int, float, bool]], run_id: str
+) -> List[str]:
+    """
+    Command running a script once in its image, outside of the warm pool.
+    """
+
+    if engine == Engine.Python:
+        return ["python3", "shim.py", json.dumps(params), run_id]
+
+    elif engine == Engine.Node:
+        return ["node", "shim.js", json.dumps(params)]
+
+    raise ValueError(f"Unsupported engine: {engine}")
+
+
+async def latest_build(script_id: str) -> PrismaModels.Build:
     build = await PrismaModels.Build.prisma().find_first(
-        where={"script_id": script.script_id, "status": BuildStatus.SUCCESS},
-        order={"updated_at": "desc"},
+        where={"script_id": script_id, "status": BuildStatus.SUCCESS},
+        order=LATEST_BUILD_ORDER,
         include={"params": True, "script": True},
     )
 
     if build is None or build.status != BuildStatus.SUCCESS:
         raise HTTPException(status_code=404, detail="No builds found")
 
+    return build
+
+
+async def run_script_wrapper(
+    script: RunScriptInput,
+    schedule_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    files: Optional[List[Dict[str, Any]]] = None,
+):
+    build = await latest_build(script.script_id)
+
     params = [] if build.params is None else build.params
     script_params = {} if script.params is None else script.params
 
     validate_params(script_params, params)
 
     run = await execute(
-        build, script_params, schedule_id=schedule_id, executor_id=user_id
+        build,
+        script_params,
+        schedule_id=schedule_id,
+        executor_id=user_id,
+        priority=priority,
+        timeout=script.timeout,
+        files=files,
     )
 
     return run
@@ -749,13 +745,129 @@ async def run_script(
     script: RunScriptInput, user: PrismaModels.User = Depends(get_user)
 ):
     """
-    Execute the latest build for a script.
+    Queue the latest build for a script. The run is returned as soon as it is
+    created; poll /run/get for its status and output.
     """
     await check_script_access(user.id, script.script_id)
 
     return await run_script_wrapper(script, user_id=user.id)
 
 
+async def read_input_file(file: UploadFile) -> Dict[str, Any]:
+    """
+    Store an uploaded input file, streamed from the file it was spooled to.
+    """
+
+    # the upload is spooled whole before the endpoint runs, so its size is known
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+
+    if size > RUN_INPUT_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{file.filename} is larger than {RUN_INPUT_MAX_BYTES} bytes",
+        )
+
+    return await store_input_file(file.filename, file.file)
+
+
+@router.post(
+    "/run-files", operation_id="run_script_with_files", response_model=PrismaModels.Run
+)
+async def run_script_with_files(
+    script_id: str = Form(...),
+    params: Optional[str] = Form(None),
+    timeout: Optional[int] = Form(None),
+    files: List[UploadFile] = File(...),
+    user: PrismaModels.User = Depends(get_user),
+):
+    """
+    Queue the latest build for a script with uploaded input files. `params` is
+    a JSON object of the other params. Each file is passed to the script as the
+    param named after its filename, which it can stream or map from disk.
+    """
+    await check_script_access(user.id, script_id)
+
+    try:
+        script_params = {} if params is None else json.loads(params)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+
+    names = [file.filename for file in files]
+    for name in names:
+        if not name or name in script_params or names.count(name) > 1:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid input file name: {name}"
+            )
+
+    inputs = [await read_input_file(file) for file in files]
+
+    script = RunScriptInput(script_id=script_id, params=script_params, timeout=timeout)
+
+    return await run_script_wrapper(script, user_id=user.id, files=inputs)
+
+
+class RunBatchInput(BaseModel):
+    """
+    Batch run input
+    """
+
+    script_id: str
+    params: List[ParamInputType]
+    parallelism: Optional[int]
+    # seconds per run, at most the build's own timeout
+    timeout: Optional[int]
+
+
+@router.post(
+    "/run-batch", operation_id="run_script_batch", response_model=PrismaModels.Batch
+)
+async def run_script_batch(
+    script: RunBatchInput, user: PrismaModels.User = Depends(get_user)
+):
+    """
+    Queue a run of the latest build for a script for each set of params. The
+    batch is returned as soon as its runs are created; poll /batch/get for its
+    progress and /batch/runs for the results.
+    """
+    await check_script_access(user.id, script.script_id)
+
+    if not script.params:
+        raise HTTPException(status_code=400, detail="No params given")
+
+    if len(script.params) > BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch can hold at most {BATCH_MAX_SIZE} runs",
+        )
+
+    parallelism = (
+        BATCH_PARALLELISM if script.parallelism is None else script.parallelism
+    )
+    if parallelism < 1:
+        raise HTTPException(status_code=400, detail="Parallelism must be positive")
+
+    build = await latest_build(script.script_id)
+
+    spec = [] if build.params is None else build.params
+    script_params = [{} if x is None else x for x in script.params]
+
+    for index, params in enumerate(script_params):
+        try:
+            validate_params(params, spec)
+        except HTTPException as err:
+            raise HTTPException(status_code=400, detail=f"Item {index}: {err.detail}")
+
+    return await execute_batch(
+        build,
+        script_params,
+        parallelism=parallelism,
+        executor_id=user.id,
+        timeout=script.timeout,
+    )
+
+
 @router.get(
     "/list",
     operation_id="list_scripts",
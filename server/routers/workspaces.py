@@ -7,6 +7,8 @@ from prisma.enums import Role
 from pydantic import BaseModel
 
 from routers.users import get_user, verify_token
+from server.admission import WorkspaceQueueStats
+from server.docker import admission
 from utils.auth import ParsedToken
 from utils.ids import propose_workspace_id_internal
 
@@ -104,6 +106,27 @@ async def get_workspace(workspace_id: str, user: PrismaModels.User = Depends(get
     return workspace
 
 
+@router.get(
+    "/queue",
+    operation_id="get_workspace_queue",
+    response_model=WorkspaceQueueStats,
+)
+async def get_workspace_queue(
+    workspace_id: str, user: PrismaModels.User = Depends(get_user)
+):
+    """
+    Get the depth of and wait time in a workspace's run queue.
+    """
+
+    workspace = await PrismaModels.Workspace.prisma().find_first(
+        where={"id": workspace_id, "users": {"some": {"user_id": {"equals": user.id}}}}
+    )
+    if workspace is None:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+
+    return admission.stats(workspace.id, workspace.max_runs)
+
+
 @router.get(
     "/list",
     operation_id="list_user_workspaces",
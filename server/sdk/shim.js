@@ -1,10 +1,118 @@
 import main from "./main";
+import * as fs from "fs";
+import * as os from "os";
+import * as path from "path";
 
 // read first argument
 const args = process.argv.slice(2);
 
-const result = main(args);
+const handle = (request) => {
+  try {
+    console.log(main([JSON.stringify(request.params)]));
+    return 0;
+  } catch (err) {
+    console.error(err);
+    return 1;
+  }
+};
 
-console.log(result);
+if (args.includes("--serve")) {
+  // serve newline delimited JSON requests of the form
+  // {"id": ..., "params": ..., "inputs": [{"key": ..., "size": ..., "text": ...}]}.
+  // the raw bytes of each input follow the request line and are spooled to a
+  // file. uploaded files are passed to main as a {"path": ..., "size": ...}
+  // param to be streamed or read. bigstring params are always passed as a
+  // string, and their files are also found in globalThis.villageInputs. each
+  // response is the output of the run followed by a line holding the request
+  // id and exit code. node cannot fork, so runs share one process.
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), "village-input-"));
 
-process.exit(0);
+  let buffer = Buffer.alloc(0);
+  let request = null;
+  let input = null;
+
+  const finish = () => {
+    const code = handle(request);
+
+    for (const spec of request.inputs || []) {
+      fs.rmSync(globalThis.villageInputs[spec.key].path, { force: true });
+    }
+
+    console.log(`${request.id} ${code}`);
+    request = null;
+  };
+
+  const nextInput = () => {
+    const spec = request.inputs[input.index];
+    const file = path.join(dir, `${request.id}-${input.index}`);
+
+    globalThis.villageInputs[spec.key] = { path: file, size: spec.size };
+    request.params[spec.key] = globalThis.villageInputs[spec.key];
+    input.fd = fs.openSync(file, "w");
+    input.remaining = spec.size;
+  };
+
+  const consume = () => {
+    while (true) {
+      if (request === null) {
+        const end = buffer.indexOf("\n");
+        if (end === -1) return;
+
+        const line = buffer.subarray(0, end).toString("utf-8");
+        buffer = buffer.subarray(end + 1);
+        if (!line.trim()) continue;
+
+        request = JSON.parse(line);
+        request.params = request.params || {};
+        globalThis.villageInputs = {};
+
+        if (!(request.inputs || []).length) {
+          finish();
+          continue;
+        }
+
+        input = { index: 0 };
+        nextInput();
+      }
+
+      // copy input bytes straight from the stream to the spool file
+      const count = Math.min(input.remaining, buffer.length);
+      fs.writeSync(input.fd, buffer, 0, count);
+      buffer = buffer.subarray(count);
+      input.remaining -= count;
+
+      if (input.remaining > 0) return;
+
+      fs.closeSync(input.fd);
+
+      const spec = request.inputs[input.index];
+      if (spec.text) {
+        request.params[spec.key] = fs.readFileSync(
+          globalThis.villageInputs[spec.key].path,
+          "utf-8"
+        );
+      }
+
+      input.index += 1;
+
+      if (input.index < request.inputs.length) {
+        nextInput();
+      } else {
+        finish();
+      }
+    }
+  };
+
+  process.stdin.on("data", (chunk) => {
+    buffer = buffer.length ? Buffer.concat([buffer, chunk]) : chunk;
+    consume();
+  });
+
+  process.stdin.on("end", () => process.exit(0));
+} else {
+  const result = main(args);
+
+  console.log(result);
+
+  process.exit(0);
+}
@@ -1,13 +1,186 @@
 # type: ignore
 import json
+import mmap
+import os
+import socket
 import sys
+import tempfile
+import traceback
+
+# scripts reach the inputs of their run with `import shim`, which must not
+# load a second copy of this module
+sys.modules.setdefault("shim", sys.modules[__name__])
+
+from main import main  # noqa: E402
+
+# inputs are copied from the request stream in chunks of this many bytes
+INPUT_CHUNK_SIZE = 1 << 20
+
+# param name -> Input of each input of the run being served
+inputs = {}
+
+
+class Input(os.PathLike):
+    """
+    A large param or uploaded file, spooled to a file instead of being held in
+    memory. Read it as a stream with open(), map it with mmap(), or load it
+    whole with read() or text().
+
+    Uploaded files are passed to main as an Input. Bigstring params are always
+    passed as a str, however large, and are also found in `shim.inputs` when
+    they were sent as raw bytes.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __fspath__(self):
+        return self.path
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.text()
+
+    def open(self, mode="rb"):
+        return open(self.path, mode)
+
+    def mmap(self):
+        with open(self.path, "rb") as f:
+            if self.size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def text(self, encoding="utf-8"):
+        return self.read().decode(encoding)
+
+
+def read_inputs(stream, request):
+    """
+    Spool the inputs that follow a request on the stream to files, as params of
+    the request.
+    """
+    params = dict(request.get("params") or {})
+    inputs.clear()
+
+    for spec in request.get("inputs", []):
+        fd, path = tempfile.mkstemp(prefix="village-input-")
+        remaining = spec["size"]
+
+        with os.fdopen(fd, "wb") as f:
+            while remaining:
+                chunk = stream.read(min(remaining, INPUT_CHUNK_SIZE))
+                if not chunk:
+                    raise EOFError("Stream ended before the input was read")
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        value = Input(path, spec["size"])
+        inputs[spec["key"]] = value
+        params[spec["key"]] = value.text() if spec.get("text") else value
+
+    request["params"] = params
+    return request
+
+
+def handle(request):
+    """
+    Run main for one request and print its result. Returns an exit code.
+    """
+    try:
+        res = main(request.get("params"))
+        print(json.dumps({"result": res, "uuid": request.get("uuid")}))
+        return 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+def handle_forked(request):
+    """
+    Run a request in a child of this already initialized process, so that
+    runs share warm imports but not state.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid == 0:
+        code = handle(request)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 1
+
+
+def serve(stream, fork):
+    """
+    Serve newline delimited JSON requests of the form
+    {"id": ..., "params": ..., "uuid": ...,
+     "inputs": [{"key": ..., "size": ..., "text": ...}]}
+    read from a binary stream. The raw bytes of each input follow the request
+    line. Each response is the output of the run followed by a line holding the
+    request id and exit code.
+    """
+    for line in iter(stream.readline, b""):
+        if not line.strip():
+            continue
+        request = read_inputs(stream, json.loads(line))
+        try:
+            code = handle_forked(request) if fork else handle(request)
+        finally:
+            for value in inputs.values():
+                os.remove(value.path)
+        print(f"{request['id']} {code}", flush=True)
+
+
+def serve_socket(path, fork):
+    """
+    Serve requests from connections to a unix socket, one connection at a time.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    while True:
+        conn, _ = server.accept()
+        with conn, conn.makefile("rb") as stream:
+            # point stdout at the connection, including for forked children
+            sys.stdout.flush()
+            saved_fd = os.dup(1)
+            os.dup2(conn.fileno(), 1)
+            try:
+                serve(stream, fork)
+            finally:
+                sys.stdout.flush()
+                os.dup2(saved_fd, 1)
+                os.close(saved_fd)
 
-from main import main
 
 if __name__ == "__main__":
     params = None
     uuid = None
-    if len(sys.argv) == 2:
+    if "--serve" in sys.argv:
+        fork = "--fork" in sys.argv
+        if "--socket" in sys.argv:
+            serve_socket(sys.argv[sys.argv.index("--socket") + 1], fork)
+        else:
+            serve(sys.stdin.buffer, fork)
+        sys.exit(0)
+    elif len(sys.argv) == 2:
         params = json.loads(sys.argv[1])
     elif len(sys.argv) > 2:
         params = json.loads(sys.argv[1])
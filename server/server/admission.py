@@ -0,0 +1,241 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from server.fleet import ExecutorHost, Fleet
+from server.resources import Resources
+from utils.logger import logger
+
+# interactive runs are admitted before scheduled ones
+PRIORITY_SCHEDULED = 0
+PRIORITY_INTERACTIVE = 1
+
+# weight of the latest wait in the moving average wait per workspace
+WAIT_SMOOTHING = 0.2
+
+
+@dataclass
+class PendingRun:
+    run_id: str
+    workspace_id: str
+    priority: int
+    enqueued_at: float
+    resources: Resources
+    image: str
+    start: Callable[[ExecutorHost], Awaitable[None]]
+    batch_id: Optional[str] = None
+
+    @property
+    def lane(self) -> str:
+        """
+        Queue the run waits in. Each batch gets its own, so that a large batch
+        takes turns with the other runs of its workspace.
+        """
+
+        return self.workspace_id if self.batch_id is None else self.batch_id
+
+
+class WorkspaceQueueStats(BaseModel):
+    """
+    Admission queue of a workspace
+    """
+
+    workspace_id: str
+    queued: int
+    running: int
+    max_runs: int
+    oldest_wait: float
+    average_wait: float
+
+
+class AdmissionController:
+    """
+    Decides when queued runs may start.
+
+    At most `max_running` runs execute at once, each workspace is held to its
+    own limit, as is each batch, and a run only starts once a host in the fleet
+    has the resources it requests free. Higher priorities are admitted first;
+    within a priority, workspaces and batches take turns so that one busy
+    workspace cannot starve the rest.
+    """
+
+    def __init__(self, max_running: int, workspace_max_running: int, fleet: Fleet):
+        self.max_running = max_running
+        self.workspace_max_running = workspace_max_running
+        self.fleet = fleet
+
+        # priority -> lane -> queued runs, next lane to serve first
+        self._queues: Dict[int, "OrderedDict[str, Deque[PendingRun]]"] = {}
+        # running runs per workspace id and per batch id
+        self._running: Dict[str, int] = {}
+        self._total_running = 0
+        self._limits: Dict[str, int] = {}
+        self._average_wait: Dict[str, float] = {}
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def submit(
+        self,
+        run: PendingRun,
+        max_runs: Optional[int] = None,
+        parallelism: Optional[int] = None,
+    ):
+        """
+        Queue a run, starting it right away if there is capacity. `parallelism`
+        limits the running runs of the run's batch.
+        """
+
+        # until a host is reached, runs wait for one rather than fail
+        total = self.fleet.largest()
+        if total is not None and (
+            run.resources.cpu > total.cpu or run.resources.memory > total.memory
+        ):
+            raise ValueError(
+                f"Run requests {run.resources.cpu} cpu and {run.resources.memory}MB "
+                f"memory, but the executor only has {total.cpu} cpu and "
+                f"{total.memory}MB"
+            )
+
+        self._limits[run.workspace_id] = (
+            self.workspace_max_running if max_runs is None else max_runs
+        )
+        if run.batch_id is not None and parallelism is not None:
+            self._limits[run.batch_id] = parallelism
+
+        queues = self._queues.setdefault(run.priority, OrderedDict())
+        queues.setdefault(run.lane, deque()).append(run)
+
+        self.admit()
+
+    def _next(self) -> Optional[Tuple[PendingRun, ExecutorHost]]:
+        for priority in sorted(self._queues, reverse=True):
+            queues = self._queues[priority]
+
+            for lane in list(queues):
+                head = queues[lane][0]
+                if self._at_limit(head.workspace_id) or self._at_limit(head.batch_id):
+                    continue
+
+                # runs that do not fit anywhere wait for others to finish
+                host = self.fleet.place(head.resources, head.image)
+                if host is None:
+                    continue
+
+                # move the lane to the back of the line
+                queue = queues.pop(lane)
+                run = queue.popleft()
+                if queue:
+                    queues[lane] = queue
+
+                return run, host
+
+        return None
+
+    def cancel(self, run_id: str) -> bool:
+        """
+        Drop a queued run. Returns False if the run is not queued.
+        """
+
+        for queues in self._queues.values():
+            for lane, queue in list(queues.items()):
+                for run in queue:
+                    if run.run_id != run_id:
+                        continue
+
+                    queue.remove(run)
+                    if not queue:
+                        del queues[lane]
+                    if run.batch_id is not None:
+                        self._forget_batch(run.batch_id)
+
+                    return True
+
+        return False
+
+    def _at_limit(self, key: Optional[str]) -> bool:
+        if key is None or key not in self._limits:
+            return False
+
+        return self._running.get(key, 0) >= self._limits[key]
+
+    def admit(self):
+        """
+        Start queued runs while there is capacity for them.
+        """
+
+        while self._total_running < self.max_running:
+            placement = self._next()
+            if placement is None:
+                return
+
+            run, host = placement
+            host.capacity.reserve(run.resources)
+            self._total_running += 1
+            self._running[run.workspace_id] = self._running.get(run.workspace_id, 0) + 1
+            if run.batch_id is not None:
+                self._running[run.batch_id] = self._running.get(run.batch_id, 0) + 1
+
+            wait = time.time() - run.enqueued_at
+            average = self._average_wait.get(run.workspace_id, wait)
+            self._average_wait[run.workspace_id] = (
+                WAIT_SMOOTHING * wait + (1 - WAIT_SMOOTHING) * average
+            )
+
+            task = asyncio.create_task(self._drive(run, host))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _drive(self, run: PendingRun, host: ExecutorHost):
+        try:
+            await run.start(host)
+        except Exception as err:
+            logger.error(f"run {run.run_id} failed: {err}")
+        finally:
+            host.capacity.release(run.resources)
+            self._total_running -= 1
+            self._running[run.workspace_id] -= 1
+            if run.batch_id is not None:
+                self._running[run.batch_id] -= 1
+                self._forget_batch(run.batch_id)
+            self.admit()
+
+    def _forget_batch(self, batch_id: str):
+        if self._running.get(batch_id, 0) > 0:
+            return
+
+        if any(batch_id in queues for queues in self._queues.values()):
+            return
+
+        self._running.pop(batch_id, None)
+        self._limits.pop(batch_id, None)
+
+    def stats(
+        self, workspace_id: str, max_runs: Optional[int] = None
+    ) -> WorkspaceQueueStats:
+        if max_runs is None:
+            max_runs = self._limits.get(workspace_id, self.workspace_max_running)
+
+        queued = [
+            run
+            for queues in self._queues.values()
+            for queue in queues.values()
+            for run in queue
+            if run.workspace_id == workspace_id
+        ]
+        now = time.time()
+
+        return WorkspaceQueueStats(
+            workspace_id=workspace_id,
+            queued=len(queued),
+            running=self._running.get(workspace_id, 0),
+            max_runs=max_runs,
+            oldest_wait=max((now - run.enqueued_at for run in queued), default=0),
+            average_wait=self._average_wait.get(workspace_id, 0),
+        )
+
+    def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
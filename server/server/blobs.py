@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import zstandard
+
+# blobs are compressed in independent frames of this many bytes, so that a
+# range can be read without decompressing everything before it
+BLOB_FRAME_SIZE = 1 << 20
+
+
+class BlobStore:
+    """
+    Content-addressed, zstd compressed blobs on the local filesystem. A blob is
+    named by the sha256 of its contents, so identical contents are stored once.
+
+    Each blob is a sequence of zstd frames, with a sidecar index holding its
+    size and the compressed size of every frame.
+    """
+
+    def __init__(self, root: str, level: int = 3):
+        self.root = root
+        self.level = level
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest) + ".idx")
+
+    def put(self, data: bytes) -> Tuple[str, int]:
+        """
+        Store a blob, returning its digest and size. Blocks.
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+
+        if self.exists(digest):
+            # keep blobs that are still written to from being collected
+            os.utime(path + ".idx")
+            return digest, len(data)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        compressor = zstandard.ZstdCompressor(level=self.level)
+        frames: List[int] = []
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            for offset in range(0, len(data), BLOB_FRAME_SIZE):
+                frame = compressor.compress(data[offset : offset + BLOB_FRAME_SIZE])
+                f.write(frame)
+                frames.append(len(frame))
+
+        self._commit(f.name, digest, len(data), frames)
+
+        return digest, len(data)
+
+    def put_file(
+        self, fileobj: BinaryIO, expected: Optional[str] = None
+    ) -> Tuple[str, int]:
+        """
+        Store a blob read from a file, hashing and compressing it as it is
+        read, returning its digest and size. With `expected`, the blob is only
+        stored if it has that digest, and ValueError is raised otherwise.
+        Blocks.
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+
+        compressor = zstandard.ZstdCompressor(level=self.level)
+        digest = hashlib.sha256()
+        frames: List[int] = []
+        size = 0
+
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as f:
+            try:
+                while data := _read_frame(fileobj):
+                    digest.update(data)
+                    size += len(data)
+
+                    frame = compressor.compress(data)
+                    f.write(frame)
+                    frames.append(len(frame))
+            except BaseException:
+                os.remove(f.name)
+                raise
+
+        if expected is not None and digest.hexdigest() != expected:
+            os.remove(f.name)
+            raise ValueError(f"Blob has digest {digest.hexdigest()}, not {expected}")
+
+        if self.exists(digest.hexdigest()):
+            os.remove(f.name)
+            os.utime(self.path(digest.hexdigest()) + ".idx")
+        else:
+            self._commit(f.name, digest.hexdigest(), size, frames)
+
+        return digest.hexdigest(), size
+
+    def _commit(self, temp: str, digest: str, size: int, frames: List[int]):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp, path)
+
+        # the index is written last, so a blob only exists once it is complete
+        index = {"size": size, "frames": frames}
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(path), delete=False
+        ) as f:
+            json.dump(index, f)
+        os.replace(f.name, path + ".idx")
+
+    def touch(self, digest: str) -> bool:
+        """
+        Keep a blob from being collected, if it exists.
+        """
+
+        try:
+            os.utime(self.path(digest) + ".idx")
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def size(self, digest: str) -> int:
+        with open(self.path(digest) + ".idx") as f:
+            return json.load(f)["size"]
+
+    def read(self, digest: str, start: int = 0, end: int = -1) -> bytes:
+        """
+        Read bytes `start` to `end` of a blob, or to its end if `end` is
+        negative. Only the frames overlapping the range are decompressed.
+        Blocks.
+        """
+
+        path = self.path(digest)
+
+        with open(path + ".idx") as f:
+            index = json.load(f)
+
+        size = index["size"]
+        end = size if end < 0 else min(end, size)
+        if start >= end:
+            return b""
+
+        first = start // BLOB_FRAME_SIZE
+        last = (end - 1) // BLOB_FRAME_SIZE
+        decompressor = zstandard.ZstdDecompressor()
+        chunks: List[bytes] = []
+
+        with open(path, "rb") as f:
+            f.seek(sum(index["frames"][:first]))
+
+            for frame in range(first, last + 1):
+                data = decompressor.decompress(f.read(index["frames"][frame]))
+                chunks.append(data)
+
+        data = b"".join(chunks)
+        offset = first * BLOB_FRAME_SIZE
+
+        return data[start - offset : end - offset]
+
+    def stream(self, digest: str) -> Iterator[bytes]:
+        """
+        Yield the contents of a blob a frame at a time. Blocks.
+        """
+
+        path = self.path(digest)
+
+        with open(path + ".idx") as f:
+            index = json.load(f)
+
+        decompressor = zstandard.ZstdDecompressor()
+
+        with open(path, "rb") as f:
+            for size in index["frames"]:
+                yield decompressor.decompress(f.read(size))
+
+    def digests(self, older_than: float) -> Iterator[str]:
+        """
+        Digests of the blobs last stored more than `older_than` seconds ago.
+        """
+
+        cutoff = time.time() - older_than
+
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(".idx"):
+                    continue
+
+                if os.path.getmtime(os.path.join(directory, name)) < cutoff:
+                    yield name[: -len(".idx")]
+
+    def delete(self, digest: str):
+        path = self.path(digest)
+
+        # remove the index first, so a partial blob is never read
+        for name in (path + ".idx", path):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+def _read_frame(fileobj: BinaryIO) -> bytes:
+    """
+    Read a whole frame from a file, or what is left of it.
+    """
+
+    chunks: List[bytes] = []
+    remaining = BLOB_FRAME_SIZE
+
+    while remaining and (chunk := fileobj.read(remaining)):
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return b"".join(chunks)
@@ -0,0 +1,145 @@
+import asyncio
+import base64
+import json
+from collections import deque
+from typing import AsyncIterator, Deque, List, Tuple
+
+import zstandard
+from prisma import models as PrismaModels
+from prisma.enums import BuildStatus
+from pydantic import BaseModel
+
+from config import BUILD_LOG_FLUSH_INTERVAL, BUILD_LOG_FLUSH_LINES, BUILD_LOG_TAIL_LINES
+from server.segments import SegmentEvents, SegmentWriter, tail_segments
+
+ACTIVE_BUILD_STATUSES = [BuildStatus.CREATED, BuildStatus.BUILDING]
+
+# set whenever a new log segment for a build is stored
+log_events = SegmentEvents()
+
+
+class BuildLogPage(BaseModel):
+    """
+    Lines of a build log
+    """
+
+    lines: List[str]
+    # index of the first line returned
+    start: int
+    # number of lines logged so far
+    total: int
+
+
+def encode_lines(lines: List[str]) -> str:
+    data = zstandard.ZstdCompressor().compress(json.dumps(lines).encode("utf-8"))
+
+    # kept as text, as prisma's Bytes fields cannot be part of a response model
+    return base64.b64encode(data).decode("ascii")
+
+
+def decode_segment(segment: PrismaModels.BuildLog) -> List[str]:
+    data = zstandard.ZstdDecompressor().decompress(base64.b64decode(segment.data))
+
+    return json.loads(data)
+
+
+async def append_segment(build_id: str, seq: int, first_line: int, lines: List[str]):
+    """
+    Store a segment of a build's log and wake anyone tailing the build.
+    """
+
+    await PrismaModels.BuildLog.prisma().create(
+        {
+            "build_id": build_id,
+            "seq": seq,
+            "first_line": first_line,
+            "end_line": first_line + len(lines),
+            "data": encode_lines(lines),
+        }
+    )
+
+    log_events.notify(build_id)
+
+
+async def read_log(build_id: str, start: int, end: int = -1) -> Tuple[List[str], int]:
+    """
+    Read lines `start` to `end` of a build's log, or to its end if `end` is
+    negative. Returns them and the number of lines logged so far.
+    """
+
+    last = await PrismaModels.BuildLog.prisma().find_first(
+        where={"build_id": build_id}, order={"seq": "desc"}
+    )
+    total = 0 if last is None else last.end_line
+    end = total if end < 0 else min(end, total)
+
+    if start >= end:
+        return [], total
+
+    segments = await PrismaModels.BuildLog.prisma().find_many(
+        where={
+            "build_id": build_id,
+            "end_line": {"gt": start},
+            "first_line": {"lt": end},
+        },
+        order={"seq": "asc"},
+    )
+
+    lines: List[str] = []
+    for segment in segments:
+        lines.extend(decode_segment(segment))
+
+    offset = start - segments[0].first_line if segments else 0
+
+    return lines[offset : offset + end - start], total
+
+
+def tail_log(build_id: str, after: int = -1) -> AsyncIterator[PrismaModels.BuildLog]:
+    """
+    Yield the log segments of a build after `after`, following the build until
+    it finishes.
+    """
+
+    async def segments_after(after: int) -> List[PrismaModels.BuildLog]:
+        return await PrismaModels.BuildLog.prisma().find_many(
+            where={"build_id": build_id, "seq": {"gt": after}}, order={"seq": "asc"}
+        )
+
+    async def finished() -> bool:
+        build = await PrismaModels.Build.prisma().find_unique(where={"id": build_id})
+        return build is None or build.status not in ACTIVE_BUILD_STATUSES
+
+    async def wait():
+        await log_events.wait(build_id, BUILD_LOG_FLUSH_INTERVAL * 2)
+
+    return tail_segments(segments_after, finished, wait, after)
+
+
+class BuildLogWriter(SegmentWriter):
+    """
+    Buffers the log lines of a build and stores them in compressed segments,
+    when enough lines are buffered or the oldest buffered line is old enough.
+    The last lines are kept for Build.output.
+    """
+
+    def __init__(self, build_id: str, loop: asyncio.AbstractEventLoop):
+        super().__init__(loop, BUILD_LOG_FLUSH_LINES, BUILD_LOG_FLUSH_INTERVAL)
+        self.build_id = build_id
+        self.tail: Deque[str] = deque(maxlen=BUILD_LOG_TAIL_LINES)
+
+        self._lines = 0
+
+    def item(self, line: str) -> Tuple[str, int]:
+        self.tail.append(line)
+        return line, 1
+
+    async def store(self, seq: int, lines: List[str]):
+        await append_segment(self.build_id, seq, self._lines, lines)
+        self._lines += len(lines)
+
+    def close(self):
+        """
+        Flush whatever is left. Blocks, so never call it on the event loop.
+        """
+
+        self.flush()
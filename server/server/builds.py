@@ -0,0 +1,568 @@
+import asyncio
+import hashlib
+import json
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+import docker  # type: ignore
+from prisma import models as PrismaModels
+from prisma.enums import BuildStatus, Engine
+
+from config import BUILD_CONTEXT_DIR, BUILD_FILE_CACHE_TTL, BUILD_WORKERS
+from server.build_logs import BuildLogWriter
+from server.contexts import (
+    CONTEXT_CHUNK_SIZE,
+    ContextFiles,
+    TarStream,
+    expire_files,
+    read_context,
+)
+from server.docker import docker_client, image_manager
+from server.images import BUILD_IMAGE_LABEL, base_image
+from server.publisher import image_publisher
+from utils.logger import logger
+
+SDK_DIR = Path(__file__).parent.parent / "sdk"
+
+# image builds are blocking docker calls, so they run on their own threads
+build_pool = ThreadPoolExecutor(
+    max_workers=BUILD_WORKERS, thread_name_prefix="village-build"
+)
+
+
+# files a script's dependencies are installed from, by engine
+DEPENDENCY_FILES = {
+    Engine.Python: ["requirements.txt"],
+    Engine.Node: ["package.json", "yarn.lock"],
+}
+
+
+def construct_dockerfile(
+    script: PrismaModels.Script,
+    build_command: Optional[str],
+    image: Optional[str],
+) -> str:
+    """
+    Construct a Dockerfile from a script.
+
+    Dependencies are installed from the files in `deps/` before the context is
+    copied in, so their layer is reused by every build with the same base image
+    and dependency files until those change.
+
+    Everything is installed and built in a first stage, where the build command
+    runs last on the extracted context, and only the code, its dependencies and
+    the shim are copied into a clean base image to be run.
+    """
+
+    image = base_image(script.engine, script.engine_version) if image is None else image
+
+    if script.engine == Engine.Python:
+
+        # packages are installed to their own directory to be copied over
+        return f"""
+        FROM {image} AS build
+
+        ENV PYTHONPATH=/deps PATH=/deps/bin:$PATH
+        WORKDIR /app
+
+        COPY deps/ /app/
+        RUN if test -f "./requirements.txt"; then python3 -m pip install --no-cache-dir --target /deps -r requirements.txt; else mkdir /deps; fi
+
+        COPY context.tar.gz /app
+        RUN tar -xzf context.tar.gz && rm context.tar.gz
+        {f'RUN {build_command}' if build_command is not None else ""}
+
+        FROM {image}
+
+        ENV PYTHONPATH=/deps PATH=/deps/bin:$PATH
+        WORKDIR /app
+
+        COPY --from=build /deps /deps
+        COPY --from=build /app /app
+        COPY shim.py /app
+        CMD ["python3", "shim.py"]
+        """
+
+    elif script.engine == Engine.Node:
+
+        return f"""
+        FROM {image} AS build
+
+        WORKDIR /app
+
+        COPY deps/ /app/
+        RUN yarn install
+
+        COPY context.tar.gz /app
+        RUN tar -xzf context.tar.gz && rm context.tar.gz
+        {f'RUN {build_command}' if build_command is not None else ""}
+
+        FROM {image}
+
+        WORKDIR /app
+
+        COPY --from=build /app /app
+        COPY shim.js /app
+        CMD ["node", "shim.js"]
+        """
+
+    raise ValueError(f"Unsupported engine: {script.engine}")
+
+
+def read_dependencies(context_file: str, engine: Engine) -> Dict[str, bytes]:
+    """
+    Read the dependency files of a context. Blocks.
+    """
+
+    names = set(DEPENDENCY_FILES.get(engine, []))
+    dependencies: Dict[str, bytes] = {}
+
+    with tarfile.open(context_file, "r|gz", bufsize=CONTEXT_CHUNK_SIZE) as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+
+            if member.isfile() and name in names:
+                dependencies[name] = tar.extractfile(member).read()  # type: ignore
+
+    return dependencies
+
+
+def dependencies_hash(dependencies: Dict[str, bytes]) -> str:
+    """
+    Hash naming a set of dependency files.
+    """
+
+    digest = hashlib.sha256()
+
+    for name, data in sorted(dependencies.items()):
+        digest.update(f"{name}:{len(data)}:".encode("utf-8"))
+        digest.update(data)
+
+    return digest.hexdigest()
+
+
+def shim_file(engine: Engine) -> str:
+    if engine == Engine.Python:
+        return "shim.py"
+
+    elif engine == Engine.Node:
+        return "shim.js"
+
+    raise ValueError(f"Unsupported engine: {engine}")
+
+
+# shim sources by file name, read once
+shims: Dict[str, bytes] = {}
+
+
+def load_shims():
+    for engine in DEPENDENCY_FILES:
+        name = shim_file(engine)
+        shims[name] = (SDK_DIR / name).read_bytes()
+
+
+def shim_source(engine: Engine) -> bytes:
+    name = shim_file(engine)
+
+    if name not in shims:
+        shims[name] = (SDK_DIR / name).read_bytes()
+
+    return shims[name]
+
+
+def context_path(build_id: str) -> str:
+    """
+    Where the uploaded context of a build is kept until the build finishes.
+    """
+
+    return os.path.join(BUILD_CONTEXT_DIR, f"{build_id}.tar.gz")
+
+
+def context_hash(
+    files: ContextFiles,
+    script: PrismaModels.Script,
+    build_command: Optional[str],
+    image: Optional[str],
+) -> str:
+    """
+    Hash of everything an image is built from: the files in a context, which
+    are hashed by name, mode and contents so that repacking them does not
+    change it, and the Dockerfile and shim they are built with.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(sorted(files)).encode("utf-8"))
+    digest.update(construct_dockerfile(script, build_command, image).encode("utf-8"))
+    digest.update(shim_source(script.engine))
+
+    return digest.hexdigest()
+
+
+def reuse_image(source_id: str, build_id: str) -> bool:
+    """
+    Tag the image of an earlier build as a build's own. Returns False if that
+    image is gone. Blocks.
+    """
+
+    try:
+        image = docker_client.images.get(source_id)  # type: ignore
+    except docker.errors.ImageNotFound:  # type: ignore
+        return False
+
+    image.tag(build_id)
+
+    return True
+
+
+def image_size(build_id: str) -> Optional[int]:
+    """
+    Size in bytes of a build's image, if it exists. Blocks.
+    """
+
+    try:
+        return docker_client.images.get(build_id).attrs["Size"]  # type: ignore
+    except docker.errors.ImageNotFound:  # type: ignore
+        return None
+
+
+def build_image(build: PrismaModels.Build, log: BuildLogWriter) -> bool:
+    """
+    Build the image of a build from its context, logging as it goes. Returns
+    whether the build succeeded. Blocks.
+    """
+
+    if build.script is None:
+        raise Exception
+
+    engine = build.script.engine
+    dependencies = read_dependencies(context_path(build.id), engine)
+    dockerfile = construct_dockerfile(build.script, build.build_command, build.image)
+
+    # the context is streamed to the daemon from where it was uploaded
+    context = TarStream(
+        [
+            ("Dockerfile", dockerfile.encode("utf-8")),
+            (shim_file(engine), shim_source(engine)),
+            ("deps", None),
+            *[(f"deps/{name}", data) for name, data in dependencies.items()],
+            ("context.tar.gz", context_path(build.id)),
+        ]
+    )
+
+    log.write(f"Dependencies {dependencies_hash(dependencies)[:12]}\n")
+    succeeded = True
+
+    try:
+        for chunk in docker_client.api.build(  # type: ignore
+            fileobj=context,
+            custom_context=True,
+            tag=build.id,
+            labels={BUILD_IMAGE_LABEL: build.id},
+            decode=True,
+        ):
+            if chunk.get("stream"):
+                log.write(chunk["stream"])
+
+            if "error" in chunk:
+                log.write(f"{chunk['error']}\n")
+                succeeded = False
+    except docker.errors.APIError as err:  # type: ignore
+        log.write(f"{err}\n")
+        return False
+
+    return succeeded
+
+
+async def run_build(build_id: str):
+    """
+    Build a queued build's image and record the result.
+    """
+
+    build = await PrismaModels.Build.prisma().update(
+        {"status": BuildStatus.BUILDING},
+        where={"id": build_id},
+        include={"script": True},
+    )
+
+    if build is None:
+        return
+
+    # the log of an attempt interrupted by a restart
+    await PrismaModels.BuildLog.prisma().delete_many(where={"build_id": build_id})
+
+    loop = asyncio.get_running_loop()
+    log = BuildLogWriter(build_id, loop)
+
+    # writing to the log can block on storing it, so never from the event loop
+    try:
+        existing = await reuse_build(build)
+
+        if existing is not None:
+            message = f"Reused the image of build {existing}\n"
+            await loop.run_in_executor(None, log.write, message)
+            succeeded = True
+        else:
+            succeeded = await loop.run_in_executor(build_pool, build_image, build, log)
+    except Exception as err:
+        logger.error(f"build {build_id} failed: {err}")
+        await loop.run_in_executor(None, log.write, f"{err}\n")
+        succeeded = False
+
+    size = None
+    if succeeded:
+        image_manager.record(build_id)
+        size = await loop.run_in_executor(build_pool, image_size, build_id)
+
+        if size is not None:
+            message = f"Image size {size / (1 << 20):.1f} MiB\n"
+            await loop.run_in_executor(None, log.write, message)
+
+    # builds to run on Fargate are created with an empty image uri
+    image_uri = build.image_uri
+    if succeeded and image_uri is not None:
+        try:
+            image_uri = await loop.run_in_executor(
+                build_pool, image_publisher.publish, build_id, log
+            )
+        except Exception as err:
+            logger.error(f"publishing build {build_id} failed: {err}")
+            await loop.run_in_executor(None, log.write, f"{err}\n")
+            succeeded = False
+
+    await loop.run_in_executor(None, log.close)
+    remove_context(build_id)
+
+    await PrismaModels.Build.prisma().update(
+        {
+            "status": BuildStatus.SUCCESS if succeeded else BuildStatus.FAILURE,
+            "output": json.dumps(list(log.tail)),
+            "image_uri": image_uri,
+            "image_size": size,
+            "completed_at": datetime.now(),
+        },
+        where={"id": build_id},
+    )
+
+
+async def reuse_build(build: PrismaModels.Build) -> Optional[str]:
+    """
+    Tag the image of an earlier successful build of the same context and
+    Dockerfile inputs as a build's own, if there is one whose image still
+    exists. Returns the id of that build.
+    """
+
+    assert build.script is not None
+    loop = asyncio.get_running_loop()
+    digest = build.context_hash
+
+    # builds queued before hashes were taken on upload
+    if digest is None:
+        context = await loop.run_in_executor(
+            build_pool, read_context, context_path(build.id)
+        )
+        digest = context_hash(
+            context.files, build.script, build.build_command, build.image
+        )
+
+        await PrismaModels.Build.prisma().update(
+            {"context_hash": digest}, where={"id": build.id}
+        )
+
+    existing = await PrismaModels.Build.prisma().find_first(
+        where={
+            "context_hash": digest,
+            "status": BuildStatus.SUCCESS,
+            "id": {"not": build.id},
+        },
+        order={"completed_at": "desc"},
+    )
+
+    if existing is None:
+        return None
+
+    if not await loop.run_in_executor(build_pool, reuse_image, existing.id, build.id):
+        return None
+
+    logger.info(f"build {build.id} reuses the image of build {existing.id}")
+
+    return existing.id
+
+
+def remove_context(build_id: str):
+    try:
+        os.remove(context_path(build_id))
+    except FileNotFoundError:
+        pass
+
+
+class BuildQueue:
+    """
+    Runs queued builds on up to `workers` workers.
+
+    A script has at most one build running and one waiting. A build submitted
+    while another of the same script is waiting replaces it, since only the
+    latest build of a script is ever run.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+
+        # script id -> build waiting to run
+        self._waiting: Dict[str, str] = {}
+        self._building: Set[str] = set()
+        self._queue: "Optional[asyncio.Queue[str]]" = None
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+
+        for _ in range(self.workers):
+            task = asyncio.create_task(self._work())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def submit(self, script_id: str, build_id: str):
+        if self._queue is None:
+            raise RuntimeError("Build queue is not running")
+
+        superseded = self._waiting.get(script_id)
+        self._waiting[script_id] = build_id
+
+        if superseded is not None:
+            remove_context(superseded)
+            await PrismaModels.Build.prisma().update(
+                {
+                    "status": BuildStatus.SUPERSEDED,
+                    "output": json.dumps([f"Superseded by build {build_id}"]),
+                    "completed_at": datetime.now(),
+                },
+                where={"id": superseded},
+            )
+        elif script_id not in self._building:
+            self._queue.put_nowait(script_id)
+
+    async def _work(self):
+        assert self._queue is not None
+
+        while True:
+            script_id = await self._queue.get()
+            build_id = self._waiting.pop(script_id)
+            self._building.add(script_id)
+
+            try:
+                await run_build(build_id)
+            except Exception as err:
+                logger.error(f"build {build_id} failed: {err}")
+            finally:
+                self._building.discard(script_id)
+
+                # a build submitted meanwhile waited for this one
+                if script_id in self._waiting:
+                    self._queue.put_nowait(script_id)
+
+    def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+
+build_queue = BuildQueue(BUILD_WORKERS)
+
+
+async def recover_builds():
+    """
+    Queue the builds that were waiting or running when the server stopped,
+    failing those whose context is gone.
+    """
+
+    builds = await PrismaModels.Build.prisma().find_many(
+        where={"status": {"in": [BuildStatus.CREATED, BuildStatus.BUILDING]}},
+        order={"created_at": "asc"},
+    )
+
+    for build in builds:
+        if os.path.exists(context_path(build.id)):
+            await PrismaModels.Build.prisma().update(
+                {"status": BuildStatus.CREATED}, where={"id": build.id}
+            )
+            await build_queue.submit(build.script_id, build.id)
+            continue
+
+        await PrismaModels.Build.prisma().update(
+            {
+                "status": BuildStatus.FAILURE,
+                "output": json.dumps(["Build was interrupted by a server restart"]),
+                "completed_at": datetime.now(),
+            },
+            where={"id": build.id},
+        )
+
+    if builds:
+        logger.info(f"recovered {len(builds)} queued builds")
+
+
+async def maintain_file_cache(interval: float):
+    """
+    Periodically expire files of uploaded contexts that are no longer used.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await loop.run_in_executor(None, expire_files)
+        except Exception as err:
+            logger.error(f"failed to expire cached context files: {err}")
+
+
+async def prepare_publisher():
+    """
+    Bring up the registry stack ahead of the first build to publish.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        await loop.run_in_executor(None, image_publisher.repository_url)
+    except Exception as err:
+        logger.error(f"failed to prepare the image registry: {err}")
+
+
+builder_tasks: Set["asyncio.Task[None]"] = set()
+
+
+async def start_builder():
+    """
+    Start the build workers and resume queued builds.
+    """
+
+    os.makedirs(BUILD_CONTEXT_DIR, exist_ok=True)
+    load_shims()
+
+    build_queue.start()
+
+    for task in [
+        asyncio.create_task(maintain_file_cache(BUILD_FILE_CACHE_TTL / 100)),
+        asyncio.create_task(prepare_publisher()),
+    ]:
+        builder_tasks.add(task)
+        task.add_done_callback(builder_tasks.discard)
+
+    await recover_builds()
+
+
+def shutdown_builder():
+    """
+    Stop the build workers. Builds in flight are resumed on the next startup.
+    """
+
+    for task in list(builder_tasks):
+        task.cancel()
+
+    build_queue.shutdown()
+    build_pool.shutdown(wait=False)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+def cache_key(build_id: str, params: Dict[str, Any]) -> str:
+    """
+    Key of a run's result: its build and a hash of its params, which are
+    serialized with sorted keys so that equal params always hash the same.
+    """
+
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    return f"{build_id}:{digest}"
+
+
+@dataclass
+class CachedResult:
+    # the output fields of the run that produced the result
+    output: Dict[str, Any]
+    expires_at: float
+
+
+class CacheStats(BaseModel):
+    """
+    Run result cache metrics
+    """
+
+    entries: int
+    max_entries: int
+    in_flight: int
+    hits: int
+    misses: int
+    coalesced: int
+    evictions: int
+    hit_rate: float
+
+
+class ResultCache:
+    """
+    Outputs of successful runs of cacheable builds, bounded to `max_entries`
+    with the least recently used evicted first.
+
+    Runs with the same key as a run in flight wait for that run instead of
+    executing themselves.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+
+        self._results: "OrderedDict[str, CachedResult]" = OrderedDict()
+        # key -> ids of the runs waiting on the run in flight
+        self._in_flight: Dict[str, List[str]] = {}
+        # id of each run in flight -> its key
+        self._leaders: Dict[str, str] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        result = self._results.get(key)
+
+        if result is not None and result.expires_at <= time.monotonic():
+            del self._results[key]
+            result = None
+
+        if result is None:
+            self.misses += 1
+            return None
+
+        self._results.move_to_end(key)
+        self.hits += 1
+
+        return result.output
+
+    def join(self, key: str, run_id: str) -> bool:
+        """
+        Wait on the run in flight for a key, if there is one. Otherwise the
+        caller's run is marked in flight and should be executed.
+        """
+
+        waiting = self._in_flight.get(key)
+
+        if waiting is None:
+            self._in_flight[key] = []
+            self._leaders[run_id] = key
+            return False
+
+        waiting.append(run_id)
+        self.coalesced += 1
+
+        return True
+
+    def finish(
+        self, run_id: str, output: Optional[Dict[str, Any]], ttl: float
+    ) -> List[str]:
+        """
+        Record the end of a run in flight, caching its output if it succeeded.
+        Returns the ids of the runs that waited on it.
+        """
+
+        key = self._leaders.pop(run_id, None)
+        if key is None:
+            return []
+
+        waiting = self._in_flight.pop(key, [])
+
+        if output is not None:
+            self._results[key] = CachedResult(output, time.monotonic() + ttl)
+            self._results.move_to_end(key)
+
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+        return waiting
+
+    def cancel(self, run_id: str) -> List[str]:
+        """
+        Stop a run from waiting on the run in flight for its key. If the run is
+        in flight itself, its key is released and the ids of the runs that
+        waited on it are returned.
+        """
+
+        if run_id in self._leaders:
+            return self.finish(run_id, None, 0)
+
+        for waiting in self._in_flight.values():
+            if run_id in waiting:
+                waiting.remove(run_id)
+                break
+
+        return []
+
+    def stats(self) -> CacheStats:
+        lookups = self.hits + self.misses
+
+        return CacheStats(
+            entries=len(self._results),
+            max_entries=self.max_entries,
+            in_flight=len(self._in_flight),
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            evictions=self.evictions,
+            hit_rate=self.hits / lookups if lookups else 0,
+        )
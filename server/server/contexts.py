@@ -0,0 +1,382 @@
+import hashlib
+import os
+import re
+import tarfile
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+from pydantic import BaseModel
+
+from config import BUILD_FILE_CACHE_DIR, BUILD_FILE_CACHE_TTL
+from server.blobs import BlobStore
+
+# contexts are read and written in chunks of this many bytes
+CONTEXT_CHUNK_SIZE = 1 << 20
+
+# files of uploaded contexts, so that later uploads can leave them out
+file_store = BlobStore(BUILD_FILE_CACHE_DIR)
+
+# name, whether it is executable, and digest of each file in a context
+ContextFiles = List[Tuple[str, bool, str]]
+
+
+class ContextTooLargeError(Exception):
+    """
+    A build context is larger than the maximum size.
+    """
+
+
+class ContextFileError(Exception):
+    """
+    A delta upload does not match its manifest.
+    """
+
+
+class ManifestFile(BaseModel):
+    """
+    File in a build context manifest
+    """
+
+    # relative to the root of the context
+    path: str
+    # sha256 of the file's contents
+    hash: str
+    size: int
+    executable: bool = False
+
+
+@dataclass
+class BuildContext:
+    size: int
+    # contents of village.yaml, if the context has one
+    config: Optional[bytes]
+    files: ContextFiles
+
+
+class _Spool:
+    """
+    Reads from an uploaded file, writing everything read to another file, if
+    given, and counting it, so a context is parsed while it is copied. The
+    count starts at `size`, for uploads that share a limit.
+    """
+
+    def __init__(
+        self,
+        source: BinaryIO,
+        out: Optional[BinaryIO],
+        max_bytes: int,
+        size: int = 0,
+    ):
+        self.source = source
+        self.out = out
+        self.max_bytes = max_bytes
+        self.size = size
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise ContextTooLargeError(
+                f"Build context is larger than {self.max_bytes} bytes"
+            )
+
+        if self.out is not None:
+            self.out.write(data)
+
+        return data
+
+
+def scan_context(fileobj: BinaryIO) -> Tuple[Optional[bytes], ContextFiles]:
+    """
+    Read a gzipped context tarball front to back, returning its village.yaml
+    and the digests of its files. Blocks.
+    """
+
+    config: Optional[bytes] = None
+    files: ContextFiles = []
+
+    with tarfile.open(fileobj=fileobj, mode="r|gz", bufsize=CONTEXT_CHUNK_SIZE) as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+
+            if member.issym():
+                files.append((name, False, f"link:{member.linkname}"))
+                continue
+
+            if not member.isfile():
+                continue
+
+            f = tar.extractfile(member)
+            assert f is not None
+
+            if name == "village.yaml":
+                data = f.read()
+                config = data
+                digest = hashlib.sha256(data)
+            else:
+                digest = hashlib.sha256()
+                while chunk := f.read(CONTEXT_CHUNK_SIZE):
+                    digest.update(chunk)
+
+            files.append((name, bool(member.mode & 0o111), digest.hexdigest()))
+
+    return config, files
+
+
+def ingest_context(source: BinaryIO, path: str, max_bytes: int) -> BuildContext:
+    """
+    Copy an uploaded context to `path`, reading it once: its size, files and
+    village.yaml are found as it is written. Raises ContextTooLargeError as
+    soon as more than `max_bytes` have been copied. Blocks.
+
+    `source` is the upload as spooled by the web framework, which has already
+    received the whole request body, so `max_bytes` bounds what is copied and
+    parsed rather than what is received.
+    """
+
+    with open(path, "wb") as out:
+        spool = _Spool(source, out, max_bytes)
+        config, files = scan_context(spool)  # type: ignore
+
+        # whatever follows the end of the archive is kept as uploaded
+        while spool.read(CONTEXT_CHUNK_SIZE):
+            pass
+
+    return BuildContext(size=spool.size, config=config, files=files)
+
+
+def read_context(path: str) -> BuildContext:
+    """
+    Scan a context that is already saved. Blocks.
+    """
+
+    with open(path, "rb") as f:
+        config, files = scan_context(f)
+
+    return BuildContext(size=os.path.getsize(path), config=config, files=files)
+
+
+def check_manifest(files: List[ManifestFile], max_bytes: int):
+    """
+    Raise ContextFileError if a manifest names a file outside the context or
+    names one twice, and ContextTooLargeError if its declared sizes add up to
+    more than `max_bytes`. The actual sizes are checked by assemble_context.
+    """
+
+    paths = set()
+
+    for file in files:
+        path = os.path.normpath(file.path)
+
+        if os.path.isabs(path) or path == ".." or path.startswith("../"):
+            raise ContextFileError(f"{file.path} is outside the context")
+
+        if path in paths:
+            raise ContextFileError(f"{file.path} is listed more than once")
+
+        if not re.fullmatch(r"[0-9a-f]{64}", file.hash):
+            raise ContextFileError(f"{file.path} does not have a sha256 hash")
+
+        paths.add(path)
+
+    if sum(x.size for x in files) > max_bytes:
+        raise ContextTooLargeError(f"Build context is larger than {max_bytes} bytes")
+
+
+def missing_files(files: List[ManifestFile]) -> List[str]:
+    """
+    Hashes of the files in a manifest that are not cached. Those that are
+    cached are kept from expiring until the build is uploaded. Blocks.
+    """
+
+    return sorted({x.hash for x in files if not file_store.touch(x.hash)})
+
+
+def store_files(uploads: List[Tuple[BinaryIO, str]], max_bytes: int):
+    """
+    Cache the files uploaded with a manifest, each with the hash it was sent
+    as. A file is only kept once it is known to have that hash. Raises
+    ContextTooLargeError as soon as more than `max_bytes` have been read from
+    the files in all. Blocks.
+    """
+
+    size = 0
+
+    for fileobj, digest in uploads:
+        spool = _Spool(fileobj, None, max_bytes, size)
+
+        try:
+            file_store.put_file(spool, digest)  # type: ignore
+        except ValueError:
+            raise ContextFileError(f"File sent as {digest} does not have that hash")
+
+        size = spool.size
+
+
+def expire_files():
+    """
+    Delete cached files that no manifest has used for BUILD_FILE_CACHE_TTL
+    seconds. Blocks.
+    """
+
+    for digest in list(file_store.digests(BUILD_FILE_CACHE_TTL)):
+        file_store.delete(digest)
+
+
+def assemble_context(
+    files: List[ManifestFile], path: str, max_bytes: int
+) -> BuildContext:
+    """
+    Write the context described by a manifest to `path` from cached files.
+    Raises ContextTooLargeError if the cached files add up to more than
+    `max_bytes`, whatever sizes the manifest declares. Blocks.
+    """
+
+    missing = missing_files(files)
+    if missing:
+        raise ContextFileError(f"Files not uploaded: {', '.join(missing)}")
+
+    if sum(file_store.size(x.hash) for x in files) > max_bytes:
+        raise ContextTooLargeError(f"Build context is larger than {max_bytes} bytes")
+
+    config: Optional[bytes] = None
+    size = 0
+
+    with tarfile.open(
+        path, "w:gz", compresslevel=1, copybufsize=CONTEXT_CHUNK_SIZE
+    ) as tar:
+        for file in files:
+            name = os.path.normpath(file.path)
+
+            info = tarfile.TarInfo(name)
+            info.size = file_store.size(file.hash)
+            info.mode = 0o755 if file.executable else 0o644
+            size += info.size
+
+            if name == "village.yaml":
+                config = file_store.read(file.hash)
+
+            tar.addfile(info, _BlobReader(file_store.stream(file.hash)))
+
+    return BuildContext(
+        size=size,
+        config=config,
+        files=[(os.path.normpath(x.path), x.executable, x.hash) for x in files],
+    )
+
+
+class _BlobReader:
+    """
+    File-like view of a stream of blob chunks, for tarfile to copy from.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size: int) -> bytes:
+        # tarfile takes a short read for the end of the file
+        parts: List[bytes] = []
+
+        while size > 0:
+            if self.offset >= len(self.chunk):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.chunk, self.offset = chunk, 0
+
+            data = self.chunk[self.offset : self.offset + size]
+            self.offset += len(data)
+            size -= len(data)
+            parts.append(data)
+
+        return b"".join(parts)
+
+
+class TarStream:
+    """
+    An uncompressed tar archive of files in memory and files on disk, produced
+    as it is read rather than assembled up front. `None` adds a directory.
+    """
+
+    def __init__(self, members: List[Tuple[str, Union[bytes, str, None]]]):
+        self.members = members
+        self._blocks = self._generate()
+        self._block = b""
+        self._offset = 0
+
+    def _info(self, name: str, source: Union[bytes, str, None]) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        # fixed, so that equal contents give equal archives
+        info.mtime = 0
+
+        if source is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = (
+                len(source) if isinstance(source, bytes) else os.path.getsize(source)
+            )
+            info.mode = 0o644
+
+        return info
+
+    def _generate(self) -> Iterator[bytes]:
+        for name, source in self.members:
+            info = self._info(name, source)
+            yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+            if isinstance(source, bytes):
+                yield source
+            elif isinstance(source, str):
+                with open(source, "rb") as f:
+                    while chunk := f.read(CONTEXT_CHUNK_SIZE):
+                        yield chunk
+
+            yield _padding(info.size)
+
+        yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+    def __len__(self) -> int:
+        size = tarfile.BLOCKSIZE * 2
+
+        for name, source in self.members:
+            info = self._info(name, source)
+            size += len(info.tobuf(format=tarfile.PAX_FORMAT))
+            size += info.size + len(_padding(info.size))
+
+        return size
+
+    def read(self, size: int = -1) -> bytes:
+        chunks: List[bytes] = []
+
+        while size != 0:
+            if self._offset >= len(self._block):
+                block = next(self._blocks, None)
+                if block is None:
+                    break
+
+                self._block, self._offset = block, 0
+                continue
+
+            end = len(self._block) if size < 0 else self._offset + size
+            chunk = self._block[self._offset : end]
+            self._offset += len(chunk)
+            chunks.append(chunk)
+
+            if size > 0:
+                size -= len(chunk)
+
+        return b"".join(chunks)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while data := self.read(CONTEXT_CHUNK_SIZE):
+            yield data
+
+
+def _padding(size: int) -> bytes:
+    remainder = size % tarfile.BLOCKSIZE
+
+    return b"\0" * (tarfile.BLOCKSIZE - remainder) if remainder else b""
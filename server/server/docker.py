@@ -1,57 +1,903 @@
+import asyncio
 import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union, cast
 
 import docker  # type: ignore
+from docker.utils.socket import frames_iter  # type: ignore
+from prisma import get_client
 from prisma import models as PrismaModels
-from prisma.enums import Engine, RunStatus
+from prisma.enums import RunStatus
+from prisma.fields import Json
 
+from config import (
+    EXECUTOR_HEARTBEAT_INTERVAL,
+    EXECUTOR_HOSTS,
+    EXECUTOR_WORKERS,
+    IMAGE_CACHE_BUDGET,
+    IMAGE_MAINTAIN_INTERVAL,
+    INSTANCE_LEASE_TTL,
+    RUN_CACHE_MAX_ENTRIES,
+    RUN_CACHE_TTL,
+    RUN_CANCEL_POLL_INTERVAL,
+    RUN_DEFAULT_TIMEOUT,
+    RUN_OUTPUT_RETENTION,
+    WORKSPACE_MAX_RUNS,
+)
+from server.admission import PRIORITY_INTERACTIVE, AdmissionController, PendingRun
+from server.cache import ResultCache, cache_key
+from server.fargate import fargate_watcher
+from server.fleet import ExecutorHost, Fleet, maintain
+from server.images import ImageManager, maintain_images
+from server.inputs import input_params, split_inputs, store_inputs
+from server.instance import (
+    INSTANCE_ID,
+    end_lease,
+    live_instances,
+    maintain_lease,
+    renew_lease,
+    unowned,
+)
+from server.output import (
+    ACTIVE_RUN_STATUSES,
+    OutputWriter,
+    blob_store,
+    compact_output,
+    maintain_outputs,
+)
+from server.resources import build_resources
+from utils.logger import logger
+
+# builds happen on the local daemon, runs on the executor fleet
 docker_client = docker.from_env()  # type: ignore
 
+fleet = Fleet()
+if EXECUTOR_HOSTS:
+    for endpoint in EXECUTOR_HOSTS:
+        fleet.register(endpoint, docker.DockerClient(base_url=endpoint))  # type: ignore
+else:
+    fleet.register("local", docker_client)
+
+# containers are driven from worker threads so that the blocking docker calls
+# never run on the event loop
+executor_pool = ThreadPoolExecutor(
+    max_workers=EXECUTOR_WORKERS, thread_name_prefix="village-executor"
+)
+admission = AdmissionController(
+    max_running=EXECUTOR_WORKERS,
+    workspace_max_running=WORKSPACE_MAX_RUNS,
+    fleet=fleet,
+)
+
+# outputs of cacheable builds, per build and params
+result_cache = ResultCache(RUN_CACHE_MAX_ENTRIES)
+image_manager = ImageManager(fleet, docker_client, IMAGE_CACHE_BUDGET)
+
+Params = Dict[str, Union[str, int, float, bool]]
+
+# keep references to background tasks so they are not garbage collected
+background_tasks: Set["asyncio.Task[None]"] = set()
+
+
+class ScriptError(Exception):
+    """
+    A script exited with a non-zero code.
+    """
+
+
+class RunTimeoutError(Exception):
+    """
+    A run took longer than its timeout.
+    """
+
+
+class RunCancelledError(Exception):
+    """
+    A run was cancelled while it was running.
+    """
+
+
+class RunNotCancellableError(Exception):
+    """
+    A run is running without a server process that can stop it.
+    """
+
+
+class RunControl:
+    """
+    Handle on a queued or running run, used to stop it from another thread or
+    from the event loop.
+    """
+
+    def __init__(self, timeout: Optional[float]):
+        self.timeout = timeout
+        self.cancelled = threading.Event()
+        self.timed_out = threading.Event()
+
+        self._container: Optional[Any] = None
+        self._lock = threading.Lock()
+
+    def attach(self, container: Any):
+        with self._lock:
+            self._container = container
+            stopped = self.cancelled.is_set() or self.timed_out.is_set()
+
+        # the run was stopped before its container was ready
+        if stopped:
+            self.kill()
+
+    def detach(self):
+        with self._lock:
+            self._container = None
+
+    def cancel(self):
+        self.cancelled.set()
+        self.kill()
+
+    def time_out(self):
+        self.timed_out.set()
+        self.kill()
+
+    def kill(self):
+        with self._lock:
+            container = self._container
+
+        if container is None:
+            return
+
+        try:
+            container.kill()
+        except docker.errors.APIError as err:  # type: ignore
+            logger.warning(f"failed to kill container {container.id}: {err}")
+
+
+# stream id of stderr in multiplexed attach output
+STDERR = 2
+
+# run id -> control of each run handed to the admission controller
+run_controls: Dict[str, RunControl] = {}
+
+
+def partial_suffix(data: bytes, token: bytes) -> int:
+    """
+    Length of the longest suffix of data that is a proper prefix of token.
+    """
+
+    for length in range(min(len(data), len(token) - 1), 0, -1):
+        if data.endswith(token[:length]):
+            return length
+
+    return 0
+
+
+def dispatch(
+    container: Any,
+    params: Params,
+    inputs: List[PrismaModels.RunInput],
+    write: Callable[[bytes], None],
+):
+    """
+    Send a run to a container serving the shim protocol and pass its output to
+    `write` as it arrives, stderr included so that tracebacks are kept. The raw
+    bytes of each input follow the request line, streamed from the blob store.
+    """
+
+    request_id = uuid.uuid4().hex
+    request = {
+        "id": request_id,
+        "params": params,
+        "inputs": [{"key": x.key, "size": x.size, "text": x.text} for x in inputs],
+    }
+
+    sock = container.attach_socket(
+        params={"stdin": 1, "stdout": 1, "stderr": 1, "stream": 1}
+    )
+
+    try:
+        sock._sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        for item in inputs:
+            for chunk in blob_store.stream(item.blob):
+                sock._sock.sendall(chunk)
+
+        # the run's output is followed by a line holding the id and exit code
+        terminator = f"{request_id} ".encode("utf-8")
+        pending = b""
+
+        for stream, data in frames_iter(sock, tty=False):
+            # the terminator is only ever printed to stdout
+            if stream == STDERR:
+                write(data)
+                continue
+
+            pending += data
+            index = pending.find(terminator)
+
+            if index == -1:
+                # only hold back what could be the start of the terminator
+                keep = partial_suffix(pending, terminator)
+                write(pending[: len(pending) - keep])
+                pending = pending[len(pending) - keep :]
+                continue
+
+            write(pending[:index])
+            pending = pending[index:]
+
+            end = pending.find(b"\n")
+            if end == -1:
+                continue
+
+            code = int(pending[len(terminator) : end])
+            if code != 0:
+                raise ScriptError(f"Script exited with code {code}")
+
+            return
+
+    finally:
+        sock.close()
+
+    raise RuntimeError("Container exited before the run finished")
+
+
+def out_of_memory(container: Any) -> bool:
+    try:
+        container.reload()
+    except docker.errors.NotFound:  # type: ignore
+        return False
+
+    return container.attrs["State"].get("OOMKilled", False)
+
+
+def run_container(
+    build: PrismaModels.Build,
+    params: Params,
+    inputs: List[PrismaModels.RunInput],
+    writer: OutputWriter,
+    host: ExecutorHost,
+    control: RunControl,
+):
+    """
+    Run a build to completion on a host, streaming its output to `writer`.
+    Blocks the calling thread.
+    """
+
+    if build.script is None:
+        raise Exception
+
+    if control.cancelled.is_set():
+        raise RunCancelledError("Run was cancelled")
+
+    hit = host.ensure_image(build.id, docker_client)
+    image_manager.record(build.id, hit)
+    warm_pool = host.pool
+
+    container = warm_pool.acquire(build.id, build.script.engine, build_resources(build))
+    control.attach(container)
+
+    # a run past its timeout has its container killed, which ends the dispatch
+    watchdog = None
+    if control.timeout is not None:
+        watchdog = threading.Timer(control.timeout, control.time_out)
+        watchdog.start()
+
+    try:
+        dispatch(container, params, inputs, writer.write)
+    except ScriptError:
+        # the container itself is still serving
+        control.detach()
+        warm_pool.release(build.id, container)
+        raise
+    except Exception as err:
+        control.detach()
+
+        if control.cancelled.is_set():
+            error: Exception = RunCancelledError("Run was cancelled")
+        elif control.timed_out.is_set():
+            error = RunTimeoutError(f"Run timed out after {control.timeout} seconds")
+        elif out_of_memory(container):
+            error = RuntimeError("Run exceeded its memory limit")
+        else:
+            error = err
+
+        warm_pool.release(build.id, container, reuse=False)
+        warm_pool.remove_container(container)
+        raise error from err
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+
+    control.detach()
+    warm_pool.release(build.id, container)
+
+
+async def complete_run(
+    run_id: str,
+    build: PrismaModels.Build,
+    params: Params,
+    inputs: List[PrismaModels.RunInput],
+    host: ExecutorHost,
+    control: RunControl,
+):
+    """
+    Run the container for an admitted run on the host it was placed on and
+    record the result.
+    """
+
+    loop = asyncio.get_running_loop()
+    writer = OutputWriter(run_id, loop)
+    status = RunStatus.FAILURE
+
+    try:
+        await PrismaModels.Run.prisma().update(
+            {"status": RunStatus.RUNNING, "started_at": datetime.utcnow()},
+            where={"id": run_id},
+        )
+
+        try:
+            await loop.run_in_executor(
+                executor_pool,
+                run_container,
+                build,
+                params,
+                inputs,
+                writer,
+                host,
+                control,
+            )
+        except Exception as err:
+            logger.error(f"run {run_id} failed: {err}")
+
+            await loop.run_in_executor(None, writer.close, str(err))
+            if isinstance(err, RunCancelledError):
+                status = RunStatus.CANCELLED
+            elif isinstance(err, RunTimeoutError):
+                status = RunStatus.TIMED_OUT
+            else:
+                status = RunStatus.FAILURE
+        else:
+            await loop.run_in_executor(None, writer.close)
+            status = RunStatus.SUCCESS
+
+        await compact_output(run_id)
+        await PrismaModels.Run.prisma().update(
+            {"status": status, "completed_at": datetime.utcnow()},
+            where={"id": run_id},
+        )
+    finally:
+        run_controls.pop(run_id, None)
+
+        # the runs waiting on this one are never left behind, however it ended
+        if build.cacheable:
+            await share_result(run_id, build, params, status)
+
+
+async def share_result(
+    run_id: str, build: PrismaModels.Build, params: Params, status: RunStatus
+):
+    """
+    Cache the output of a finished run of a cacheable build, and hand it to the
+    identical runs that waited on it.
+    """
+
+    output: Optional[Dict[str, Any]] = None
+    ttl = RUN_CACHE_TTL if build.cache_ttl is None else build.cache_ttl
+
+    try:
+        run = await PrismaModels.Run.prisma().find_unique(where={"id": run_id})
+        if run is not None:
+            # large outputs are shared by reference to their blob
+            output = {
+                "output": run.output,
+                "output_blob": run.output_blob,
+                "output_size": run.output_size,
+            }
+    finally:
+        waiting = result_cache.finish(
+            run_id, output if status == RunStatus.SUCCESS else None, ttl
+        )
+
+    if status == RunStatus.CANCELLED or output is None:
+        # the runs that waited were not cancelled themselves, so run them
+        await requeue_waiting(waiting, build, params)
+    elif waiting:
+        await PrismaModels.Run.prisma().update_many(
+            data={
+                "status": status,
+                **output,
+                "cached": True,
+                "completed_at": datetime.utcnow(),
+            },
+            where={"id": {"in": waiting}, "status": RunStatus.CREATED},
+        )
+
+
+async def requeue_waiting(
+    waiting: List[str], build: PrismaModels.Build, params: Params
+):
+    """
+    Queue the runs that waited on a run which ended without a result to share.
+    The first of them is run, and the others wait on it in turn.
+    """
+
+    if not waiting:
+        return
+
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={"id": {"in": waiting}, "status": RunStatus.CREATED},
+        order={"created_at": "asc"},
+        include={"inputs": True},
+    )
+
+    for run in runs:
+        if await from_cache(run, build, params) is None:
+            await enqueue([(run, params)], build)
+
+
+async def from_cache(
+    run: PrismaModels.Run, build: PrismaModels.Build, params: Params
+) -> Optional[PrismaModels.Run]:
+    """
+    Finish a run of a cacheable build with a cached output, or leave it waiting
+    on an identical run in flight. Returns None if the run must be executed.
+    """
+
+    key = cache_key(build.id, input_params(run, params))
+    output = result_cache.get(key)
+
+    if output is not None:
+        now = datetime.utcnow()
+        return await PrismaModels.Run.prisma().update(
+            {
+                "status": RunStatus.SUCCESS,
+                **output,
+                "cached": True,
+                "started_at": now,
+                "completed_at": now,
+            },
+            where={"id": run.id},
+        )
+
+    if result_cache.join(key, run.id):
+        return run
+
+    return None
+
+
+def run_timeout(run: PrismaModels.Run, build: PrismaModels.Build) -> float:
+    """
+    Timeout of a run, which may shorten the timeout of its build.
+    """
+
+    if run.timeout is not None:
+        return run.timeout if build.timeout is None else min(run.timeout, build.timeout)
+
+    return RUN_DEFAULT_TIMEOUT if build.timeout is None else build.timeout
+
+
+def pending_run(
+    run: PrismaModels.Run, build: PrismaModels.Build, params: Params
+) -> PendingRun:
+    if build.script is None:
+        raise Exception
+
+    control = RunControl(run_timeout(run, build))
+    run_controls[run.id] = control
+
+    return PendingRun(
+        run_id=run.id,
+        workspace_id=build.script.workspace_id,
+        priority=run.priority,
+        enqueued_at=run.created_at.timestamp(),
+        resources=build_resources(build),
+        image=build.id,
+        start=lambda host: complete_run(
+            run.id, build, params, run.inputs or [], host, control
+        ),
+        batch_id=run.batch_id,
+    )
+
+
+async def enqueue(
+    runs: List[Tuple[PrismaModels.Run, Params]],
+    build: PrismaModels.Build,
+    parallelism: Optional[int] = None,
+):
+    """
+    Hand created runs of a build to the admission controller.
+    """
+
+    if build.script is None:
+        raise Exception
+
+    workspace = await PrismaModels.Workspace.prisma().find_unique(
+        where={"id": build.script.workspace_id}
+    )
+
+    try:
+        for run, params in runs:
+            admission.submit(
+                pending_run(run, build, params),
+                max_runs=None if workspace is None else workspace.max_runs,
+                parallelism=parallelism,
+            )
+    except ValueError as err:
+        failed = []
+        for run, _ in runs:
+            run_controls.pop(run.id, None)
+            failed.append(run.id)
+            # identical runs waiting on this one could not run either
+            failed.extend(result_cache.finish(run.id, None, 0))
+
+        # every run of a build requests the same resources
+        await PrismaModels.Run.prisma().update_many(
+            data={
+                "output": str(err),
+                "status": RunStatus.FAILURE,
+                "completed_at": datetime.utcnow(),
+            },
+            where={"id": {"in": failed}},
+        )
+
 
 async def execute(
     build: PrismaModels.Build,
-    params: Dict[str, Union[str, int, float, bool]],
+    params: Params,
     schedule_id: Optional[str] = None,
     executor_id: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    timeout: Optional[int] = None,
+    files: Optional[List[Dict[str, Any]]] = None,
 ):
+    """
+    Create a run for a build and queue it for execution. Returns as soon as the
+    run is recorded; poll or tail the run for its status and output.
 
-    print(executor_id)
+    Large bigstring params and `files`, uploaded files already in the blob
+    store, are sent to the container as raw bytes instead of inline with the
+    other params.
+    """
+
+    if build.script is None:
+        raise Exception
+
+    params, inputs = split_inputs(params, build.params or [])
 
     run = await PrismaModels.Run.prisma().create(
         {
             "script_id": build.script_id,
             "build_id": build.id,
-            "status": RunStatus.RUNNING,
+            "status": RunStatus.CREATED,
+            "priority": priority,
             "output": "",
             "schedule_id": schedule_id,
             "creator_id": executor_id,
+            "timeout": timeout,
             "params": {
                 "create": [
                     {"key": key, "value": str(value)} for key, value in params.items()
                 ]
             },
-        }
+            "param_values": Json(params),
+            "instance_id": INSTANCE_ID,
+            "inputs": {"create": await store_inputs(inputs) + (files or [])},
+        },
+        include={"inputs": True},
     )
 
-    if build.script is None:
-        raise Exception
+    if build.cacheable:
+        cached = await from_cache(run, build, params)
+        if cached is not None:
+            return cached
 
-    output: str = ""
+    await enqueue([(run, params)], build)
 
-    if build.script.engine == Engine.Python:
-        output = docker_client.containers.run(build.id, f"python3 shim.py '{json.dumps(params)}'").decode("utf-8")  # type: ignore
+    return run
 
-    elif build.script.engine == Engine.Node:
-        output = docker_client.containers.run(build.id, f"node shim.js '{json.dumps(params)}'").decode("utf-8")  # type: ignore
 
-    run = await PrismaModels.Run.prisma().update(
+async def execute_batch(
+    build: PrismaModels.Build,
+    params: List[Params],
+    parallelism: int,
+    executor_id: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    timeout: Optional[int] = None,
+) -> PrismaModels.Batch:
+    """
+    Create a run of a build for each set of params, as one batch, and queue
+    them for execution with at most `parallelism` running at once.
+    """
+
+    batch = await PrismaModels.Batch.prisma().create(
         {
-            "output": output,
-            "status": RunStatus.SUCCESS,
+            "build_id": build.id,
+            "script_id": build.script_id,
+            "creator_id": executor_id,
+            "size": len(params),
+            "parallelism": parallelism,
+        }
+    )
+
+    items = [split_inputs(item, build.params or []) for item in params]
+    inputs = [await store_inputs(item) for _, item in items]
+
+    # create the runs in a single round trip to the database
+    async with get_client().batch_() as batcher:
+        for index, (item, _) in enumerate(items):
+            batcher.run.create(
+                {
+                    "script_id": build.script_id,
+                    "build_id": build.id,
+                    "batch_id": batch.id,
+                    "batch_index": index,
+                    "status": RunStatus.CREATED,
+                    "priority": priority,
+                    "output": "",
+                    "creator_id": executor_id,
+                    "timeout": timeout,
+                    "params": {
+                        "create": [
+                            {"key": key, "value": str(value)}
+                            for key, value in item.items()
+                        ]
+                    },
+                    "param_values": Json(item),
+                    "instance_id": INSTANCE_ID,
+                    "inputs": {"create": inputs[index]},
+                }
+            )
+
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={"batch_id": batch.id},
+        order={"batch_index": "asc"},
+        include={"inputs": True},
+    )
+
+    pending = [(run, item) for run, (item, _) in zip(runs, items)]
+    if build.cacheable:
+        pending = [
+            (run, item)
+            for run, item in pending
+            if await from_cache(run, build, item) is None
+        ]
+
+    await enqueue(pending, build, parallelism)
+
+    return batch
+
+
+async def cancel_run(run_id: str):
+    """
+    Stop a run. A queued run is cancelled right away; a running run has its
+    container killed and is marked cancelled once its output is stored. A run
+    of another server process is stopped by that process, when it next checks
+    for cancelled runs.
+    """
+
+    control = run_controls.get(run_id)
+    if control is not None:
+        control.cancel()
+
+    if control is not None and not admission.cancel(run_id):
+        # the run has been admitted and finishes as cancelled
+        return
+
+    if control is None:
+        requested = await PrismaModels.Run.prisma().update_many(
+            data={"cancel_requested": True},
+            where={
+                "id": run_id,
+                "status": {"in": ACTIVE_RUN_STATUSES},
+                "instance_id": {"not": INSTANCE_ID},
+            },
+        )
+        if requested:
+            return
+
+    run_controls.pop(run_id, None)
+    waiting = result_cache.cancel(run_id)
+
+    cancelled = await PrismaModels.Run.prisma().update_many(
+        data={"status": RunStatus.CANCELLED, "completed_at": datetime.utcnow()},
+        where={"id": run_id, "status": RunStatus.CREATED},
+    )
+
+    if not cancelled and control is None:
+        raise RunNotCancellableError("Run cannot be cancelled by this server")
+
+    if waiting:
+        run = await PrismaModels.Run.prisma().find_unique(
+            where={"id": run_id},
+            include={"build": {"include": {"script": True}}, "params": True},
+        )
+        if run is not None and run.build is not None:
+            await requeue_waiting(waiting, run.build, stored_params(run))
+
+
+async def cancel_requested_runs():
+    """
+    Stop the runs of this server process cancelled through another one.
+    """
+
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={
+            "cancel_requested": True,
+            "status": {"in": ACTIVE_RUN_STATUSES},
+            "instance_id": INSTANCE_ID,
+        }
+    )
+
+    for run in runs:
+        control = run_controls.get(run.id)
+
+        if control is not None and not control.cancelled.is_set():
+            await cancel_run(run.id)
+
+
+async def maintain_cancels(interval: float):
+    """
+    Periodically stop the runs cancelled through other server processes.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await cancel_requested_runs()
+        except Exception as err:
+            logger.error(f"failed to cancel requested runs: {err}")
+
+
+async def reclaim_runs(live: List[str]):
+    """
+    Fail the runs that were running on server processes that have stopped, as
+    told by `live`. Their containers are reclaimed by the reaper. Runs on
+    Fargate carry on without the server.
+    """
+
+    count = await PrismaModels.Run.prisma().update_many(
+        data={
+            "status": RunStatus.FAILURE,
+            "output": "Run was interrupted by a server restart",
             "completed_at": datetime.utcnow(),
         },
-        where={"id": run.id},
+        where={"status": RunStatus.RUNNING, "task_arn": None, **unowned(live)},
     )
 
-    return run
+    if count:
+        logger.info(f"reclaimed {count} interrupted runs")
+
+
+async def claim_runs(status: RunStatus, live: List[str], **where: Any) -> int:
+    """
+    Take over the runs with a status of server processes that have stopped.
+    """
+
+    return await PrismaModels.Run.prisma().update_many(
+        data={"instance_id": INSTANCE_ID},
+        where={"status": status, **where, **unowned(live)},
+    )
+
+
+async def recover_fargate_runs(live: List[str]):
+    """
+    Watch the runs on Fargate that were in flight when the server processes
+    running them stopped.
+    """
+
+    await claim_runs(RunStatus.RUNNING, live, task_arn={"not": None})
+
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={
+            "status": RunStatus.RUNNING,
+            "task_arn": {"not": None},
+            "instance_id": INSTANCE_ID,
+        },
+        include={"build": True},
+    )
+
+    for run in runs:
+        assert run.build is not None and run.task_arn is not None
+
+        started = run.started_at or run.created_at
+        fargate_watcher.watch(
+            run.id, run.task_arn, run_timeout(run, run.build), started.timestamp()
+        )
+
+    if runs:
+        logger.info(f"recovered {len(runs)} runs on Fargate")
+
+
+def stored_params(run: PrismaModels.Run) -> Params:
+    # runs created before their params were kept with their types
+    if run.param_values is None:
+        return {param.key: param.value for param in run.params or []}
+
+    return cast(Params, run.param_values)
+
+
+async def recover_queue(live: List[str]):
+    """
+    Queue the runs that were still waiting for admission when the server
+    processes that created them stopped.
+    """
+
+    await claim_runs(RunStatus.CREATED, live)
+
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={"status": RunStatus.CREATED, "instance_id": INSTANCE_ID},
+        order={"created_at": "asc"},
+        include={
+            "batch": True,
+            "build": {"include": {"script": True}},
+            "inputs": True,
+            "params": True,
+        },
+    )
+
+    for run in runs:
+        if run.build is None:
+            continue
+
+        params = stored_params(run)
+
+        # identical runs wait on the first again, as before the restart
+        if run.build.cacheable and await from_cache(run, run.build, params):
+            continue
+
+        await enqueue(
+            [(run, params)],
+            run.build,
+            None if run.batch is None else run.batch.parallelism,
+        )
+
+    if runs:
+        logger.info(f"recovered {len(runs)} queued runs")
+
+
+async def start_executor():
+    """
+    Start the executor's background maintenance and resume queued runs.
+    """
+
+    for task in [
+        asyncio.create_task(
+            maintain(fleet, EXECUTOR_HEARTBEAT_INTERVAL, admission.admit)
+        ),
+        asyncio.create_task(maintain_outputs(RUN_OUTPUT_RETENTION / 10)),
+        asyncio.create_task(maintain_images(image_manager, IMAGE_MAINTAIN_INTERVAL)),
+        asyncio.create_task(fargate_watcher.supervise()),
+        asyncio.create_task(maintain_lease(INSTANCE_LEASE_TTL / 3)),
+        asyncio.create_task(maintain_cancels(RUN_CANCEL_POLL_INTERVAL)),
+    ]:
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    # what other processes left behind is only reclaimed once their lease has
+    # expired, so that several servers can share a database and executors
+    await renew_lease()
+    live = await live_instances()
+
+    await reclaim_runs(live)
+    await asyncio.get_running_loop().run_in_executor(None, fleet.reap, live)
+    await recover_queue(live)
+    await recover_fargate_runs(live)
+
+
+async def shutdown_executor():
+    """
+    Stop the executor pool. Runs still in flight are left for the next startup.
+    """
+
+    for task in list(background_tasks):
+        task.cancel()
+
+    admission.shutdown()
+    executor_pool.shutdown(wait=False)
+    fleet.shutdown()
+
+    try:
+        await end_lease()
+    except Exception as err:
+        logger.error(f"failed to end instance lease: {err}")
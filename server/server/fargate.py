@@ -0,0 +1,493 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import boto3
+from prisma import models as PrismaModels
+from prisma.enums import RunStatus
+
+from config import (
+    AWS_REGION,
+    FARGATE_CLUSTER,
+    FARGATE_EXECUTION_ROLE,
+    FARGATE_LOG_GROUP,
+    FARGATE_POLL_MAX_INTERVAL,
+    FARGATE_POLL_MIN_INTERVAL,
+    FARGATE_SECURITY_GROUPS,
+    FARGATE_SUBNETS,
+)
+from utils.logger import logger
+
+# name of the container in village task definitions
+CONTAINER_NAME = "village"
+
+# cpu units and the memory sizes in megabytes Fargate allows with them
+FARGATE_SIZES: List[Tuple[int, List[int]]] = [
+    (256, [512, 1024, 2048]),
+    (512, list(range(1024, 4096 + 1, 1024))),
+    (1024, list(range(2048, 8192 + 1, 1024))),
+    (2048, list(range(4096, 16384 + 1, 1024))),
+    (4096, list(range(8192, 30720 + 1, 1024))),
+]
+
+# ECS rejects a run whose overrides are larger than this
+MAX_OVERRIDE_BYTES = 8192
+
+# most tasks ECS describes in one call
+DESCRIBE_TASKS_BATCH = 100
+
+# times the log of a stopped task is read again when it is still empty, as its
+# last lines can reach CloudWatch after the task is reported stopped
+LOG_READ_ATTEMPTS = 3
+
+
+class FargateError(Exception):
+    """
+    A task could not be started on Fargate.
+    """
+
+
+def fargate_size(cpu: float, memory: int) -> Tuple[int, int]:
+    """
+    Smallest Fargate task size with at least `cpu` cores and `memory` megabytes.
+    """
+
+    for units, memories in FARGATE_SIZES:
+        if units < cpu * 1024:
+            continue
+
+        for size in memories:
+            if size >= memory:
+                return units, size
+
+    raise FargateError(f"No Fargate task has {cpu} cpus and {memory} MB of memory")
+
+
+class FargateRunner:
+    """
+    Runs build images as tasks on one long-lived ECS cluster.
+
+    The cluster and log group are created on first use, and a task definition
+    is registered once per image and size. Both are cached, so starting a run
+    is a single RunTask call with its params as a container override.
+    """
+
+    def __init__(
+        self,
+        ecs: Any,
+        cluster: str,
+        subnets: List[str],
+        security_groups: List[str],
+        execution_role: Optional[str],
+        log_group: str,
+        region: str,
+    ):
+        self.ecs = ecs
+        self.cluster = cluster
+        self.subnets = subnets
+        self.security_groups = security_groups
+        self.execution_role = execution_role
+        self.log_group = log_group
+        self.region = region
+
+        self._cluster_arn: Optional[str] = None
+        # (image uri, cpu units, memory) -> task definition arn
+        self._task_definitions: Dict[Tuple[str, int, int], str] = {}
+        self._lock = threading.Lock()
+
+    def cluster_arn(self) -> str:
+        """
+        Create the cluster if it does not exist. Blocks.
+        """
+
+        with self._lock:
+            if self._cluster_arn is None:
+                # creating a cluster that exists returns it
+                res = self.ecs.create_cluster(clusterName=self.cluster)
+                self._cluster_arn = res["cluster"]["clusterArn"]
+
+            return self._cluster_arn
+
+    def task_definition(self, image_uri: str, cpu: float, memory: int) -> str:
+        """
+        Task definition running an image with at least the given resources,
+        registered on first use. Blocks.
+        """
+
+        units, size = fargate_size(cpu, memory)
+        key = (image_uri, units, size)
+
+        with self._lock:
+            arn = self._task_definitions.get(key)
+            if arn is not None:
+                return arn
+
+        digest = hashlib.sha256(image_uri.encode("utf-8")).hexdigest()[:16]
+        family = f"village-{digest}-{units}-{size}"
+
+        # registered before a restart
+        try:
+            res = self.ecs.describe_task_definition(taskDefinition=family)
+            arn = res["taskDefinition"]["taskDefinitionArn"]
+        except self.ecs.exceptions.ClientException:
+            arn = self._register(family, image_uri, units, size)
+
+        with self._lock:
+            self._task_definitions[key] = arn
+
+        return arn
+
+    def _register(self, family: str, image_uri: str, cpu: int, memory: int) -> str:
+        logger.info(f"registering task definition {family} for {image_uri}")
+
+        definition: Dict[str, Any] = {
+            "family": family,
+            "networkMode": "awsvpc",
+            "requiresCompatibilities": ["FARGATE"],
+            "cpu": str(cpu),
+            "memory": str(memory),
+            "runtimePlatform": {
+                "cpuArchitecture": "ARM64",
+                "operatingSystemFamily": "LINUX",
+            },
+            "containerDefinitions": [
+                {
+                    "name": CONTAINER_NAME,
+                    "image": image_uri,
+                    "memory": memory,
+                    "essential": True,
+                    "logConfiguration": {
+                        "logDriver": "awslogs",
+                        "options": {
+                            "awslogs-group": self.log_group,
+                            "awslogs-region": self.region,
+                            "awslogs-stream-prefix": "village",
+                            "awslogs-create-group": "true",
+                        },
+                    },
+                }
+            ],
+        }
+
+        if self.execution_role is not None:
+            definition["executionRoleArn"] = self.execution_role
+
+        res = self.ecs.register_task_definition(**definition)
+
+        return res["taskDefinition"]["taskDefinitionArn"]
+
+    def run(
+        self,
+        image_uri: str,
+        cpu: float,
+        memory: int,
+        command: List[str],
+        run_id: str,
+    ) -> str:
+        """
+        Start a task running `command` in an image. Returns the task's arn.
+        Blocks.
+        """
+
+        overrides = {
+            "containerOverrides": [{"name": CONTAINER_NAME, "command": command}]
+        }
+
+        if len(json.dumps(overrides)) > MAX_OVERRIDE_BYTES:
+            raise FargateError("Params are too large to run on Fargate")
+
+        res = self.ecs.run_task(
+            cluster=self.cluster_arn(),
+            taskDefinition=self.task_definition(image_uri, cpu, memory),
+            launchType="FARGATE",
+            count=1,
+            networkConfiguration={
+                "awsvpcConfiguration": {
+                    "subnets": self.subnets,
+                    "securityGroups": self.security_groups,
+                    "assignPublicIp": "ENABLED",
+                }
+            },
+            overrides=overrides,
+            startedBy=run_id[:36],
+        )
+
+        if res.get("failures") or not res.get("tasks"):
+            reasons = ", ".join(x.get("reason", "") for x in res.get("failures", []))
+            raise FargateError(f"Task did not start: {reasons}")
+
+        return res["tasks"][0]["taskArn"]
+
+    def log_stream(self, task_arn: str) -> str:
+        """
+        Log stream a task's output goes to.
+        """
+
+        task_id = task_arn.split("/")[-1]
+
+        return f"village/{CONTAINER_NAME}/{task_id}"
+
+    def describe(self, task_arns: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Describe up to DESCRIBE_TASKS_BATCH tasks, `None` for those ECS no
+        longer knows. Blocks.
+        """
+
+        res = self.ecs.describe_tasks(cluster=self.cluster_arn(), tasks=task_arns)
+        tasks: Dict[str, Optional[Dict[str, Any]]] = {x: None for x in task_arns}
+
+        for task in res["tasks"]:
+            tasks[task["taskArn"]] = task
+
+        return tasks
+
+    def stop(self, task_arn: str, reason: str):
+        """
+        Stop a task. Blocks.
+        """
+
+        self.ecs.stop_task(cluster=self.cluster_arn(), task=task_arn, reason=reason)
+
+    def read_log(self, logs: Any, task_arn: str) -> List[str]:
+        """
+        Every line a task logged. Blocks.
+        """
+
+        lines: List[str] = []
+        token: Optional[str] = None
+
+        while True:
+            kwargs: Dict[str, Any] = {
+                "logGroupName": self.log_group,
+                "logStreamName": self.log_stream(task_arn),
+                "startFromHead": True,
+            }
+            if token is not None:
+                kwargs["nextToken"] = token
+
+            try:
+                res = logs.get_log_events(**kwargs)
+            except logs.exceptions.ResourceNotFoundException:
+                # the task stopped before its container started
+                return lines
+
+            lines.extend(x["message"] for x in res["events"])
+
+            # the last page returns the token it was asked for
+            if not res["events"] or res.get("nextForwardToken") == token:
+                return lines
+
+            token = res.get("nextForwardToken")
+
+
+@dataclass
+class FargateRun:
+    run_id: str
+    task_arn: str
+    timeout: float
+    # when the run times out, and when its task is next checked
+    deadline: float
+    next_check: float
+    interval: float
+    log_reads: int = 0
+
+
+def run_result(run_id: str, lines: List[str]) -> Optional[str]:
+    """
+    The result line the shim prints with a run's id, if the run logged it.
+    """
+
+    for line in reversed(lines):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+
+        if isinstance(message, dict) and message.get("uuid") == run_id:
+            return line
+
+    return None
+
+
+class FargateWatcher:
+    """
+    Supervises every run in flight on Fargate from a single loop.
+
+    Due tasks are described in batches, and each is checked less often the
+    longer it runs. The log of a task is read once it stops, finding its
+    result by run id, and the run is updated. Runs past their timeout have
+    their task stopped.
+    """
+
+    def __init__(
+        self,
+        runner: FargateRunner,
+        logs: Any,
+        min_interval: float,
+        max_interval: float,
+    ):
+        self.runner = runner
+        self.logs = logs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        # task arn -> run
+        self.runs: Dict[str, FargateRun] = {}
+        # created on the event loop by supervise
+        self._wake: Optional[asyncio.Event] = None
+
+    def watch(self, run_id: str, task_arn: str, timeout: float, started: float):
+        now = time.time()
+
+        self.runs[task_arn] = FargateRun(
+            run_id=run_id,
+            task_arn=task_arn,
+            timeout=timeout,
+            deadline=started + timeout,
+            next_check=now + self.min_interval,
+            interval=self.min_interval,
+        )
+
+        if self._wake is not None:
+            self._wake.set()
+
+    async def supervise(self):
+        self._wake = asyncio.Event()
+
+        while True:
+            try:
+                await self.check()
+            except Exception as err:
+                logger.error(f"failed to check runs on Fargate: {err}")
+
+            delay = self.max_interval
+            if self.runs:
+                next_check = min(x.next_check for x in self.runs.values())
+                delay = max(0, min(delay, next_check - time.time()))
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def check(self):
+        """
+        Check the runs that are due and finish those whose tasks stopped.
+        """
+
+        loop = asyncio.get_running_loop()
+        now = time.time()
+        due = [x for x in self.runs.values() if x.next_check <= now]
+
+        for offset in range(0, len(due), DESCRIBE_TASKS_BATCH):
+            batch = due[offset : offset + DESCRIBE_TASKS_BATCH]
+            tasks = await loop.run_in_executor(
+                None, self.runner.describe, [x.task_arn for x in batch]
+            )
+
+            await asyncio.gather(
+                *(self._check(run, tasks[run.task_arn], now) for run in batch)
+            )
+
+    async def _check(self, run: FargateRun, task: Optional[Dict[str, Any]], now: float):
+        loop = asyncio.get_running_loop()
+
+        try:
+            if task is None or task["lastStatus"] == "STOPPED":
+                await self._finish(run, task)
+
+            elif now >= run.deadline:
+                await loop.run_in_executor(
+                    None, self.runner.stop, run.task_arn, "Run timed out"
+                )
+                await self._complete(
+                    run,
+                    RunStatus.TIMED_OUT,
+                    f"Run timed out after {run.timeout} seconds",
+                )
+
+            else:
+                run.interval = min(run.interval * 2, self.max_interval)
+                run.next_check = min(now + run.interval, run.deadline)
+        except Exception as err:
+            logger.error(f"failed to check run {run.run_id}: {err}")
+            run.next_check = now + run.interval
+
+    async def _finish(self, run: FargateRun, task: Optional[Dict[str, Any]]):
+        loop = asyncio.get_running_loop()
+        lines = await loop.run_in_executor(
+            None, self.runner.read_log, self.logs, run.task_arn
+        )
+        result = run_result(run.run_id, lines)
+
+        run.log_reads += 1
+        if result is None and not lines and run.log_reads < LOG_READ_ATTEMPTS:
+            run.next_check = time.time() + self.min_interval
+            return
+
+        containers = [] if task is None else task.get("containers", [])
+        exit_code = containers[0].get("exitCode") if containers else None
+
+        if result is not None:
+            await self._complete(run, RunStatus.SUCCESS, result)
+        elif exit_code == 0:
+            # the node shim prints its result without the run id
+            await self._complete(run, RunStatus.SUCCESS, "\n".join(lines))
+        else:
+            reason = "Task not found" if task is None else task.get("stoppedReason")
+            output = "\n".join(lines + [f"Task stopped: {reason}"])
+            await self._complete(run, RunStatus.FAILURE, output)
+
+    async def cancel(self, run_id: str, task_arn: str):
+        """
+        Stop the task of a run and mark the run cancelled, whichever server
+        process is watching it.
+        """
+
+        self.runs.pop(task_arn, None)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.runner.stop, task_arn, "Run cancelled")
+
+        await complete_fargate_run(run_id, RunStatus.CANCELLED, "Run was cancelled")
+
+    async def _complete(self, run: FargateRun, status: RunStatus, output: str):
+        await complete_fargate_run(run.run_id, status, output)
+
+        self.runs.pop(run.task_arn, None)
+
+
+async def complete_fargate_run(run_id: str, status: RunStatus, output: str):
+    """
+    Finish a run on Fargate, unless it has already finished, so that a run
+    cancelled from one process is not overwritten by the process watching it.
+    """
+
+    await PrismaModels.Run.prisma().update_many(
+        data={"status": status, "output": output, "completed_at": datetime.utcnow()},
+        where={"id": run_id, "status": RunStatus.RUNNING},
+    )
+
+
+fargate_runner = FargateRunner(
+    boto3.client("ecs", region_name=AWS_REGION),
+    cluster=FARGATE_CLUSTER,
+    subnets=FARGATE_SUBNETS,
+    security_groups=FARGATE_SECURITY_GROUPS,
+    execution_role=FARGATE_EXECUTION_ROLE,
+    log_group=FARGATE_LOG_GROUP,
+    region=AWS_REGION,
+)
+
+fargate_watcher = FargateWatcher(
+    fargate_runner,
+    boto3.client("logs", region_name=AWS_REGION),
+    min_interval=FARGATE_POLL_MIN_INTERVAL,
+    max_interval=FARGATE_POLL_MAX_INTERVAL,
+)
@@ -0,0 +1,197 @@
+import asyncio
+import time
+from typing import Any, Callable, Collection, Dict, Optional, Set
+
+import docker  # type: ignore
+
+from config import (
+    EXECUTOR_CPU,
+    EXECUTOR_MEMORY,
+    WARM_POOL_IDLE_TTL,
+    WARM_POOL_MAX_BUILDS,
+    WARM_POOL_MAX_SIZE,
+    WARM_POOL_MIN_SIZE,
+)
+from server.pool import ContainerPool
+from server.resources import Capacity, Resources, host_capacity
+from utils.logger import logger
+
+
+class ExecutorHost:
+    """
+    A docker daemon that runs containers, with its own warm pool.
+    """
+
+    def __init__(self, endpoint: str, client: Any):
+        self.endpoint = endpoint
+        self.client = client
+        self.capacity = Capacity(Resources(cpu=0, memory=0))
+        self.pool = ContainerPool(
+            client,
+            self.capacity,
+            min_size=WARM_POOL_MIN_SIZE,
+            max_size=WARM_POOL_MAX_SIZE,
+            idle_ttl=WARM_POOL_IDLE_TTL,
+            max_builds=WARM_POOL_MAX_BUILDS,
+        )
+
+        # build ids whose images are present on the host
+        self.images: Set[str] = set()
+        self.healthy = False
+        self.last_heartbeat: Optional[float] = None
+
+    def heartbeat(self):
+        """
+        Refresh the capacity of the host and the images present on it. Blocks.
+        """
+
+        self.capacity.total = host_capacity(self.client, EXECUTOR_CPU, EXECUTOR_MEMORY)
+        self.images = {
+            tag.split(":")[0]
+            for image in self.client.images.list()  # type: ignore
+            for tag in image.tags
+        }
+        self.healthy = True
+        self.last_heartbeat = time.monotonic()
+
+    def slack(self, request: Resources) -> float:
+        """
+        Largest fraction of the host's cpu or memory left free after placing a
+        run on it.
+        """
+
+        free = self.capacity.free()
+        total = self.capacity.total
+
+        return max(
+            (free.cpu - request.cpu) / total.cpu if total.cpu else 0,
+            (free.memory - request.memory) / total.memory if total.memory else 0,
+        )
+
+    def ensure_image(self, build_id: str, source: Any) -> bool:
+        """
+        Copy a build's image from the daemon that built it, if the host does
+        not have it yet. Returns whether it had. Blocks.
+        """
+
+        if build_id in self.images:
+            return True
+
+        hit = True
+
+        try:
+            self.client.images.get(build_id)  # type: ignore
+        except docker.errors.ImageNotFound:  # type: ignore
+            hit = False
+            logger.info(f"copying image {build_id} to {self.endpoint}")
+            image = source.images.get(build_id)  # type: ignore
+            # an image shared by several builds has several tags, and a saved
+            # image keeps none of them, so tag it with the one it is run by
+            loaded = self.client.images.load(image.save())  # type: ignore
+            loaded[0].tag(build_id)
+
+        self.images.add(build_id)
+
+        return hit
+
+
+class Fleet:
+    """
+    The executor hosts that runs can be placed on.
+    """
+
+    def __init__(self):
+        self.hosts: Dict[str, ExecutorHost] = {}
+
+    def register(self, endpoint: str, client: Any) -> ExecutorHost:
+        host = ExecutorHost(endpoint, client)
+        self.hosts[endpoint] = host
+
+        try:
+            host.heartbeat()
+        except Exception as err:
+            logger.error(f"executor {endpoint} is unreachable: {err}")
+
+        return host
+
+    def largest(self) -> Optional[Resources]:
+        """
+        The most cpu and memory a single run could be given, or None if no host
+        has reported its capacity yet.
+        """
+
+        reported = [
+            x.capacity.total
+            for x in self.hosts.values()
+            if x.last_heartbeat is not None
+        ]
+
+        if not reported:
+            return None
+
+        return Resources(
+            cpu=max(x.cpu for x in reported),
+            memory=max(x.memory for x in reported),
+        )
+
+    def place(self, request: Resources, image: str) -> Optional[ExecutorHost]:
+        """
+        Pick a healthy host with room for a run. Runs are bin-packed: among
+        the hosts that already have the run's image, or all of them if none
+        does, the run goes where it leaves the least free, so that other hosts
+        stay free for large runs.
+        """
+
+        candidates = [
+            x for x in self.hosts.values() if x.healthy and x.capacity.fits(request)
+        ]
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda x: (image not in x.images, x.slack(request)))
+
+    def heartbeat(self):
+        for host in self.hosts.values():
+            try:
+                host.heartbeat()
+            except Exception as err:
+                if host.healthy:
+                    logger.error(f"executor {host.endpoint} is unreachable: {err}")
+                host.healthy = False
+
+    def sweep(self):
+        for host in self.hosts.values():
+            if host.healthy:
+                host.pool.sweep()
+
+    def reap(self, live: Optional[Collection[str]] = None):
+        for host in self.hosts.values():
+            if not host.healthy:
+                continue
+
+            try:
+                host.pool.reap(live)
+            except docker.errors.DockerException as err:  # type: ignore
+                logger.error(f"failed to reap containers on {host.endpoint}: {err}")
+
+    def shutdown(self):
+        for host in self.hosts.values():
+            host.pool.shutdown()
+
+
+async def maintain(fleet: Fleet, interval: float, admit: Callable[[], None]):
+    """
+    Periodically check on the executor hosts, expire idle containers and
+    remove finished ones. `admit` is called after each heartbeat, so runs
+    waiting for a host start once it is back.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, fleet.heartbeat)
+        admit()
+        await loop.run_in_executor(None, fleet.sweep)
+        await loop.run_in_executor(None, fleet.reap)
@@ -0,0 +1,248 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import docker  # type: ignore
+from prisma import models as PrismaModels
+from prisma import types as PrismaTypes
+from prisma.enums import BuildStatus, Engine
+from pydantic import BaseModel
+
+from server.fleet import Fleet
+from server.output import ACTIVE_RUN_STATUSES
+from utils.logger import logger
+
+# label on build images, holding the id of the build that built them
+BUILD_IMAGE_LABEL = "village.build"
+
+
+def base_image(engine: Engine, engine_version: str) -> str:
+    """
+    Image a script is built on when its config does not name one.
+    """
+
+    if engine == Engine.Python:
+        return f"python:{engine_version}-alpine"
+
+    elif engine == Engine.Node:
+        return f"node:{engine_version}-alpine"
+
+    raise ValueError(f"Unsupported engine: {engine}")
+
+
+class DaemonImages(BaseModel):
+    """
+    Build images on a docker daemon
+    """
+
+    name: str
+    images: int
+    # apparent size, counting layers shared between images once per image
+    size: int
+
+
+class ImageStats(BaseModel):
+    """
+    Build image cache metrics
+    """
+
+    daemons: List[DaemonImages]
+    budget: int
+    base_images: List[str]
+    hits: int
+    misses: int
+    evictions: int
+    evicted_bytes: int
+    hit_rate: float
+
+
+class ImageManager:
+    """
+    Keeps the base images in use pulled ahead of builds and runs, and keeps
+    the build images on each docker daemon within `budget` bytes.
+
+    Over budget, the least recently used images are removed first, never those
+    of the latest successful build of a script or of a build with runs to do.
+    """
+
+    def __init__(self, fleet: Fleet, builder: Any, budget: int):
+        self.fleet = fleet
+        self.builder = builder
+        self.budget = budget
+
+        # build id -> when a run or build last used its image
+        self.last_used: Dict[str, float] = {}
+        self.base_images: Set[str] = set()
+        self.sizes: Dict[str, DaemonImages] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def record(self, build_id: str, hit: Optional[bool] = None):
+        """
+        Record a use of a build's image, and whether a run found it on its host.
+        """
+
+        self.last_used[build_id] = time.time()
+
+        if hit is True:
+            self.hits += 1
+        elif hit is False:
+            self.misses += 1
+
+    def daemons(self) -> List[Tuple[str, Any]]:
+        daemons = [
+            (x.endpoint, x.client) for x in self.fleet.hosts.values() if x.healthy
+        ]
+
+        if all(client is not self.builder for _, client in daemons):
+            daemons.append(("builder", self.builder))
+
+        return daemons
+
+    def prewarm(self, images: Set[str]):
+        """
+        Pull the base images not yet on each daemon. Blocks.
+        """
+
+        for name, client in self.daemons():
+            for image in images:
+                try:
+                    client.images.get(image)  # type: ignore
+                    continue
+                except docker.errors.ImageNotFound:  # type: ignore
+                    pass
+
+                logger.info(f"pulling {image} on {name}")
+
+                try:
+                    client.images.pull(image)  # type: ignore
+                except docker.errors.DockerException as err:  # type: ignore
+                    logger.error(f"failed to pull {image} on {name}: {err}")
+
+        self.base_images = images
+
+    def evict(self, protected: Set[str]):
+        """
+        Remove build images from each daemon over budget. Blocks.
+        """
+
+        for name, client in self.daemons():
+            try:
+                self._evict(name, client, protected)
+            except docker.errors.DockerException as err:  # type: ignore
+                logger.error(f"failed to evict images on {name}: {err}")
+
+    def _evict(self, name: str, client: Any, protected: Set[str]):
+        images = client.images.list(filters={"label": BUILD_IMAGE_LABEL})
+        size = sum(x.attrs["Size"] for x in images)
+
+        def build_ids(image: Any) -> Set[str]:
+            return {tag.split(":")[0] for tag in image.tags}
+
+        candidates = sorted(
+            (x for x in images if not build_ids(x) & protected),
+            key=lambda x: (
+                max((self.last_used.get(y, 0) for y in build_ids(x)), default=0),
+                x.attrs["Created"],
+            ),
+        )
+
+        for image in candidates:
+            if size <= self.budget:
+                break
+
+            try:
+                # an image shared by several builds is removed with all its tags
+                client.images.remove(image.id, force=True)  # type: ignore
+            except docker.errors.APIError as err:  # type: ignore
+                logger.info(f"not evicting image {image.id} on {name}: {err}")
+                continue
+
+            logger.info(f"evicted image {image.id} from {name}")
+            images.remove(image)
+            size -= image.attrs["Size"]
+            self.evictions += 1
+            self.evicted_bytes += image.attrs["Size"]
+
+            host = self.fleet.hosts.get(name)
+            if host is not None:
+                host.images -= build_ids(image)
+
+        self.sizes[name] = DaemonImages(name=name, images=len(images), size=size)
+
+    def stats(self) -> ImageStats:
+        lookups = self.hits + self.misses
+
+        return ImageStats(
+            daemons=list(self.sizes.values()),
+            budget=self.budget,
+            base_images=sorted(self.base_images),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            evicted_bytes=self.evicted_bytes,
+            hit_rate=self.hits / lookups if lookups else 0,
+        )
+
+
+async def base_images_in_use() -> Set[str]:
+    scripts = await PrismaModels.Script.prisma().find_many()
+
+    return {base_image(x.engine, x.engine_version) for x in scripts}
+
+
+# a script runs the successful build that finished last
+LATEST_BUILD_ORDER: PrismaTypes.BuildOrderByInput = {"updated_at": "desc"}
+
+
+async def protected_builds() -> Set[str]:
+    """
+    Builds whose images are kept: the latest successful build of each script,
+    and builds still building or with runs to do.
+    """
+
+    scripts = await PrismaModels.Script.prisma().find_many(
+        include={
+            "builds": {
+                "where": {"status": BuildStatus.SUCCESS},
+                "order_by": LATEST_BUILD_ORDER,
+                "take": 1,
+            }
+        }
+    )
+    building = await PrismaModels.Build.prisma().find_many(
+        where={"status": {"in": [BuildStatus.CREATED, BuildStatus.BUILDING]}}
+    )
+    runs = await PrismaModels.Run.prisma().find_many(
+        where={"status": {"in": ACTIVE_RUN_STATUSES}}
+    )
+
+    return (
+        {build.id for script in scripts for build in script.builds or []}
+        | {build.id for build in building}
+        | {run.build_id for run in runs}
+    )
+
+
+async def maintain_images(manager: ImageManager, interval: float):
+    """
+    Pull the base images in use, then periodically again along with evicting
+    build images.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        try:
+            images = await base_images_in_use()
+            await loop.run_in_executor(None, manager.prewarm, images)
+
+            protected = await protected_builds()
+            await loop.run_in_executor(None, manager.evict, protected)
+        except Exception as err:
+            logger.error(f"failed to maintain images: {err}")
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,70 @@
+import asyncio
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+from prisma import models as PrismaModels
+from prisma.enums import ParamType
+
+from config import RUN_INPUT_INLINE_BYTES
+from server.output import blob_store
+
+
+def split_inputs(
+    params: Dict[str, Any], spec: List[PrismaModels.Param]
+) -> Tuple[Dict[str, Any], Dict[str, bytes]]:
+    """
+    Separate bigstring params too large to send inline from the rest. Those are
+    sent to the container as raw bytes after the request.
+    """
+
+    bigstrings = {x.key for x in spec if x.type == ParamType.bigstring}
+    inline: Dict[str, Any] = {}
+    inputs: Dict[str, bytes] = {}
+
+    for key, value in params.items():
+        if key in bigstrings and isinstance(value, str):
+            data = value.encode("utf-8")
+            if len(data) >= RUN_INPUT_INLINE_BYTES:
+                inputs[key] = data
+                continue
+
+        inline[key] = value
+
+    return inline, inputs
+
+
+async def store_inputs(inputs: Dict[str, bytes]) -> List[Dict[str, Any]]:
+    """
+    Store the bigstring params of a run split from the rest in the blob store.
+    Returns the data to create the run's inputs with.
+    """
+
+    loop = asyncio.get_running_loop()
+    created = []
+
+    for key, data in inputs.items():
+        digest, size = await loop.run_in_executor(None, blob_store.put, data)
+        # passed to the script as a str, like a bigstring sent inline
+        created.append({"key": key, "blob": digest, "size": size, "text": True})
+
+    return created
+
+
+async def store_input_file(key: str, fileobj: BinaryIO) -> Dict[str, Any]:
+    """
+    Store an uploaded file in the blob store as it is read. Returns the data to
+    create the run's input with.
+    """
+
+    loop = asyncio.get_running_loop()
+    digest, size = await loop.run_in_executor(None, blob_store.put_file, fileobj)
+
+    return {"key": key, "blob": digest, "size": size}
+
+
+def input_params(run: PrismaModels.Run, params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Params of a run with its inputs stood in for by their digests, for keying
+    the result cache.
+    """
+
+    return {**params, **{x.key: {"blob": x.blob} for x in run.inputs or []}}
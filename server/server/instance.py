@@ -0,0 +1,72 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+from prisma import models as PrismaModels
+
+from config import INSTANCE_LEASE_TTL
+from utils.logger import logger
+
+# id of this server process. the runs it executes and the containers it starts
+# are recorded as its own, and reclaimed by a later process once its lease
+# has expired
+INSTANCE_ID = uuid.uuid4().hex
+
+
+async def renew_lease():
+    expires_at = datetime.utcnow() + timedelta(seconds=INSTANCE_LEASE_TTL)
+
+    await PrismaModels.Instance.prisma().upsert(
+        where={"id": INSTANCE_ID},
+        data={
+            "create": {"id": INSTANCE_ID, "expires_at": expires_at},
+            "update": {"expires_at": expires_at},
+        },
+    )
+
+
+async def end_lease():
+    """
+    Give up the lease, so that the next process reclaims what this one leaves
+    behind right away.
+    """
+
+    await PrismaModels.Instance.prisma().delete_many(where={"id": INSTANCE_ID})
+
+
+async def live_instances() -> List[str]:
+    """
+    Ids of the server processes holding a lease, this one included. Leases
+    that have expired are removed.
+    """
+
+    now = datetime.utcnow()
+
+    await PrismaModels.Instance.prisma().delete_many(where={"expires_at": {"lt": now}})
+    instances = await PrismaModels.Instance.prisma().find_many()
+
+    return [x.id for x in instances]
+
+
+def unowned(live: List[str]):
+    """
+    Filter for runs of no live server process.
+    """
+
+    return {"OR": [{"instance_id": None}, {"instance_id": {"not_in": live}}]}
+
+
+async def maintain_lease(interval: float):
+    """
+    Periodically renew the lease, so that other processes leave this one's runs
+    and containers alone.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await renew_lease()
+        except Exception as err:
+            logger.error(f"failed to renew instance lease: {err}")
@@ -0,0 +1,269 @@
+import asyncio
+import codecs
+import io
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional, Tuple
+
+from prisma import models as PrismaModels
+from prisma.enums import RunStatus
+
+from config import (
+    RUN_OUTPUT_BLOB_DIR,
+    RUN_OUTPUT_BLOB_THRESHOLD,
+    RUN_OUTPUT_FLUSH_BYTES,
+    RUN_OUTPUT_FLUSH_INTERVAL,
+    RUN_OUTPUT_RETENTION,
+)
+from server.blobs import BlobStore
+from server.segments import SegmentEvents, SegmentWriter, tail_segments
+from utils.logger import logger
+
+ACTIVE_RUN_STATUSES = [RunStatus.CREATED, RunStatus.RUNNING]
+
+# outputs of finished runs above the threshold, and large run inputs
+blob_store = BlobStore(RUN_OUTPUT_BLOB_DIR)
+
+# set whenever new output for a run is stored
+output_events = SegmentEvents()
+
+# chunks of run output read from the database at once when it is compacted
+OUTPUT_PAGE_SIZE = 500
+
+
+async def append_output(run_id: str, seq: int, data: str):
+    """
+    Store a chunk of run output and wake anyone tailing the run.
+    """
+
+    await PrismaModels.RunOutput.prisma().create(
+        {"run_id": run_id, "seq": seq, "data": data}
+    )
+
+    output_events.notify(run_id)
+
+
+async def read_output(run_id: str) -> str:
+    """
+    Read the stored output of a run.
+    """
+
+    chunks = await PrismaModels.RunOutput.prisma().find_many(
+        where={"run_id": run_id}, order={"seq": "asc"}
+    )
+
+    return "".join(chunk.data for chunk in chunks)
+
+
+async def output_pages(run_id: str) -> AsyncIterator[bytes]:
+    """
+    Read the stored output of a run a page of chunks at a time.
+    """
+
+    after = -1
+
+    while True:
+        chunks = await PrismaModels.RunOutput.prisma().find_many(
+            where={"run_id": run_id, "seq": {"gt": after}},
+            order={"seq": "asc"},
+            take=OUTPUT_PAGE_SIZE,
+        )
+        if not chunks:
+            return
+
+        after = chunks[-1].seq
+        yield "".join(chunk.data for chunk in chunks).encode("utf-8")
+
+
+class PageReader(io.RawIOBase):
+    """
+    File of the pages left in an iterator, read from another thread while the
+    event loop fetches them.
+    """
+
+    def __init__(
+        self,
+        pages: AsyncIterator[bytes],
+        head: bytes,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.pages = pages
+        self.loop = loop
+        self._buffer = bytearray(head)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if not self._buffer:
+            future = asyncio.run_coroutine_threadsafe(
+                self.pages.__anext__(), self.loop  # type: ignore
+            )
+            try:
+                self._buffer += future.result()
+            except StopAsyncIteration:
+                return 0
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        del self._buffer[:size]
+
+        return size
+
+
+async def compact_output(run_id: str):
+    """
+    Store the output of a finished run on the run itself, or in the blob store
+    if it is large. Large outputs are streamed into the blob store rather than
+    read whole. The chunks it was streamed in are expired later, once anyone
+    tailing the run has caught up.
+    """
+
+    pages = output_pages(run_id)
+    head = bytearray()
+
+    async for page in pages:
+        head += page
+        if len(head) >= RUN_OUTPUT_BLOB_THRESHOLD:
+            break
+    else:
+        await PrismaModels.Run.prisma().update(
+            {"output": head.decode("utf-8"), "output_size": len(head)},
+            where={"id": run_id},
+        )
+        return
+
+    loop = asyncio.get_running_loop()
+    reader = io.BufferedReader(PageReader(pages, bytes(head), loop))
+    digest, size = await loop.run_in_executor(None, blob_store.put_file, reader)
+
+    await PrismaModels.Run.prisma().update(
+        {"output": "", "output_blob": digest, "output_size": size},
+        where={"id": run_id},
+    )
+
+
+async def read_output_range(run: PrismaModels.Run, start: int, end: int) -> bytes:
+    """
+    Read bytes `start` to `end` of a run's output, or to its end if `end` is
+    negative.
+    """
+
+    if run.output_blob is not None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, blob_store.read, run.output_blob, start, end
+        )
+
+    output = run.output or await read_output(run.id)
+    data = output.encode("utf-8")
+
+    return data[start:] if end < 0 else data[start:end]
+
+
+async def expire_outputs():
+    """
+    Delete the chunks of runs that finished more than RUN_OUTPUT_RETENTION
+    seconds ago, and the blobs no run output or input refers to anymore.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(seconds=RUN_OUTPUT_RETENTION)
+
+    await PrismaModels.RunOutput.prisma().delete_many(
+        where={
+            "run": {
+                "is": {
+                    "status": {"not_in": ACTIVE_RUN_STATUSES},
+                    "completed_at": {"lt": cutoff},
+                }
+            }
+        }
+    )
+
+    loop = asyncio.get_running_loop()
+    digests = await loop.run_in_executor(
+        None, lambda: list(blob_store.digests(RUN_OUTPUT_RETENTION))
+    )
+
+    for offset in range(0, len(digests), 1000):
+        batch = digests[offset : offset + 1000]
+        runs = await PrismaModels.Run.prisma().find_many(
+            where={"output_blob": {"in": batch}}
+        )
+        inputs = await PrismaModels.RunInput.prisma().find_many(
+            where={"blob": {"in": batch}}
+        )
+        referenced = {run.output_blob for run in runs} | {x.blob for x in inputs}
+
+        for digest in batch:
+            if digest not in referenced:
+                logger.info(f"deleting unreferenced output blob {digest}")
+                await loop.run_in_executor(None, blob_store.delete, digest)
+
+
+async def maintain_outputs(interval: float):
+    """
+    Periodically expire old output chunks and blobs.
+    """
+
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await expire_outputs()
+        except Exception as err:
+            logger.error(f"failed to expire run outputs: {err}")
+
+
+def tail_output(run_id: str, after: int = -1) -> AsyncIterator[PrismaModels.RunOutput]:
+    """
+    Yield the output chunks of a run after `after`, following the run until it
+    finishes.
+    """
+
+    async def chunks_after(after: int) -> List[PrismaModels.RunOutput]:
+        return await PrismaModels.RunOutput.prisma().find_many(
+            where={"run_id": run_id, "seq": {"gt": after}}, order={"seq": "asc"}
+        )
+
+    async def finished() -> bool:
+        run = await PrismaModels.Run.prisma().find_unique(where={"id": run_id})
+        return run is None or run.status not in ACTIVE_RUN_STATUSES
+
+    async def wait():
+        await output_events.wait(run_id, RUN_OUTPUT_FLUSH_INTERVAL * 2)
+
+    return tail_segments(chunks_after, finished, wait, after)
+
+
+class OutputWriter(SegmentWriter):
+    """
+    Buffers the output of a run and appends it to storage in batches, when
+    enough bytes are buffered or the oldest buffered byte is old enough.
+    """
+
+    def __init__(self, run_id: str, loop: asyncio.AbstractEventLoop):
+        super().__init__(loop, RUN_OUTPUT_FLUSH_BYTES, RUN_OUTPUT_FLUSH_INTERVAL)
+        self.run_id = run_id
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def item(self, data: bytes) -> Tuple[str, int]:
+        return self._decoder.decode(data), len(data)
+
+    async def store(self, seq: int, chunks: List[str]):
+        data = "".join(chunks)
+        if data:
+            await append_output(self.run_id, seq, data)
+
+    def close(self, error: Optional[str] = None):
+        """
+        Flush whatever is left, including a trailing partial character and an
+        optional error message. Blocks, so never call it on the event loop.
+        """
+
+        with self._lock:
+            self._buffer.append(self._decoder.decode(b"", final=True))
+            if error is not None:
+                self._buffer.append(error)
+
+        self.flush()
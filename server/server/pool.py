@@ -0,0 +1,337 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Collection, Dict, List, Optional, Set, Tuple
+
+import docker  # type: ignore
+from prisma.enums import Engine
+
+from server.instance import INSTANCE_ID
+from server.resources import Capacity, Resources
+from utils.logger import logger
+
+# containers started by the executor are labelled with the id of the server
+# process that started them, so that those left behind by an earlier process
+# can be told apart and reclaimed
+CONTAINER_LABEL = "village.executor"
+
+
+def shim_command(engine: Engine) -> List[str]:
+    """
+    Command for a container that imports the script once and then serves runs
+    sent to it on stdin.
+    """
+
+    if engine == Engine.Python:
+        return ["python3", "shim.py", "--serve", "--fork"]
+
+    elif engine == Engine.Node:
+        return ["node", "shim.js", "--serve"]
+
+    raise ValueError(f"Unsupported engine: {engine}")
+
+
+@dataclass
+class IdleContainer:
+    container: Any
+    resources: Resources
+    idle_since: float
+
+
+class ContainerPool:
+    """
+    Pre-started containers for recently run builds. Containers serve runs
+    through the shim's server mode and are reused across runs.
+
+    Each build keeps between `min_size` and `max_size` idle containers, growing
+    with the number of runs it has in flight. Containers idle for longer than
+    `idle_ttl` seconds are removed, and only the `max_builds` most recently
+    used builds are kept warm.
+
+    Idle containers hold their resources in the host's `capacity`. They are
+    only started into capacity no run has reserved, and are removed, least
+    recently used build first, when a run needs their share.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        capacity: Capacity,
+        min_size: int,
+        max_size: int,
+        idle_ttl: float,
+        max_builds: int,
+    ):
+        self.client = client
+        self.capacity = capacity
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.max_builds = max_builds
+
+        # build id -> idle containers, least recently used build first
+        self._idle: "OrderedDict[str, List[IdleContainer]]" = OrderedDict()
+        self._specs: Dict[str, Tuple[Engine, Resources]] = {}
+        self._busy: Dict[str, int] = {}
+        # ids of containers handed out by `acquire` and not yet released
+        self._in_use: Set[str] = set()
+        self._refilling: Set[str] = set()
+        self._lock = threading.Lock()
+        self._refill_pool = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="village-pool"
+        )
+
+    def start_container(
+        self, build_id: str, engine: Engine, resources: Resources
+    ) -> Any:
+        return self.client.containers.run(  # type: ignore
+            build_id,
+            shim_command(engine),
+            detach=True,
+            stdin_open=True,
+            labels={CONTAINER_LABEL: INSTANCE_ID},
+            **resources.container_options(),
+        )
+
+    def remove_container(self, container: Any):
+        try:
+            container.remove(force=True)
+        except docker.errors.APIError as err:  # type: ignore
+            logger.warning(f"failed to remove container {container.id}: {err}")
+
+    def remove_idle(self, entries: List[IdleContainer]):
+        for entry in entries:
+            self.capacity.release_idle(entry.resources)
+            self.remove_container(entry.container)
+
+    def make_room(self):
+        """
+        Remove idle containers, least recently used build first, until they
+        and the runs on the host fit on it.
+        """
+
+        while self.capacity.overcommitted():
+            with self._lock:
+                entry = None
+                for idle in self._idle.values():
+                    if idle:
+                        entry = idle.pop(0)
+                        break
+
+            if entry is None:
+                return
+
+            self.remove_idle([entry])
+
+    def acquire(self, build_id: str, engine: Engine, resources: Resources) -> Any:
+        """
+        Take a running container for a build, starting one if none are idle.
+        """
+
+        with self._lock:
+            self._specs[build_id] = (engine, resources)
+            self._busy[build_id] = self._busy.get(build_id, 0) + 1
+
+            idle = self._idle.setdefault(build_id, [])
+            self._idle.move_to_end(build_id)
+
+            evicted: List[IdleContainer] = []
+            while len(self._idle) > self.max_builds:
+                _, containers = self._idle.popitem(last=False)
+                evicted.extend(containers)
+
+        self.remove_idle(evicted)
+
+        container = None
+
+        while container is None:
+            with self._lock:
+                entry = idle.pop() if idle else None
+
+            if entry is None:
+                break
+
+            # the run's own reservation covers the container from here on
+            self.capacity.release_idle(entry.resources)
+
+            try:
+                entry.container.reload()
+            except docker.errors.NotFound:  # type: ignore
+                continue
+
+            if entry.container.status == "running":
+                container = entry.container
+            else:
+                self.remove_container(entry.container)
+
+        if container is None:
+            self.make_room()
+
+        self.refill(build_id)
+
+        if container is None:
+            try:
+                container = self.start_container(build_id, engine, resources)
+            except Exception:
+                self.release(build_id)
+                raise
+
+        with self._lock:
+            self._in_use.add(container.id)
+
+        return container
+
+    def release(
+        self, build_id: str, container: Optional[Any] = None, reuse: bool = True
+    ):
+        """
+        Mark a run dispatched by `acquire` as finished. A container that is
+        still healthy is returned to the pool for reuse; with `reuse` unset the
+        container is left for the caller to remove.
+        """
+
+        with self._lock:
+            self._busy[build_id] = max(self._busy.get(build_id, 0) - 1, 0)
+            if container is not None:
+                self._in_use.discard(container.id)
+
+            if not reuse:
+                return
+
+            idle = self._idle.get(build_id)
+            if container is not None and idle is not None:
+                if len(idle) < self.max_size:
+                    # taken over from the run, whose reservation is released
+                    # right after
+                    resources = self._specs[build_id][1]
+                    self.capacity.hold_idle(resources, force=True)
+                    idle.append(IdleContainer(container, resources, time.monotonic()))
+                    container = None
+
+        if container is not None:
+            self.remove_container(container)
+
+    def refill(self, build_id: str):
+        """
+        Top up the idle containers of a build in the background.
+        """
+
+        with self._lock:
+            if build_id in self._refilling:
+                return
+            self._refilling.add(build_id)
+
+        self._refill_pool.submit(self._refill, build_id)
+
+    def _refill(self, build_id: str):
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.get(build_id)
+                    target = min(
+                        self.max_size,
+                        max(self.min_size, self._busy.get(build_id, 0)),
+                    )
+                    if idle is None or len(idle) >= target:
+                        return
+                    engine, resources = self._specs[build_id]
+
+                # only what no run or other idle container holds is used
+                if not self.capacity.hold_idle(resources):
+                    return
+
+                try:
+                    container = self.start_container(build_id, engine, resources)
+                except Exception:
+                    self.capacity.release_idle(resources)
+                    raise
+
+                entry = IdleContainer(container, resources, time.monotonic())
+
+                with self._lock:
+                    # the build may have been evicted while the container started
+                    stale = self._idle.get(build_id) is not idle
+                    if not stale:
+                        idle.append(entry)
+
+                if stale:
+                    self.remove_idle([entry])
+                    return
+        except docker.errors.DockerException as err:  # type: ignore
+            logger.error(f"failed to refill warm pool for {build_id}: {err}")
+        finally:
+            with self._lock:
+                self._refilling.discard(build_id)
+
+    def sweep(self):
+        """
+        Remove containers that have been idle for longer than the TTL.
+        """
+
+        now = time.monotonic()
+        expired: List[IdleContainer] = []
+
+        with self._lock:
+            for build_id in list(self._idle):
+                idle = self._idle[build_id]
+                fresh = [x for x in idle if now - x.idle_since < self.idle_ttl]
+                expired.extend(x for x in idle if now - x.idle_since >= self.idle_ttl)
+                idle[:] = fresh
+
+                if not idle and not self._busy.get(build_id):
+                    del self._idle[build_id]
+                    self._busy.pop(build_id, None)
+
+        self.remove_idle(expired)
+
+    def reap(self, live: Optional[Collection[str]] = None):
+        """
+        Remove containers that have exited without being handed back. At
+        startup, `live` holds the ids of the server processes with a lease, and
+        the containers left behind by any other process are removed too.
+        Blocks.
+        """
+
+        containers = self.client.containers.list(  # type: ignore
+            all=True, filters={"label": CONTAINER_LABEL}
+        )
+
+        with self._lock:
+            in_use = set(self._in_use)
+
+        reaped: List[str] = []
+        for container in containers:
+            owner = container.labels.get(CONTAINER_LABEL)
+            orphaned = live is not None and owner not in live
+            finished = container.status in ("exited", "dead")
+
+            if orphaned or (finished and container.id not in in_use):
+                reaped.append(container.id)
+                self.remove_container(container)
+
+        if not reaped:
+            return
+
+        with self._lock:
+            for idle in self._idle.values():
+                for entry in idle:
+                    if entry.container.id in reaped:
+                        self.capacity.release_idle(entry.resources)
+                idle[:] = [x for x in idle if x.container.id not in reaped]
+
+        logger.info(f"reaped {len(reaped)} containers")
+
+    def shutdown(self):
+        """
+        Remove every idle container.
+        """
+
+        self._refill_pool.shutdown(wait=False)
+
+        with self._lock:
+            containers = [x for idle in self._idle.values() for x in idle]
+            self._idle.clear()
+
+        self.remove_idle(containers)
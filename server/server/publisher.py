@@ -0,0 +1,140 @@
+import base64
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import boto3
+import docker  # type: ignore
+import pulumi
+import pulumi_awsx as awsx
+from pulumi import automation as auto
+
+from config import AWS_REGION
+from server.build_logs import BuildLogWriter
+from server.docker import docker_client
+from utils.logger import logger
+
+PULUMI_PROJECT = "village_containers"
+PULUMI_STACK = "dev-build"
+
+# registry credentials are renewed this long before they expire
+AUTH_RENEW_MARGIN = timedelta(minutes=10)
+
+
+class PublishError(Exception):
+    """
+    An image could not be pushed to the registry.
+    """
+
+
+def registry_program():
+    repo = awsx.ecr.Repository("village-repo")
+
+    pulumi.export("repository_url", repo.url)
+
+
+class ImagePublisher:
+    """
+    Pushes build images to the ECR repository of a Pulumi stack.
+
+    The stack, which only owns the repository, is brought up once rather than
+    for every build. Images are then pushed straight from the daemon they were
+    built on, so builds are published as they finish, several at a time.
+    """
+
+    def __init__(self, builder: Any, ecr: Any, region: str):
+        self.builder = builder
+        self.ecr = ecr
+        self.region = region
+
+        self._repository_url: Optional[str] = None
+        self._auth: Optional[Dict[str, str]] = None
+        self._auth_expires = datetime.min.replace(tzinfo=timezone.utc)
+        self._lock = threading.Lock()
+
+    def repository_url(self) -> str:
+        """
+        Bring up the stack owning the repository if it is not up yet. Blocks.
+        """
+
+        with self._lock:
+            if self._repository_url is None:
+                stack = auto.create_or_select_stack(
+                    stack_name=PULUMI_STACK,
+                    project_name=PULUMI_PROJECT,
+                    program=registry_program,
+                )
+                stack.workspace.install_plugin("aws", "v4.0.0")
+                stack.set_config("aws:region", auto.ConfigValue(value=self.region))
+
+                res = stack.up(on_output=logger.info)
+                self._repository_url = res.outputs["repository_url"].value
+
+            return self._repository_url
+
+    def auth_config(self) -> Dict[str, str]:
+        """
+        Credentials for pushing to the registry. Blocks.
+        """
+
+        with self._lock:
+            now = datetime.now(timezone.utc)
+
+            if self._auth is None or now >= self._auth_expires - AUTH_RENEW_MARGIN:
+                res = self.ecr.get_authorization_token()
+                data = res["authorizationData"][0]
+                token = base64.b64decode(data["authorizationToken"]).decode("utf-8")
+                username, password = token.split(":", 1)
+
+                self._auth = {"username": username, "password": password}
+                self._auth_expires = data["expiresAt"]
+
+            return self._auth
+
+    def publish(self, build_id: str, log: BuildLogWriter) -> str:
+        """
+        Push the image of a build, logging as it goes. Returns its image uri.
+        Blocks.
+        """
+
+        repository = self.repository_url()
+        log.write(f"Pushing to {repository}\n")
+
+        image = self.builder.images.get(build_id)
+        image.tag(repository, tag=build_id)
+        digest: Optional[str] = None
+
+        try:
+            for chunk in self.builder.api.push(
+                repository,
+                tag=build_id,
+                auth_config=self.auth_config(),
+                stream=True,
+                decode=True,
+            ):
+                if "error" in chunk:
+                    raise PublishError(chunk["error"])
+
+                if "aux" in chunk:
+                    digest = chunk["aux"].get("Digest")
+
+                # layer progress is left out of the log
+                elif "progressDetail" not in chunk and chunk.get("status"):
+                    layer = chunk.get("id")
+                    status = chunk["status"]
+                    log.write(f"{layer}: {status}\n" if layer else f"{status}\n")
+        except docker.errors.APIError as err:  # type: ignore
+            raise PublishError(str(err)) from err
+        finally:
+            # the image stays tagged with the build id alone, for eviction
+            self.builder.images.remove(f"{repository}:{build_id}")
+
+        if digest is None:
+            return f"{repository}:{build_id}"
+
+        return f"{repository}@{digest}"
+
+
+image_publisher = ImagePublisher(
+    docker_client, boto3.client("ecr", region_name=AWS_REGION), AWS_REGION
+)
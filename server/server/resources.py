@@ -0,0 +1,122 @@
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from prisma import models as PrismaModels
+
+from config import RUN_DEFAULT_CPU, RUN_DEFAULT_MEMORY
+
+
+@dataclass(frozen=True)
+class Resources:
+    cpu: float  # cores
+    memory: int  # megabytes
+
+    def container_options(self) -> Dict[str, Any]:
+        """
+        Docker options that hold a container to these resources.
+        """
+
+        return {
+            "nano_cpus": int(self.cpu * 1e9),
+            "mem_limit": f"{self.memory}m",
+            # no swap beyond the memory limit
+            "memswap_limit": f"{self.memory}m",
+        }
+
+
+def build_resources(build: PrismaModels.Build) -> Resources:
+    """
+    Resources requested by a build, falling back to the defaults.
+    """
+
+    return Resources(
+        cpu=RUN_DEFAULT_CPU if build.cpu is None else build.cpu,
+        memory=RUN_DEFAULT_MEMORY if build.memory is None else build.memory,
+    )
+
+
+class Capacity:
+    """
+    Resources of a docker host, how much of them runs have reserved, and how
+    much the idle containers of its warm pool hold.
+
+    Runs are admitted against what other runs have reserved, as idle
+    containers make way for them; idle containers are only started into what
+    is left. Together they never hold more than the host has, so the host is
+    not overcommitted. Used from the event loop and from pool threads.
+    """
+
+    def __init__(self, total: Resources):
+        self.total = total
+        self.reserved = Resources(cpu=0, memory=0)
+        self.idle = Resources(cpu=0, memory=0)
+        self._lock = threading.Lock()
+
+    def free(self) -> Resources:
+        return Resources(
+            cpu=self.total.cpu - self.reserved.cpu,
+            memory=self.total.memory - self.reserved.memory,
+        )
+
+    def fits(self, request: Resources) -> bool:
+        free = self.free()
+        return request.cpu <= free.cpu and request.memory <= free.memory
+
+    def reserve(self, request: Resources):
+        with self._lock:
+            self.reserved = _add(self.reserved, request)
+
+    def release(self, request: Resources):
+        with self._lock:
+            self.reserved = _add(self.reserved, request, -1)
+
+    def hold_idle(self, request: Resources, force: bool = False) -> bool:
+        """
+        Account for an idle container, if there is room for it beside the runs
+        and the other idle containers or `force` is set. Returns whether it was
+        accounted for.
+        """
+
+        with self._lock:
+            held = _add(_add(self.reserved, self.idle), request)
+            if not force and (
+                held.cpu > self.total.cpu or held.memory > self.total.memory
+            ):
+                return False
+
+            self.idle = _add(self.idle, request)
+            return True
+
+    def release_idle(self, request: Resources):
+        with self._lock:
+            self.idle = _add(self.idle, request, -1)
+
+    def overcommitted(self) -> bool:
+        """
+        Whether runs and idle containers together hold more than the host has,
+        so idle containers have to make way.
+        """
+
+        held = _add(self.reserved, self.idle)
+        return held.cpu > self.total.cpu or held.memory > self.total.memory
+
+
+def _add(a: Resources, b: Resources, sign: int = 1) -> Resources:
+    return Resources(cpu=a.cpu + sign * b.cpu, memory=a.memory + sign * b.memory)
+
+
+def host_capacity(client: Any, cpu: Optional[str], memory: Optional[str]) -> Resources:
+    """
+    Capacity of a docker host, as configured or as reported by its daemon.
+    """
+
+    if cpu is not None and memory is not None:
+        return Resources(cpu=float(cpu), memory=int(memory))
+
+    info = client.info()  # type: ignore
+
+    return Resources(
+        cpu=float(info["NCPU"]) if cpu is None else float(cpu),
+        memory=int(info["MemTotal"]) // 2**20 if memory is None else int(memory),
+    )
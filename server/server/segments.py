@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Protocol,
+    Tuple,
+    TypeVar,
+)
+
+
+class Segment(Protocol):
+    seq: int
+
+
+S = TypeVar("S", bound=Segment)
+
+
+class SegmentEvents:
+    """
+    Events set whenever a new segment is stored for a build or run, keyed by
+    its id.
+    """
+
+    def __init__(self):
+        self._events: Dict[str, asyncio.Event] = {}
+
+    def notify(self, key: str):
+        event = self._events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    async def wait(self, key: str, timeout: float):
+        """
+        Wait until a new segment is stored for `key`, or the timeout passes.
+        """
+
+        event = self._events.setdefault(key, asyncio.Event())
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def tail_segments(
+    segments_after: Callable[[int], Awaitable[List[S]]],
+    finished: Callable[[], Awaitable[bool]],
+    wait: Callable[[], Awaitable[None]],
+    after: int = -1,
+) -> AsyncIterator[S]:
+    """
+    Yield the segments after `after`, waiting for more until `finished`.
+    """
+
+    while True:
+        done = await finished()
+
+        # segments are flushed before their build or run is marked finished,
+        # so reading them after the status cannot miss the last of them
+        segments = await segments_after(after)
+
+        for segment in segments:
+            after = segment.seq
+            yield segment
+
+        if done:
+            return
+
+        if not segments:
+            await wait()
+
+
+class SegmentWriter:
+    """
+    Buffers what is written and stores it in numbered segments, when enough is
+    buffered or the oldest buffered item is old enough. Subclasses turn what
+    is written into buffered items and store segments of them.
+
+    Written to from other threads; storage writes are sent to the event loop.
+    """
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, flush_size: int, flush_interval: float
+    ):
+        self.loop = loop
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._buffer: List[Any] = []
+        self._size = 0
+        self._seq = 0
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def item(self, data: Any) -> Tuple[Any, int]:
+        """
+        The item to buffer for what is written, and how much it counts towards
+        `flush_size`. Called with the buffer locked.
+        """
+
+        raise NotImplementedError
+
+    async def store(self, seq: int, items: List[Any]):
+        raise NotImplementedError
+
+    def write(self, data: Any):
+        with self._lock:
+            item, size = self.item(data)
+            self._buffer.append(item)
+            self._size += size
+
+            if self._size >= self.flush_size:
+                flush_now = True
+            else:
+                flush_now = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+                items = self._buffer
+                self._buffer = []
+                self._size = 0
+
+            if not items:
+                return
+
+            future = asyncio.run_coroutine_threadsafe(
+                self.store(self._seq, items), self.loop
+            )
+            future.result()
+            self._seq += 1
@@ -0,0 +1,159 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("docker")
+# the fleet's warm pools need a generated prisma client
+pytest.importorskip("prisma.models")
+
+from server.admission import (  # noqa: E402
+    PRIORITY_INTERACTIVE,
+    PRIORITY_SCHEDULED,
+    AdmissionController,
+    PendingRun,
+)
+from server.fleet import Fleet  # noqa: E402
+from server.resources import Resources  # noqa: E402
+
+RUN = Resources(cpu=1, memory=512)
+
+
+class FakeImages:
+    def list(self):
+        return []
+
+
+class FakeClient:
+    images = FakeImages()
+
+    def info(self):
+        return {"NCPU": 64, "MemTotal": 65536 * 2**20}
+
+
+class Runs:
+    """
+    Runs that stay running until they are finished by the test.
+    """
+
+    def __init__(self):
+        self.started = []
+        self.done = {}
+
+    def pending(
+        self,
+        run_id: str,
+        workspace_id: str = "a",
+        priority: int = PRIORITY_INTERACTIVE,
+        batch_id=None,
+    ) -> PendingRun:
+        self.done[run_id] = asyncio.Event()
+
+        async def start(host):
+            self.started.append(run_id)
+            await self.done[run_id].wait()
+
+        return PendingRun(
+            run_id=run_id,
+            workspace_id=workspace_id,
+            priority=priority,
+            enqueued_at=time.time(),
+            resources=RUN,
+            image="build",
+            start=start,
+            batch_id=batch_id,
+        )
+
+    async def finish(self, run_id: str):
+        self.done[run_id].set()
+        await settle()
+
+
+async def settle():
+    # lets started runs, and those admitted as others finish, get going
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def controller(max_running: int, workspace_max_running: int) -> AdmissionController:
+    fleet = Fleet()
+    fleet.register("local", FakeClient())
+
+    return AdmissionController(max_running, workspace_max_running, fleet)
+
+
+def test_interactive_runs_are_admitted_before_scheduled_ones():
+    async def scenario():
+        admission, runs = controller(1, 4), Runs()
+
+        admission.submit(runs.pending("first"))
+        admission.submit(runs.pending("scheduled", priority=PRIORITY_SCHEDULED))
+        admission.submit(runs.pending("interactive"))
+        await settle()
+        assert runs.started == ["first"]
+
+        await runs.finish("first")
+        await runs.finish("interactive")
+
+        return runs.started
+
+    assert asyncio.run(scenario()) == ["first", "interactive", "scheduled"]
+
+
+def test_workspaces_and_batches_take_turns():
+    async def scenario():
+        admission, runs = controller(1, 4), Runs()
+
+        admission.submit(runs.pending("first", workspace_id="c"))
+        admission.submit(runs.pending("a1"))
+        admission.submit(runs.pending("a2"))
+        admission.submit(runs.pending("b1", workspace_id="b"))
+        admission.submit(runs.pending("x1", batch_id="x"), parallelism=4)
+        await settle()
+
+        for run_id in ["first", "a1", "b1", "x1"]:
+            await runs.finish(run_id)
+
+        return runs.started
+
+    assert asyncio.run(scenario()) == ["first", "a1", "b1", "x1", "a2"]
+
+
+def test_workspace_limit():
+    async def scenario():
+        admission, runs = controller(8, 1), Runs()
+
+        admission.submit(runs.pending("a1"))
+        admission.submit(runs.pending("a2"))
+        admission.submit(runs.pending("b1", workspace_id="b"), max_runs=2)
+        admission.submit(runs.pending("b2", workspace_id="b"), max_runs=2)
+        await settle()
+        assert sorted(runs.started) == ["a1", "b1", "b2"]
+        assert admission.stats("a").queued == 1
+
+        await runs.finish("a1")
+
+        return runs.started
+
+    assert asyncio.run(scenario())[-1] == "a2"
+
+
+def test_batch_parallelism():
+    async def scenario():
+        admission, runs = controller(8, 8), Runs()
+
+        for index in range(4):
+            admission.submit(runs.pending(f"x{index}", batch_id="x"), parallelism=2)
+        await settle()
+        assert runs.started == ["x0", "x1"]
+
+        await runs.finish("x0")
+        assert runs.started == ["x0", "x1", "x2"]
+
+        # the batch's limit is dropped once it has no runs left
+        for run_id in ["x1", "x2", "x3"]:
+            await runs.finish(run_id)
+
+        return admission
+
+    assert "x" not in asyncio.run(scenario())._limits
@@ -0,0 +1,45 @@
+import io
+
+import pytest
+
+pytest.importorskip("zstandard")
+
+from server import blobs  # noqa: E402
+from server.blobs import BlobStore  # noqa: E402
+
+# several frames of a few bytes each, the last one short
+DATA = bytes(range(256)) * 4 + b"tail"
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, "BLOB_FRAME_SIZE", 100)
+    return BlobStore(str(tmp_path))
+
+
+@pytest.mark.parametrize(
+    "start,end",
+    [(0, -1), (0, 100), (99, 101), (150, 420), (1000, -1), (1020, 5000), (300, 300)],
+)
+def test_range_reads(store, start, end):
+    digest, size = store.put(DATA)
+
+    assert size == len(DATA)
+    assert store.read(digest, start, end) == DATA[start : None if end < 0 else end]
+
+
+def test_blob_is_stored_once_whoever_writes_it(store):
+    digest, _ = store.put(DATA)
+
+    assert store.put_file(io.BytesIO(DATA)) == (digest, len(DATA))
+    assert store.size(digest) == len(DATA)
+    assert b"".join(store.stream(digest)) == DATA
+
+
+def test_put_file_checks_the_expected_digest(store):
+    digest, _ = store.put(b"other")
+
+    with pytest.raises(ValueError):
+        store.put_file(io.BytesIO(DATA), expected=digest)
+
+    assert list(store.digests(older_than=-60)) == [digest]
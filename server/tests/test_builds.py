@@ -0,0 +1,73 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+docker = pytest.importorskip("docker")
+# the build queue needs a generated prisma client
+pytest.importorskip("prisma.models")
+
+from prisma import models as PrismaModels  # noqa: E402
+from prisma.enums import BuildStatus, Engine  # noqa: E402
+
+try:
+    from server.builds import BuildQueue, construct_dockerfile  # noqa: E402
+except docker.errors.DockerException:
+    pytest.skip("needs a Docker daemon", allow_module_level=True)
+
+
+class FakeBuilds:
+    def __init__(self):
+        self.updates = []
+
+    async def update(self, data, where):
+        self.updates.append((where["id"], data["status"]))
+
+
+def instructions(dockerfile: str):
+    return [x.strip() for x in dockerfile.splitlines() if x.strip()]
+
+
+@pytest.mark.parametrize(
+    "engine,install",
+    [
+        (Engine.Python, "RUN if test -f"),
+        (Engine.Node, "RUN yarn install"),
+    ],
+)
+def test_build_command_runs_on_the_extracted_context(engine, install):
+    script = SimpleNamespace(engine=engine, engine_version="3.10")
+    lines = instructions(construct_dockerfile(script, "make all", "base:latest"))
+
+    def index(prefix: str) -> int:
+        return next(i for i, x in enumerate(lines) if x.startswith(prefix))
+
+    assert lines[0] == "FROM base:latest AS build"
+    assert lines.count("FROM base:latest") == 1
+    assert (
+        index("COPY deps/")
+        < index(install)
+        < index("COPY context.tar.gz")
+        < index("RUN tar -xzf context.tar.gz")
+        < index("RUN make all")
+        < lines.index("FROM base:latest")
+        < index("COPY --from=build /app")
+    )
+
+
+def test_waiting_build_is_superseded_by_a_newer_one(monkeypatch):
+    builds = FakeBuilds()
+    monkeypatch.setattr(PrismaModels.Build, "prisma", lambda: builds)
+
+    # without workers, every build stays queued
+    queue = BuildQueue(workers=0)
+
+    async def submit():
+        queue.start()
+        await queue.submit("script", "first")
+        await queue.submit("script", "second")
+        await queue.submit("other", "third")
+
+    asyncio.run(submit())
+
+    assert builds.updates == [("first", BuildStatus.SUPERSEDED)]
@@ -0,0 +1,40 @@
+from server.cache import ResultCache, cache_key
+
+KEY = cache_key("build", {"name": "village"})
+
+
+def test_identical_runs_wait_on_the_run_in_flight():
+    cache = ResultCache(max_entries=2)
+
+    assert not cache.join(KEY, "leader")
+    assert cache.join(KEY, "waiter")
+
+    assert cache.finish("leader", {"output": "done"}, ttl=60) == ["waiter"]
+    assert cache.get(KEY) == {"output": "done"}
+    assert cache.stats().in_flight == 0
+
+
+def test_cancelling_a_queued_leader_releases_its_key():
+    cache = ResultCache(max_entries=2)
+    cache.join(KEY, "leader")
+    cache.join(KEY, "first")
+    cache.join(KEY, "second")
+
+    assert cache.cancel("leader") == ["first", "second"]
+    assert cache.stats().in_flight == 0
+    assert cache.get(KEY) is None
+
+    # the waiters are queued again, with the first of them in flight
+    assert not cache.join(KEY, "first")
+    assert cache.join(KEY, "second")
+    assert cache.finish("first", None, ttl=60) == ["second"]
+
+
+def test_cancelling_a_waiter():
+    cache = ResultCache(max_entries=2)
+    cache.join(KEY, "leader")
+    cache.join(KEY, "waiter")
+
+    assert cache.cancel("waiter") == []
+    assert cache.finish("leader", None, ttl=60) == []
+    assert cache.stats().in_flight == 0
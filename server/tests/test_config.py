@@ -0,0 +1,48 @@
+import pytest
+
+# the config's param types come from the generated prisma client
+pytest.importorskip("prisma.enums")
+pytest.importorskip("pydantic_yaml")
+
+from pydantic import ValidationError  # noqa: E402
+
+from models.config import Config  # noqa: E402
+
+CONFIG = """
+name: village
+id: village
+"""
+
+
+def parse(extra: str) -> Config:
+    return Config.parse_raw(CONFIG + extra)
+
+
+@pytest.mark.parametrize(
+    "memory,megabytes",
+    [("512", 512), ("512m", 512), ("2g", 2048), ("2 GB", 2048), ("1024k", 1)],
+)
+def test_memory_sizes(memory, megabytes):
+    assert parse(f"memory: {memory}").memory == megabytes
+
+
+@pytest.mark.parametrize("memory", ["1.5", "true", "[512]", "lots", "512t"])
+def test_invalid_memory_sizes_are_rejected(memory):
+    with pytest.raises(ValidationError):
+        parse(f"memory: {memory}")
+
+
+@pytest.mark.parametrize(
+    "field,value", [("cpu", "0"), ("cpu", "-1"), ("memory", "0"), ("timeout", "0")]
+)
+def test_resources_must_be_positive(field, value):
+    with pytest.raises(ValidationError):
+        parse(f"{field}: {value}")
+
+
+def test_resources_are_optional():
+    config = parse("cpu: 0.5")
+
+    assert config.cpu == 0.5
+    assert config.memory is None
+    assert config.timeout is None
@@ -0,0 +1,105 @@
+import hashlib
+import io
+import tarfile
+
+import pytest
+
+pytest.importorskip("zstandard")
+
+from server import contexts  # noqa: E402
+from server.blobs import BlobStore  # noqa: E402
+from server.contexts import (  # noqa: E402
+    ContextFileError,
+    ContextTooLargeError,
+    ManifestFile,
+    TarStream,
+    assemble_context,
+    read_context,
+    store_files,
+)
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path))
+    monkeypatch.setattr(contexts, "file_store", store)
+    return store
+
+
+def test_file_with_another_hash_is_not_kept(store):
+    sent = sha256(b"expected")
+
+    with pytest.raises(ContextFileError):
+        store_files([(io.BytesIO(b"uploaded"), sent)], max_bytes=1024)
+
+    assert not store.exists(sent)
+    assert not store.exists(sha256(b"uploaded"))
+
+
+def test_uploaded_files_share_the_size_limit(store):
+    first, second = b"a" * 600, b"b" * 600
+
+    store_files([(io.BytesIO(first), sha256(first))], max_bytes=1024)
+
+    with pytest.raises(ContextTooLargeError):
+        store_files(
+            [
+                (io.BytesIO(first), sha256(first)),
+                (io.BytesIO(second), sha256(second)),
+            ],
+            max_bytes=1024,
+        )
+
+    assert store.exists(sha256(first))
+    assert not store.exists(sha256(second))
+
+
+def test_tar_stream(tmp_path):
+    context = tmp_path / "context.tar.gz"
+    context.write_bytes(b"x" * 1000)
+    members = [
+        ("Dockerfile", b"FROM scratch\n"),
+        ("deps", None),
+        ("deps/requirements.txt", b""),
+        ("context.tar.gz", str(context)),
+    ]
+
+    stream = TarStream(members)
+    # odd sizes, so that reads straddle headers, contents and padding
+    chunks = iter(lambda: stream.read(333), b"")
+    data = b"".join(chunks)
+
+    assert len(data) == len(TarStream(members))
+    assert b"".join(TarStream(members)) == data
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert tar.getnames() == [x for x, _ in members]
+        assert tar.getmember("deps").isdir()
+        assert tar.extractfile("Dockerfile").read() == b"FROM scratch\n"
+        assert tar.extractfile("context.tar.gz").read() == b"x" * 1000
+
+
+def test_assembled_context_has_the_manifest_files(store, tmp_path):
+    config, script = b"name: village\n", b"#!/bin/sh\n"
+    store.put(config)
+    store.put(script)
+    files = [
+        ManifestFile(path="village.yaml", hash=sha256(config), size=len(config)),
+        ManifestFile(
+            path="bin/run", hash=sha256(script), size=len(script), executable=True
+        ),
+    ]
+    path = str(tmp_path / "context.tar.gz")
+
+    assembled = assemble_context(files, path, max_bytes=1024)
+
+    assert assembled.config == config
+    assert read_context(path).files == assembled.files
+    assert assembled.files == [
+        ("village.yaml", False, sha256(config)),
+        ("bin/run", True, sha256(script)),
+    ]
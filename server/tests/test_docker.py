@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+docker = pytest.importorskip("docker")
+# the executor needs a generated prisma client
+pytest.importorskip("prisma.models")
+
+from prisma import models as PrismaModels  # noqa: E402
+
+try:
+    from server.docker import (  # noqa: E402
+        RunControl,
+        RunNotCancellableError,
+        cancel_requested_runs,
+        cancel_run,
+        run_controls,
+    )
+except docker.errors.DockerException:
+    pytest.skip("needs a Docker daemon", allow_module_level=True)
+
+RUN_ID = "run"
+
+
+class FakeRuns:
+    def __init__(self, updated=0, found=()):
+        self.updated = updated
+        self.found = list(found)
+        self.updates = []
+
+    async def update_many(self, data, where):
+        self.updates.append(data)
+        return self.updated
+
+    async def find_many(self, where):
+        return self.found
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    fake = FakeRuns()
+    monkeypatch.setattr(PrismaModels.Run, "prisma", lambda: fake)
+    yield fake
+    run_controls.pop(RUN_ID, None)
+
+
+def test_run_of_another_server_is_left_to_its_owner(runs):
+    runs.updated = 1
+
+    asyncio.run(cancel_run(RUN_ID))
+
+    assert runs.updates == [{"cancel_requested": True}]
+
+
+def test_owner_stops_runs_cancelled_elsewhere(runs):
+    control = RunControl(timeout=None)
+    run_controls[RUN_ID] = control
+    runs.found = [SimpleNamespace(id=RUN_ID)]
+
+    asyncio.run(cancel_requested_runs())
+
+    assert control.cancelled.is_set()
+    assert runs.updates == []
+
+
+def test_run_no_server_can_stop_is_not_cancellable(runs):
+    with pytest.raises(RunNotCancellableError):
+        asyncio.run(cancel_run(RUN_ID))
+
+    assert len(runs.updates) == 2
@@ -0,0 +1,91 @@
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+# the runner's module needs a generated prisma client
+pytest.importorskip("prisma.models")
+
+from server.fargate import (  # noqa: E402
+    FargateError,
+    FargateRunner,
+    fargate_size,
+    run_result,
+)
+
+IMAGE_URI = "123456789012.dkr.ecr.us-west-1.amazonaws.com/village:abc"
+
+
+@pytest.fixture
+def runner():
+    with moto.mock_aws():
+        ec2 = boto3.client("ec2", region_name="us-west-1")
+        vpc = ec2.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]
+        ec2.modify_vpc_attribute(VpcId=vpc["VpcId"], EnableDnsHostnames={"Value": True})
+        subnet = ec2.create_subnet(VpcId=vpc["VpcId"], CidrBlock="10.0.0.0/24")
+
+        ecs = boto3.client("ecs", region_name="us-west-1")
+        yield FargateRunner(
+            ecs,
+            cluster="village-test",
+            subnets=[subnet["Subnet"]["SubnetId"]],
+            security_groups=[],
+            execution_role=None,
+            log_group="/village/test",
+            region="us-west-1",
+        )
+
+
+def test_fargate_size():
+    assert fargate_size(0.25, 512) == (256, 512)
+    assert fargate_size(0.5, 3000) == (512, 3072)
+    assert fargate_size(1, 512) == (1024, 2048)
+
+    with pytest.raises(FargateError):
+        fargate_size(8, 512)
+
+
+def test_task_definition_is_registered_once(runner):
+    arn = runner.task_definition(IMAGE_URI, 0.25, 512)
+
+    assert runner.task_definition(IMAGE_URI, 0.25, 512) == arn
+    assert runner.task_definition(IMAGE_URI, 0.25, 1024) != arn
+
+    # a new process finds the definition registered by the last one
+    restarted = FargateRunner(
+        runner.ecs,
+        cluster="village-test",
+        subnets=runner.subnets,
+        security_groups=[],
+        execution_role=None,
+        log_group="/village/test",
+        region="us-west-1",
+    )
+    assert restarted.task_definition(IMAGE_URI, 0.25, 512) == arn
+
+    families = runner.ecs.list_task_definition_families()["families"]
+    assert len(families) == 2
+
+
+def test_run(runner):
+    command = ["python3", "shim.py", '{"name": "village"}', "run-uuid"]
+    arn = runner.run(IMAGE_URI, 0.25, 512, command, "run-id")
+
+    task = runner.ecs.describe_tasks(cluster=runner.cluster_arn(), tasks=[arn])
+    overrides = task["tasks"][0]["overrides"]["containerOverrides"]
+
+    assert overrides == [{"name": "village", "command": command}]
+    assert runner.log_stream(arn) == f"village/village/{arn.split('/')[-1]}"
+
+
+def test_run_with_large_params(runner):
+    command = ["python3", "shim.py", "x" * 10000, "run-uuid"]
+
+    with pytest.raises(FargateError):
+        runner.run(IMAGE_URI, 0.25, 512, command, "run-id")
+
+
+def test_run_result():
+    lines = ["starting", '{"result": 1, "uuid": "run-id"}', '{"uuid": "other"}']
+
+    assert run_result("run-id", lines) == lines[1]
+    assert run_result("run-id", ["42", "[1]"]) is None
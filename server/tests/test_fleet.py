@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("docker")
+# the warm pool needs a generated prisma client
+pytest.importorskip("prisma.models")
+
+from server.fleet import Fleet  # noqa: E402
+from server.resources import Resources  # noqa: E402
+
+RUN = Resources(cpu=1, memory=512)
+
+
+class FakeImage:
+    def __init__(self, tag: str):
+        self.tags = [f"{tag}:latest"]
+
+
+class FakeImages:
+    def __init__(self, tags):
+        self.tags = tags
+
+    def list(self):
+        return [FakeImage(x) for x in self.tags]
+
+
+class FakeClient:
+    def __init__(self, cpu, memory, images=(), reachable=True):
+        self.cpu = cpu
+        self.memory = memory
+        self.images = FakeImages(list(images))
+        self.reachable = reachable
+
+    def info(self):
+        if not self.reachable:
+            raise ConnectionError("unreachable")
+
+        return {"NCPU": self.cpu, "MemTotal": self.memory * 2**20}
+
+
+def test_place_prefers_hosts_with_the_image():
+    fleet = Fleet()
+    fleet.register("a", FakeClient(8, 8192))
+    fleet.register("b", FakeClient(2, 2048, images=["build"]))
+
+    assert fleet.place(RUN, "build").endpoint == "b"
+
+    # without the image anywhere, the run is packed onto the fuller host
+    assert fleet.place(RUN, "other").endpoint == "b"
+
+    fleet.hosts["b"].capacity.reserve(Resources(cpu=2, memory=0))
+    assert fleet.place(RUN, "build").endpoint == "a"
+
+
+def test_unhealthy_hosts_are_skipped():
+    fleet = Fleet()
+    fleet.register("a", FakeClient(2, 2048))
+    client = FakeClient(8, 8192, images=["build"])
+    fleet.register("b", client)
+
+    client.reachable = False
+    fleet.heartbeat()
+
+    assert not fleet.hosts["b"].healthy
+    assert fleet.place(RUN, "build").endpoint == "a"
+
+
+def test_host_recovers_after_failed_first_heartbeat():
+    fleet = Fleet()
+    client = FakeClient(4, 4096, reachable=False)
+    fleet.register("a", client)
+
+    # runs are not rejected before any host has reported its capacity
+    assert fleet.largest() is None
+    assert fleet.place(RUN, "build") is None
+
+    client.reachable = True
+    fleet.heartbeat()
+
+    assert fleet.largest() == Resources(cpu=4, memory=4096)
+    assert fleet.place(RUN, "build").endpoint == "a"
@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SHIM = Path(__file__).parent.parent / "sdk" / "shim.py"
+
+MAIN = """
+calls = []
+
+
+def main(params):
+    calls.append(params["name"])
+
+    if params["name"] == "fail":
+        raise ValueError("failed")
+
+    print("hello", params["name"])
+    return {"calls": len(calls), "data": params.get("data")}
+"""
+
+
+def request(request_id: int, params, inputs=()) -> bytes:
+    specs = [{"key": key, "size": len(data), "text": True} for key, data in inputs]
+    line = json.dumps(
+        {"id": request_id, "params": params, "uuid": f"u{request_id}", "inputs": specs}
+    )
+
+    return line.encode("utf-8") + b"\n" + b"".join(data for _, data in inputs)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_serve_fork_ends_each_run_with_its_id_and_exit_code(tmp_path):
+    (tmp_path / "main.py").write_text(MAIN)
+
+    requests = [
+        request(1, {"name": "a"}, [("data", b"raw bytes")]),
+        request(2, {"name": "fail"}),
+        b"\n",
+        request(3, {"name": "b"}),
+    ]
+    served = subprocess.run(
+        [sys.executable, str(SHIM), "--serve", "--fork"],
+        input=b"".join(requests),
+        capture_output=True,
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": str(tmp_path)},
+        timeout=30,
+    )
+
+    assert served.returncode == 0
+    assert served.stdout.decode("utf-8").splitlines() == [
+        "hello a",
+        json.dumps({"result": {"calls": 1, "data": "raw bytes"}, "uuid": "u1"}),
+        "1 0",
+        "2 1",
+        "hello b",
+        # runs are forked, so no state is left from the runs before
+        json.dumps({"result": {"calls": 1, "data": None}, "uuid": "u3"}),
+        "3 0",
+    ]
+    assert b"ValueError: failed" in served.stderr
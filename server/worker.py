@@ -1,33 +1,81 @@
 import asyncio
-import json
-from collections import namedtuple
 from dataclasses import dataclass
 from datetime import timedelta
-from typing import Optional
+from typing import Dict, Optional, Set, Union, cast
 
-import requests
+from fastapi import HTTPException
+from prisma import models as PrismaModels
 from temporalio import activity, workflow
 from temporalio.client import Client
+from temporalio.exceptions import ApplicationError
 from temporalio.worker import Worker
 
 from config import TEMPORAL_SERVER
+from routers.scripts import RunScriptInput, run_script_wrapper
+from server.admission import PRIORITY_SCHEDULED
+from utils.logger import logger
+
+# seconds between activity heartbeats while a scheduled run is queued
+HEARTBEAT_INTERVAL = 5
 
 
 @dataclass
 class RunScheduledInput:
     schedule_id: str
+    # only checked by /schedule/run, as the worker queues runs itself
     token: str
 
 
-@activity.defn
-async def run_script(schedule: RunScheduledInput):
-    res = requests.post(
-        "http://localhost:8000/schedule/run",
-        data=json.dumps({"schedule_id": schedule.schedule_id, "token": schedule.token}),
-        headers={"Content-type": "application/json", "Accept": "text/plain"},
+async def dispatch_schedule(schedule_id: str) -> Optional[PrismaModels.Run]:
+    """
+    Queue a run of the latest build of a scheduled script with the schedule's
+    params. Returns None if the schedule is gone.
+    """
+
+    schedule = await PrismaModels.Schedule.prisma().find_unique(
+        where={"id": schedule_id},
+        include={"params": True},
     )
 
-    return res.text
+    if schedule is None:
+        return None
+
+    params_dict = {param.key: param.value for param in schedule.params or []}
+    params = cast(Optional[Dict[str, Union[str, int, float, bool]]], params_dict)
+
+    run_inputs = RunScriptInput(script_id=schedule.script_id, params=params)
+
+    return await run_script_wrapper(
+        run_inputs, schedule_id=schedule.id, priority=PRIORITY_SCHEDULED
+    )
+
+
+async def heartbeat():
+    while True:
+        activity.heartbeat()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+@activity.defn
+async def run_script(schedule: RunScheduledInput) -> Optional[str]:
+    """
+    Queue a scheduled run and return its id, without waiting for it to finish.
+    """
+
+    beat = asyncio.create_task(heartbeat())
+
+    try:
+        run = await dispatch_schedule(schedule.schedule_id)
+    except HTTPException as err:
+        # no build to run or invalid params, which a retry will not fix
+        raise ApplicationError(str(err.detail), non_retryable=True) from err
+    finally:
+        beat.cancel()
+
+    if run is None:
+        raise ApplicationError("Schedule not found", non_retryable=True)
+
+    return run.id
 
 
 @workflow.defn
@@ -35,20 +83,40 @@ class RunScript:
     @workflow.run
     async def run(self, schedule: RunScheduledInput) -> Optional[str]:
         return await workflow.execute_activity(
-            run_script, schedule, schedule_to_close_timeout=timedelta(seconds=5)
+            run_script,
+            schedule,
+            start_to_close_timeout=timedelta(minutes=5),
+            heartbeat_timeout=timedelta(seconds=HEARTBEAT_INTERVAL * 4),
         )
 
 
-async def main():
-    # Create client connected to server at the given address
-    client = await Client.connect(TEMPORAL_SERVER)
+worker_tasks: Set["asyncio.Task[None]"] = set()
+
+
+async def run_worker():
+    try:
+        client = await Client.connect(TEMPORAL_SERVER)
+    except Exception as err:
+        logger.error(f"not running schedules, Temporal is unreachable: {err}")
+        return
 
-    # Run the worker
     worker = Worker(
         client, task_queue="main-queue", workflows=[RunScript], activities=[run_script]
     )
     await worker.run()
 
 
-if __name__ == "__main__":
-    asyncio.run(main())
+def start_worker():
+    """
+    Run scheduled scripts from this process, next to the executor they are
+    queued on.
+    """
+
+    task = asyncio.create_task(run_worker())
+    worker_tasks.add(task)
+    task.add_done_callback(worker_tasks.discard)
+
+
+def shutdown_worker():
+    for task in list(worker_tasks):
+        task.cancel()